@@ -1281,8 +1281,8 @@ class Handlers:
         return
 
     def on_subtract_bg_checkbutton_activate(self, button):
-        #TODO
-        return
+        # a check button of its own, the background is subtracted on top of the dark or temporal subtraction
+        self.parent.parent.ImageProcessor.set_background_subtraction(button.get_active())
 
     def on_ip_back_button_clicked(self, button):
         self.parent.IpViewWrapper.channel_decrement()
@@ -0,0 +1,335 @@
+import os
+import time
+import argparse
+import tempfile
+from subprocess import run
+import numpy as np
+import cv2
+from tifffile import imread, imwrite
+
+from ImageProcessing.raw_converter import Crop, HDR_SIZE, HDR_WIDTH_OFFSET, IMG_H, IMG_W, RAW_CONVERT_BINARY_PATH, DECODE_MODES, UNPACK_BACKENDS, get_raw_convert_lib, get_raw_geometry, get_raw_payload, decode_raw_buffer, decode_raw_file, write_raw_tiff, numba
+from ImageProcessing.ZionImage import ZionImage, jpg_to_raw, set_load_threads, rgb2gray, median_filter, segment_spots, segment_spots_multiscale, open_spots, MEDIAN_BACKENDS, MORPHOLOGY_MODES
+from ImageProcessing.ZionImageCache import image_cache
+from ImageProcessing.ZionRegistration import ZionRegistration, REGISTRATION_MODES, get_transform_distance
+
+'''
+    Timing comparisons for the image processing pipeline. Run from the repository root, eg:
+        python -m ImageProcessing.ZionBenchmarks raw [path/to/capture.jpg]
+        python -m ImageProcessing.ZionBenchmarks compression [path/to/capture.jpg]
+        python -m ImageProcessing.ZionBenchmarks imageset
+        python -m ImageProcessing.ZionBenchmarks registration
+        python -m ImageProcessing.ZionBenchmarks median [path/to/uv_image.tif]
+        python -m ImageProcessing.ZionBenchmarks rois [path/to/uv_image.tif]
+        python -m ImageProcessing.ZionBenchmarks morphology [path/to/uv_image.tif]
+        python -m ImageProcessing.ZionBenchmarks check
+    If no capture is given, synthetic data is used instead (real captures give much more meaningful compression numbers).
+'''
+
+def make_synthetic_jpeg_raw(seed=0, jpeg_size=2**20, width=2*IMG_W, height=2*IMG_H):
+    ''' Random "jpeg" followed by a BRCM header block and random packed bayer data, laid out like a capture.
+        The default size is a full resolution (sensor mode 3) capture, 2028x1520 gives a sensor mode 2 one.
+    '''
+    rng = np.random.default_rng(seed)
+    jpeg = rng.integers(0, 256, jpeg_size, dtype=np.uint8).tobytes()
+    header = bytearray(HDR_SIZE)
+    header[:4] = b'BRCM'
+    header[HDR_WIDTH_OFFSET-32:HDR_WIDTH_OFFSET-26] = b'imx477'
+    header[HDR_WIDTH_OFFSET:HDR_WIDTH_OFFSET+4] = np.array([width, height], dtype='<u2').tobytes()
+    bytes_per_line = (width*3//2 + 31) // 32 * 32
+    payload = rng.integers(0, 256, bytes_per_line*(height+16), dtype=np.uint8).tobytes()
+    return jpeg + bytes(header) + payload
+
+def make_synthetic_image(seed=0, nSpots=60):
+    ''' Decoded-looking frame: gaussian spots on a dim background with noise, 12-bit data in the top of 16 bits '''
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:IMG_H, 0:IMG_W]
+    img = np.full((IMG_H, IMG_W, 3), 200.0)
+    for _ in range(nSpots):
+        y, x = rng.uniform(0, IMG_H), rng.uniform(0, IMG_W)
+        img += rng.uniform(200, 2000, 3) * np.exp(-((yy-y)**2 + (xx-x)**2) / (2*rng.uniform(15, 40)**2))[:,:,None]
+    img = np.clip(rng.poisson(img), 0, 4095).astype(np.uint16)
+    return img << 4
+
+def get_available_backends():
+    return [b for b in UNPACK_BACKENDS if not (b == 'c' and get_raw_convert_lib() is None) and not (b == 'numba' and numba is None)]
+
+def unpack_reference(buffer):
+    ''' Plain per-pixel unpacking of the 'rgb' image, written independently of the raw_converter backends '''
+    geometry = get_raw_geometry(buffer)
+    payload = get_raw_payload(buffer, geometry).reshape(-1, geometry.bytes_per_line)
+    img = np.empty((geometry.img_h, geometry.img_w, 3), dtype=np.uint16)
+    for l in range(geometry.img_h):
+        even = payload[2*l].astype(np.uint16)
+        odd = payload[2*l+1].astype(np.uint16)
+        for p in range(geometry.img_w):
+            g1, r = (even[3*p] << 4) | (even[3*p+2] & 0x0F), (even[3*p+1] << 4) | (even[3*p+2] >> 4)
+            b, g2 = (odd[3*p] << 4) | (odd[3*p+2] & 0x0F), (odd[3*p+1] << 4) | (odd[3*p+2] >> 4)
+            img[l, p] = (r << 4, (g1 << 3) + (g2 << 3), b << 4)
+    return img
+
+def check_unpack_backends(seeds=(0, 1)):
+    ''' Regression check of every available unpack backend and decode mode against each other, and of the 'rgb' output
+        against unpack_reference, on synthetic sensor mode 3 and mode 2 buffers. Cropped decoding is checked against
+        cropping the whole image. Raises ValueError on any mismatch.
+    '''
+    backends = get_available_backends()
+    print(f"Checking unpack backends {backends}")
+    for width, height in ((2*IMG_W, 2*IMG_H), (IMG_W, IMG_H)):
+        for seed in seeds:
+            buffer = make_synthetic_jpeg_raw(seed=seed, width=width, height=height)
+            # the reference is slow, so it's only compared on a band of lines
+            rgb = decode_raw_buffer(buffer, backend=backends[-1])
+            geometry = get_raw_geometry(buffer)
+            band = geometry.bytes_per_line*32
+            banded = buffer[:-geometry.payload_size] + buffer[-geometry.payload_size:][:band] + bytes(geometry.payload_size-band)
+            if not np.array_equal(decode_raw_buffer(banded, backend=backends[-1])[:16], unpack_reference(banded)[:16]):
+                raise ValueError(f"{backends[-1]} unpacking of {width}x{height} doesn't match the reference!")
+            for mode in DECODE_MODES:
+                expected = decode_raw_buffer(buffer, mode=mode, backend=backends[-1])
+                for backend in backends[:-1]:
+                    if not np.array_equal(decode_raw_buffer(buffer, mode=mode, backend=backend), expected):
+                        raise ValueError(f"{backend} and {backends[-1]} differ in {mode} mode for {width}x{height}!")
+            # 'full' mode demosaics the crop on its own, so its edges differ from the whole image's
+            for crop in (Crop.from_normalized((0.3, 0.2, 0.5, 0.6), geometry), Crop(geometry.img_h-2, geometry.img_w-4, 2, 4)):
+                for mode in ('rgb', 'bayer', 'binned'):
+                    expected = decode_raw_buffer(buffer, mode=mode, backend=backends[-1])
+                    f = 2 if mode == 'binned' else 1
+                    expected = expected[crop.y//f:(crop.y+crop.h)//f, crop.x//f:(crop.x+crop.w)//f]
+                    for backend in backends:
+                        if not np.array_equal(decode_raw_buffer(buffer, mode=mode, backend=backend, crop=crop), expected):
+                            raise ValueError(f"{backend} decoding of {crop} differs from the whole image in {mode} mode for {width}x{height}!")
+    print("All unpack backends bit-identical")
+
+def time_it(func, repeats=5):
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return min(times), sum(times)/len(times)
+
+def print_timing_table(results):
+    print(f"{'method':<50}{'best (s)':>10}{'mean (s)':>10}")
+    for name, (t_best, t_mean) in results.items():
+        print(f"{name:<50}{t_best:>10.4f}{t_mean:>10.4f}")
+
+def benchmark_raw_conversion(jpg_path=None, repeats=5):
+    tmp_dir = tempfile.mkdtemp()
+    if jpg_path is None:
+        jpg_path = os.path.join(tmp_dir, "synthetic.jpg")
+        with open(jpg_path, "wb") as f:
+            f.write(make_synthetic_jpeg_raw())
+    with open(jpg_path, "rb") as f:
+        buffer = f.read()
+    tif_path = os.path.join(tmp_dir, "out.tif")
+
+    results = dict()
+    try:
+        results["convert_raw_c binary (fork + file round trip)"] = time_it(lambda: run([RAW_CONVERT_BINARY_PATH, jpg_path, tif_path], capture_output=True), repeats)
+        reference = imread(tif_path)
+    except OSError as e:
+        print(f"Skipping convert_raw_c binary: {e}")
+        reference = None
+
+    results["in-process decode from file"] = time_it(lambda: decode_raw_file(jpg_path), repeats)
+    results["in-process decode from buffer"] = time_it(lambda: decode_raw_buffer(buffer), repeats)
+    out = np.empty_like(decode_raw_buffer(buffer))
+    results["in-process decode into preallocated array"] = time_it(lambda: decode_raw_buffer(buffer, out=out), repeats)
+    crop = Crop.from_normalized((0.25, 0.25, 0.5, 0.5), get_raw_geometry(buffer))
+    results["in-process decode of the middle quarter (crop)"] = time_it(lambda: decode_raw_buffer(buffer, crop=crop), repeats)
+    results["in-process decode from buffer + tiff write"] = time_it(lambda: jpg_to_raw(jpg_path, tif_path, buffer=buffer), repeats)
+    for backend in get_available_backends():
+        decode_raw_buffer(buffer, out=out, backend=backend) # eg numba compiles on first call
+        results[f"{backend} backend decode into preallocated array"] = time_it(lambda: decode_raw_buffer(buffer, out=out, backend=backend), repeats)
+    if reference is not None:
+        print(f"In-process output identical to convert_raw_c: {np.array_equal(reference, decode_raw_buffer(buffer))}")
+
+    print_timing_table(results)
+    return results
+
+def make_synthetic_cycle(dir_path, cycle=1, wavelengths=('000', '445', '525', '590', '645', '365'), seed=0):
+    ''' Tifs of a cycle, a dark and two frames of every other wavelength, named like converted captures.
+        Returns the frames of each wavelength in capture order.
+    '''
+    rng = np.random.default_rng(seed)
+    img = make_synthetic_image(seed)
+    wl_files = dict()
+    t = 1000
+    for wl in wavelengths:
+        for _ in range(1 if wl == '000' else 2):
+            t += 1
+            filepath = os.path.join(dir_path, f"{t:08d}_{cycle:03d}A_{t:05d}_{wl}_C{cycle:03d}_{t:09d}.tif")
+            imwrite(filepath, np.clip(img.astype(np.int32) + rng.integers(-512, 512, img.shape), 0, 65535).astype(np.uint16))
+            wl_files.setdefault(wl, []).append(filepath)
+    return wl_files
+
+def benchmark_imageset_loading(repeats=5, threads=(1, 2, 4, 6)):
+    ''' Time to read a 6 wavelength cycle (dark subtracted and as difference images) into a ZionImage, per load pool size '''
+    wl_files = make_synthetic_cycle(tempfile.mkdtemp())
+    wls = list(wl_files.keys())
+    files = [wl_files[wl][-1] for wl in wls]
+    subtrahends = [wl_files[wl][0] for wl in wls if wl != '000']
+    def load(**kwargs):
+        image_cache.clear() # timing reads from disk, not from the cache
+        return ZionImage(files, wls, cycle=1, **kwargs).view_4D
+
+    results = dict()
+    expected = dict()
+    for nThreads in threads:
+        set_load_threads(nThreads)
+        for name, kwargs in (("dark subtracted", dict()), ("difference images", dict(subtrahends=subtrahends))):
+            out = load(**kwargs)
+            if not np.array_equal(expected.setdefault(name, out), out):
+                raise ValueError(f"Loading with {nThreads} threads gives a different {name} imageset!")
+            results[f"{name}, {nThreads} load threads"] = time_it(lambda: load(**kwargs), repeats)
+    set_load_threads(min(4, os.cpu_count() or 1))
+    print_timing_table(results)
+    return results
+
+def benchmark_registration(repeats=5, scales=(2, 4, 8)):
+    ''' Registration time and error (furthest a corner ends up from where it should, in pixels) for known drifts, per mode and scale '''
+    img = make_synthetic_image(0)
+    drifts = {"translation": np.array([[1, 0, 6.3], [0, 1, -4.2]]), "affine": np.array([[1.001, 0.002, 6.3], [-0.002, 1.001, -4.2]])}
+    rng = np.random.default_rng(1)
+    results = dict()
+    errors = dict()
+    for drift_name, drift in drifts.items():
+        moved = cv2.warpAffine(img, drift, (img.shape[1], img.shape[0]))
+        moved = np.clip(moved.astype(np.int32) + rng.integers(-512, 512, moved.shape), 0, 65535).astype(np.uint16)
+        for mode in REGISTRATION_MODES:
+            for scale in scales:
+                registration = ZionRegistration(img, scale=scale, mode=mode)
+                name = f"{drift_name} drift, {mode} mode, scale {scale}"
+                results[name] = time_it(lambda: registration.estimate(moved), repeats)
+                errors[name] = get_transform_distance(registration.estimate(moved), drift, img.shape[:2])
+    print_timing_table(results)
+    print(f"{'error (pixels)':<50}")
+    for name, error in errors.items():
+        print(f"{name:<50}{error:>10.2f}")
+
+def benchmark_median_backends(tif_path=None, repeats=1, median_ks=9):
+    ''' Median filter time per backend (see ZionImage.MEDIAN_BACKENDS), and how the ROIs found with each (by segment_spots)
+        compare to those of 'disk': spot count, and the intersection over union of the ROI masks
+    '''
+    img = imread(tif_path) if tif_path is not None else make_synthetic_image()
+    img_gs = rgb2gray(img) if img.ndim == 3 else img
+    results = dict()
+    masks = dict()
+    for backend in MEDIAN_BACKENDS:
+        results[backend] = time_it(lambda: median_filter(img_gs, median_ks, backend=backend), repeats)
+        labels, nSpots = segment_spots(img_gs, median_ks, median_backend=backend)
+        masks[backend] = (labels > 0, nSpots)
+    print_timing_table(results)
+    reference, _ = masks['disk']
+    print(f"{'backend':<50}{'spots':>10}{'ROI IoU':>10}")
+    for backend, (mask, nSpots) in masks.items():
+        union = np.count_nonzero(mask | reference)
+        iou = np.count_nonzero(mask & reference) / union if union else 1.0
+        print(f"{backend:<50}{nSpots:>10}{iou:>10.4f}")
+
+def benchmark_roi_detection(tif_path=None, repeats=1, scales=(1, 2, 4), backends=('disk', 'rank', 'cv2')):
+    ''' Spot segmentation time at full resolution (scale 1) and coarse to fine (see ZionImage.segment_spots_multiscale),
+        per median backend, and how the ROIs compare to those of full resolution with the 'disk' median
+    '''
+    img = imread(tif_path) if tif_path is not None else make_synthetic_image()
+    img_gs = rgb2gray(img) if img.ndim == 3 else img
+    results = dict()
+    rois = dict()
+    for scale in scales:
+        for backend in backends:
+            name = f"scale {scale}, {backend} median"
+            if scale > 1:
+                segment = lambda: segment_spots_multiscale(img_gs, median_backend=backend, scale=scale)
+            else:
+                segment = lambda: segment_spots(img_gs, median_backend=backend)
+            results[name] = time_it(segment, repeats)
+            rois[name] = segment()
+    print_timing_table(results)
+    reference = rois["scale 1, disk median"][0] > 0
+    print(f"{'method':<50}{'spots':>10}{'ROI IoU':>10}")
+    for name, (labels, nSpots) in rois.items():
+        mask = labels > 0
+        print(f"{name:<50}{nSpots:>10}{np.count_nonzero(mask & reference) / max(np.count_nonzero(mask | reference), 1):>10.4f}")
+
+def benchmark_morphology(tif_path=None, repeats=3, median_ks=9):
+    ''' open_spots time per morphology mode (see ZionImage.MORPHOLOGY_MODES), on the thresholded median filtered UV image,
+        and how many pixels of each mode's mask differ from 'exact'
+    '''
+    img = imread(tif_path) if tif_path is not None else make_synthetic_image()
+    img_gs = median_filter(rgb2gray(img) if img.ndim == 3 else img, median_ks, backend='rank')
+    img_bin = img_gs > img_gs.mean()
+    results = dict()
+    masks = dict()
+    for mode in MORPHOLOGY_MODES:
+        if mode == 'validate':
+            continue
+        results[mode] = time_it(lambda: open_spots(img_bin, mode=mode), repeats)
+        masks[mode] = open_spots(img_bin, mode=mode)
+    print_timing_table(results)
+    print(f"{'mode':<50}{'pixels differing from exact':>30}")
+    for mode, mask in masks.items():
+        print(f"{mode:<50}{np.count_nonzero(mask != masks['exact']):>30}")
+
+def benchmark_tiff_compression(jpg_path=None, repeats=3, codecs=(('none', None), ('deflate', 1), ('deflate', 6), ('deflate', 9), ('zstd', 1), ('zstd', 3), ('zstd', 9), ('lzw', None))):
+    ''' Table of file size vs encode/decode time for the raw tif codecs (see raw_converter.TIFF_COMPRESSIONS) '''
+    img = decode_raw_file(jpg_path) if jpg_path is not None else make_synthetic_image()
+    tmp_dir = tempfile.mkdtemp()
+    print(f"{'codec':<10}{'level':>6}{'size (MB)':>11}{'ratio':>8}{'encode (s)':>12}{'decode (s)':>12}")
+    results = dict()
+    for codec, level in codecs:
+        tif_path = os.path.join(tmp_dir, f"{codec}_{level}.tif")
+        try:
+            t_encode, _ = time_it(lambda: write_raw_tiff(tif_path, img, compression=codec, level=level), repeats)
+        except (ValueError, KeyError, ImportError) as e: # eg tifffile without imagecodecs can't encode zstd or lzw
+            print(f"{codec:<10}{str(level):>6}  not available: {e}")
+            continue
+        t_decode, _ = time_it(lambda: imread(tif_path), repeats)
+        if not np.array_equal(imread(tif_path), img):
+            raise ValueError(f"{codec} round trip is not lossless!")
+        size = os.path.getsize(tif_path)
+        results[(codec, level)] = (size, t_encode, t_decode)
+        print(f"{codec:<10}{str(level):>6}{size/2**20:>11.2f}{img.nbytes/size:>8.2f}{t_encode:>12.4f}{t_decode:>12.4f}")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Image processing benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    raw_parser = subparsers.add_parser("raw", help="raw conversion: convert_raw_c binary vs in-process decoding")
+    raw_parser.add_argument("jpg_path", nargs="?", default=None, help="jpeg+raw capture (synthetic if not given)")
+    raw_parser.add_argument("--repeats", type=int, default=5)
+    compression_parser = subparsers.add_parser("compression", help="raw tif size vs encode/decode time per codec")
+    compression_parser.add_argument("jpg_path", nargs="?", default=None, help="jpeg+raw capture (synthetic image if not given)")
+    compression_parser.add_argument("--repeats", type=int, default=3)
+    imageset_parser = subparsers.add_parser("imageset", help="ZionImage cycle loading time vs number of load threads")
+    imageset_parser.add_argument("--repeats", type=int, default=5)
+    registration_parser = subparsers.add_parser("registration", help="drift estimation time and error per registration mode and scale")
+    registration_parser.add_argument("--repeats", type=int, default=5)
+    median_parser = subparsers.add_parser("median", help="median filter time and ROI overlap with the 'disk' backend per median backend")
+    median_parser.add_argument("tif_path", nargs="?", default=None, help="UV image (synthetic if not given)")
+    median_parser.add_argument("--repeats", type=int, default=1)
+    median_parser.add_argument("--median_ks", type=int, default=9)
+    rois_parser = subparsers.add_parser("rois", help="spot segmentation time and ROI overlap, full resolution vs coarse to fine")
+    rois_parser.add_argument("tif_path", nargs="?", default=None, help="UV image (synthetic if not given)")
+    rois_parser.add_argument("--repeats", type=int, default=1)
+    morphology_parser = subparsers.add_parser("morphology", help="ROI morphology time and mask differences per morphology mode")
+    morphology_parser.add_argument("tif_path", nargs="?", default=None, help="UV image (synthetic if not given)")
+    morphology_parser.add_argument("--repeats", type=int, default=3)
+    subparsers.add_parser("check", help="regression check of the raw unpack backends on synthetic buffers")
+    args = parser.parse_args()
+
+    if args.benchmark == "raw":
+        benchmark_raw_conversion(args.jpg_path, repeats=args.repeats)
+    elif args.benchmark == "compression":
+        benchmark_tiff_compression(args.jpg_path, repeats=args.repeats)
+    elif args.benchmark == "imageset":
+        benchmark_imageset_loading(repeats=args.repeats)
+    elif args.benchmark == "registration":
+        benchmark_registration(repeats=args.repeats)
+    elif args.benchmark == "median":
+        benchmark_median_backends(args.tif_path, repeats=args.repeats, median_ks=args.median_ks)
+    elif args.benchmark == "rois":
+        benchmark_roi_detection(args.tif_path, repeats=args.repeats)
+    elif args.benchmark == "morphology":
+        benchmark_morphology(args.tif_path, repeats=args.repeats)
+    elif args.benchmark == "check":
+        check_unpack_backends()
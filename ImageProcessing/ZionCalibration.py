@@ -0,0 +1,99 @@
+import os
+import json
+import numpy as np
+
+from ImageProcessing.raw_converter import apply_calibration
+
+'''
+    This module defines ZionCalibration, a session's master dark (median of several dark frames) and optional flat field.
+    They're stored once in the processed images directory and applied while frames are decoded
+    (see raw_converter.decode_raw_buffer), as a saturating subtraction (and rounded, clamped gain), so the per-cycle
+    dark ('000') frames don't have to be read and subtracted again for every wavelength of every ZionImage.
+    first_cycle is the first cycle whose frames were all converted with the calibration applied.
+'''
+
+class ZionCalibration:
+
+    DARK_FILENAME = "master_dark.npy"
+    GAIN_FILENAME = "flat_field_gain.npy"
+    INFO_FILENAME = "calibration.json"
+
+    def __init__(self, master_dark, gain=None, first_cycle=None, nDarkFrames=None):
+        self.master_dark = np.ascontiguousarray(master_dark, dtype=np.uint16)
+        if gain is not None:
+            gain = np.ascontiguousarray(gain, dtype=np.float32)
+            if gain.shape != self.master_dark.shape:
+                raise ValueError(f"Flat field of shape {gain.shape} doesn't match the dark's {self.master_dark.shape}!")
+            if not np.all(np.isfinite(gain)) or np.any(gain < 0):
+                raise ValueError("Flat field gain has to be finite and positive!")
+        self.gain = gain
+        self.first_cycle = first_cycle
+        self.nDarkFrames = nDarkFrames
+
+    @property
+    def shape(self):
+        return self.master_dark.shape
+
+    @classmethod
+    def from_frames(cls, dark_frames, flat_frames=None):
+        ''' Master dark is the per-pixel median of the dark frames. The flat field is the mean of the dark subtracted
+            flat frames, normalized to 1 per color channel, and stored as its inverse (the gain to apply).
+        '''
+        dark_frames = list(dark_frames)
+        if not dark_frames:
+            raise ValueError("No dark frames to build the master dark from!")
+        master_dark = np.rint(np.median(np.stack(dark_frames), axis=0)).astype(np.uint16)
+        gain = None
+        if flat_frames is not None:
+            flat = np.zeros(master_dark.shape, dtype=np.float64)
+            nFlats = 0
+            for frame in flat_frames:
+                flat += np.maximum(frame.astype(np.float64) - master_dark, 0)
+                nFlats += 1
+            flat /= nFlats
+            flat /= flat.reshape(-1, flat.shape[-1]).mean(axis=0)
+            gain = (1 / np.maximum(flat, 1e-3)).astype(np.float32)
+        return cls(master_dark, gain, nDarkFrames=len(dark_frames))
+
+    def is_applied(self, cycle):
+        return self.first_cycle is not None and cycle is not None and cycle >= self.first_cycle
+
+    def apply(self, img, out=None):
+        ''' For frames that weren't calibrated while decoding '''
+        return apply_calibration(img, self.master_dark, self.gain, out=out)
+
+    def take(self, flat_indices):
+        ''' Dark and gain at some pixels (flat indices into an image's rows and columns), eg for ZionSpotIndex '''
+        dark = self.master_dark.reshape(-1, self.shape[-1])[flat_indices]
+        gain = self.gain.reshape(-1, self.shape[-1])[flat_indices] if self.gain is not None else None
+        return dark, gain
+
+    def crop(self, crop):
+        ''' Calibration of the frames decoded with a raw_converter.Crop, from a whole image one '''
+        return ZionCalibration(self.master_dark[crop.slices], self.gain[crop.slices] if self.gain is not None else None,
+                               first_cycle=self.first_cycle, nDarkFrames=self.nDarkFrames)
+
+    @staticmethod
+    def exists(dir_path):
+        return os.path.exists(os.path.join(dir_path, ZionCalibration.INFO_FILENAME))
+
+    @classmethod
+    def load(cls, dir_path):
+        with open(os.path.join(dir_path, cls.INFO_FILENAME)) as f:
+            info = json.load(f)
+        master_dark = np.load(os.path.join(dir_path, info["dark"]))
+        gain = np.load(os.path.join(dir_path, info["gain"])) if info.get("gain") else None
+        return cls(master_dark, gain, first_cycle=info.get("first_cycle"), nDarkFrames=info.get("nDarkFrames"))
+
+    def save(self, dir_path):
+        os.makedirs(dir_path, exist_ok=True)
+        np.save(os.path.join(dir_path, self.DARK_FILENAME), self.master_dark)
+        if self.gain is not None:
+            np.save(os.path.join(dir_path, self.GAIN_FILENAME), self.gain)
+        self.save_info(dir_path)
+
+    def save_info(self, dir_path):
+        info = {"dark": self.DARK_FILENAME, "gain": self.GAIN_FILENAME if self.gain is not None else None,
+                "shape": list(self.shape), "first_cycle": self.first_cycle, "nDarkFrames": self.nDarkFrames}
+        with open(os.path.join(dir_path, self.INFO_FILENAME), "w") as f:
+            json.dump(info, f)
@@ -70,6 +70,14 @@ df_cols2 = [ ("roi", False),
              ("time", False),
             ]
 
+def rgb_to_hsv(rgb):
+    ''' rgb2hsv, with signed or float (difference image) intensities scaled like uint16 ones. Hue and saturation
+        of negative differences don't mean much, but at least the values are on the same scale.
+    '''
+    if rgb.dtype.kind == 'u':
+        return rgb2hsv(rgb)
+    return rgb2hsv(rgb.astype(np.float64) / 65535)
+
 def extract_spot_data(img, roi_labels, csvFileName = None, kinetic=False):
     ''' takes in a ZionImage and a 2D image of spot labels. Optionally writes a csv file.
         Outputs a pandas dataframe containing all data for the cycle.
@@ -87,7 +95,7 @@ def extract_spot_data(img, roi_labels, csvFileName = None, kinetic=False):
             for w_ind, w in enumerate(img.wavelengths):
                 spot_data[df_cols[0]] = f"spot_{s_idx:03d}"
                 spot_data[df_cols[1]] = w
-                hsv_intensities = rgb2hsv(img[w][roi_labels==s_idx])
+                hsv_intensities = rgb_to_hsv(img[w][roi_labels==s_idx])
                 rgb_intensities = img[w][roi_labels==s_idx]
                 spot_data[df_cols[2]], spot_data[df_cols[3]], spot_data[df_cols[4]] = np.mean(rgb_intensities, axis=0).tolist()
                 spot_data[df_cols[5]], spot_data[df_cols[6]], spot_data[df_cols[7]] = np.median(rgb_intensities, axis=0).tolist()
@@ -110,26 +118,30 @@ def extract_spot_data(img, roi_labels, csvFileName = None, kinetic=False):
                         # ~ print(f"Appending to {csvFileName}:\n{lineToWrite}")
                 df_total = pd.concat([df_total, pd.DataFrame(spot_data, index=[pd_idx])], axis=0)
                 pd_idx += 1
+    df_total = spot_rows_to_dataframe(df_total, img.wavelengths)
+
+    #TODO now write to csv, not earlier?
+
+    return df_total
+
+def spot_rows_to_dataframe(df_total, wavelengths):
+    ''' Reshapes a dataframe of one row per spot and wavelength (with df_cols columns) to one row per spot '''
     df_total.set_index(["roi", "time", "cycle", "wavelength"], inplace=True)
     df_total = df_total.unstack()
 
     w_idx = []
-    for w in img.wavelengths:
+    for w in wavelengths:
         w_idx += 3*[w]
     ch_idx = []
     # TODO: dependent on df_cols def above, but this could be accessed once move to df_cols2 above
     for c in [2,5,8,11,14,17,20,23]:
-        ch_idx += len(img.wavelengths) * df_cols[c:(c+3)]
+        ch_idx += len(wavelengths) * df_cols[c:(c+3)]
     try:
         mi = pd.MultiIndex.from_arrays([ch_idx, int(len(ch_idx)/len(w_idx))*w_idx])
     except ValueError as e:
         print(f"ch_idx = {ch_idx}, w_idx = {w_idx}")
         raise e
-    df_total = df_total.reindex(columns=mi)
-    
-    #TODO now write to csv, not earlier?
-
-    return df_total
+    return df_total.reindex(columns=mi)
 
 def csv_to_data(csvfile):
     df_total = pd.read_csv(csvfile)
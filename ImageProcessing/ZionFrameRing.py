@@ -0,0 +1,61 @@
+import queue
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+
+'''
+    This module defines a ring of preallocated shared memory frame slots, used to hand captured jpeg+raw buffers
+    from the capture loop to the image saving thread and then to the image processor's converter (in another process)
+    by slot index, instead of copying/pickling every ~18 MB frame through queues and re-reading it from disk.
+'''
+
+@dataclass
+class ZionFrameSlot:
+    index: int
+    size: int
+
+class ZionFrameRing:
+
+    SLOT_SIZE = 32*1024*1024 # jpeg + 18.7 MB of raw bayer data
+
+    def __init__(self, manager, nSlots=6, slotSize=SLOT_SIZE):
+        self.nSlots = nSlots
+        self.slotSize = slotSize
+        self._shm = shared_memory.SharedMemory(create=True, size=nSlots*slotSize)
+        self.name = self._shm.name
+        # free slot indices, shared across processes through the manager
+        self._free_slots = manager.Queue()
+        for slot in range(nSlots):
+            self._free_slots.put(slot)
+
+    def put(self, data):
+        ''' Copies data into a free slot and returns its ZionFrameSlot.
+            Returns None (and the caller should fall back to copying) if the frame doesn't fit or no slot is free,
+            so the capture loop never blocks on a slow consumer.
+        '''
+        with memoryview(data) as data_view, data_view.cast('B') as data_bytes:
+            size = data_bytes.nbytes
+            if size > self.slotSize:
+                print(f"Frame of {size} bytes doesn't fit in a {self.slotSize} byte slot!")
+                return None
+            try:
+                slot = self._free_slots.get_nowait()
+            except queue.Empty:
+                print("No free frame slots!")
+                return None
+            start = slot*self.slotSize
+            self._shm.buf[start:start+size] = data_bytes
+        return ZionFrameSlot(slot, size)
+
+    def view(self, frame_slot : ZionFrameSlot):
+        ''' memoryview of the frame data in a slot (no copy), only valid until the slot is released '''
+        start = frame_slot.index*self.slotSize
+        return self._shm.buf[start:start+frame_slot.size]
+
+    def release(self, frame_slot : ZionFrameSlot):
+        ''' Called by the last consumer of a slot to hand it back to the capture loop '''
+        self._free_slots.put(frame_slot.index)
+
+    def close(self, unlink=True):
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
@@ -1,15 +1,24 @@
 import os
+import threading
+import warnings
 from collections import UserDict
-from subprocess import call, check_call, check_output, run
+from concurrent.futures import ThreadPoolExecutor, Future
 from glob import glob
 import numpy as np
 import pandas as pd
 import cv2
+from scipy import ndimage
 from skimage import filters, morphology, segmentation, measure
-from tifffile import imread
+from skimage.filters import rank
+from tifffile import imread, TiffFile
 
 from ImageProcessing.ZionBaseCaller import crosstalk_correct, display_signals, base_call, add_basecall_result_to_dataframe
 from ImageProcessing.ZionData import extract_spot_data, csv_to_data, df_cols
+from ImageProcessing.raw_converter import Crop, decode_raw_buffer, decode_raw_file, write_raw_tiff
+from ImageProcessing.ZionRawStore import ZionRawStore
+from ImageProcessing.ZionImageCache import image_cache
+from ImageProcessing.ZionSessionIndex import get_session_index
+from ImageProcessing.ZionRois import ZionRois, get_image_hash
 
 '''
     This module primarily the ZionImage class, which contains an imageset for a given snapshot/cycle. Contains image data from all excitation channels.
@@ -17,15 +26,18 @@ from ImageProcessing.ZionData import extract_spot_data, csv_to_data, df_cols
 '''
 
 # First, some low-level image file handling functions:
-def jpg_to_raw(filepath, target_path):
-    # This runs the C raw converter, which must be in the following location
-    ret = run(["./raw_convert_c/convert_raw_c", filepath, target_path])
-    # ~ ret = check_output(["./raw_convert_c/convert_raw_c", filepath, target_path])
-    retcode = ret.returncode
-    if retcode == 0:
-        return ret.returncode
-    else:
-        raise OSError(f"raw converter failed on image {filepath} with error {retcode}")
+def jpg_to_raw(filepath, target_path, buffer=None, compression=None, level=None, mode='rgb', calibration=None, crop=None):
+    # compression is a codec name of raw_converter.TIFF_COMPRESSIONS (None is uncompressed), level is codec-specific
+    # mode is one of raw_converter.DECODE_MODES
+    # calibration is a ZionCalibration to apply while decoding
+    # crop is a raw_converter.Crop to decode (and write) just part of the image
+    # Decodes in-process (optionally straight from the captured buffer), with the raw converter library if it's built,
+    # otherwise with numba/numpy (see raw_converter.decode_raw_buffer). The convert_raw_c binary isn't forked any more,
+    # a stale build of it would use the fixed raw offset and none of the above options.
+    dark, gain = (calibration.master_dark, calibration.gain) if calibration is not None else (None, None)
+    img = decode_raw_buffer(buffer, mode=mode, dark=dark, gain=gain, crop=crop) if buffer is not None else decode_raw_file(filepath, mode=mode, dark=dark, gain=gain, crop=crop)
+    write_raw_tiff(target_path, img, compression=compression, level=level)
+    return 0
 
 def get_wavelength_from_filename(filepath):
     fp_splt = filepath.split('_')
@@ -42,40 +54,278 @@ def get_cycle_from_filename(filepath):
 def get_time_from_filename(filepath):
     return int( os.path.splitext(filepath)[0].split('_')[-1] )
 
+def read_raw_image(imagefile, store=None):
+    # Frames in a ZionRawStore are looked up by name and returned as views, otherwise imagefile is a tif
+    # read through the process-wide image cache (so the returned array is read-only)
+    if store is not None:
+        return store[imagefile]
+    return image_cache.get(imagefile)
+
+def read_raw_image_info(imagefile, store=None):
+    # (shape, dtype) of a frame without reading its data
+    if store is not None:
+        return store.frame_shape, store.dtype
+    with TiffFile(imagefile) as tif:
+        series = tif.series[0]
+        return tuple(series.shape), series.dtype
+
+# ZionImages read their channels with a thread pool shared by the process (tif decoding and the subtractions release
+# the GIL), created on first use. A forked child (eg the image processor) inherits the pool but not its threads, so
+# anything submitted to it would never run: _reset_load_pool drops it (and a lock a parent thread may have held) in the
+# child, which then creates its own.
+_load_pool = None
+_nLoadThreads = min(4, os.cpu_count() or 1)
+_load_pool_lock = threading.Lock()
+
+def _reset_load_pool():
+    global _load_pool, _load_pool_lock
+    _load_pool = None
+    _load_pool_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_load_pool)
+
+def set_load_threads(nThreads):
+    # 1 loads serially in the calling thread
+    global _load_pool, _nLoadThreads
+    with _load_pool_lock:
+        if _load_pool is not None:
+            _load_pool.shutdown(wait=False)
+            _load_pool = None
+        _nLoadThreads = max(1, int(nThreads))
+
+def get_load_pool():
+    global _load_pool
+    with _load_pool_lock:
+        if _load_pool is None and _nLoadThreads > 1:
+            _load_pool = ThreadPoolExecutor(max_workers=_nLoadThreads, thread_name_prefix="ZionImageLoad")
+        return _load_pool
+
 # Now some image processing tools or shortcuts that are useful OUTSIDE of a "ZionImage":
 
+# dtypes difference (and dark subtracted) images can be kept in, None keeps the images' (unsigned) dtype
+DIFF_DTYPES = (None, 'int32', 'float32')
+
+def subtract_image(image, subtrahend, out, clamp=None):
+    ''' image - subtrahend, computed into out without wrapping around: saturating at 0 if out is unsigned, otherwise
+        signed (or float). clamp=(low, high) clips the difference (either can be None), eg (0, None) drops negative noise.
+    '''
+    if out.dtype.kind == 'u':
+        cv2.subtract(image, subtrahend, dst=out)
+    else:
+        # inputs are cast element by element, no temporaries
+        np.subtract(image, subtrahend, out=out, dtype=out.dtype)
+    if clamp is not None:
+        np.clip(out, clamp[0], clamp[1], out=out)
+    return out
+
+def estimate_background(img, radius=64, scale=8):
+    ''' Smooth per-channel background of an (H, W[, C]) image, as float32 at 1/scale resolution: the image is area
+        downsampled, morphologically opened with a disk of radius (full resolution) pixels, which has to be larger than
+        the spots, and blurred to round off the opening's plateaus. upsample_background brings it back to full size.
+    '''
+    h, w = img.shape[:2]
+    small = cv2.resize(img.astype(np.float32, copy=False), (max(1, w//scale), max(1, h//scale)), interpolation=cv2.INTER_AREA)
+    r = max(1, round(radius/scale))
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2*r+1, 2*r+1))
+    background = cv2.morphologyEx(small, cv2.MORPH_OPEN, kernel, borderType=cv2.BORDER_REPLICATE)
+    return cv2.blur(background, (2*r+1, 2*r+1), borderType=cv2.BORDER_REPLICATE)
+
+def upsample_background(background, dims, dtype):
+    ''' Full resolution (dims is (H, W)) background in dtype, ready to subtract '''
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'u':
+        background = np.clip(np.rint(background), 0, np.iinfo(dtype).max).astype(dtype)
+    elif dtype == np.float32:
+        pass
+    else: # cv2 can't resize int32
+        return np.rint(cv2.resize(background, dims[::-1], interpolation=cv2.INTER_LINEAR)).astype(dtype)
+    return cv2.resize(background, dims[::-1], interpolation=cv2.INTER_LINEAR)
+
 def rgb2gray(img, weights=None):
-    return np.average(img, axis=-1, weights=weights).round().astype('uint16')
+    # clipped, so negative values of signed (eg dark subtracted int32) images don't wrap around
+    return np.clip(np.average(img, axis=-1, weights=weights).round(), 0, 65535).astype('uint16')
+
+# Median filter implementations for 16-bit grayscale images (kernel_size is the radius of the footprint):
+#   'disk'        skimage.filters.median with a disk footprint, the reference (and slowest)
+#   'rank'        skimage's histogram based rank median with the same disk, on the top 12 bits (ie the sensor's bits),
+#                 so it differs from 'disk' by less than 16 (and near the borders, which it doesn't pad)
+#   'separable'   median of the rows, then of the columns, of a square footprint (an approximation, ~5x faster than 'disk')
+#   'square'      scipy.ndimage with a (2*kernel_size+1) square footprint
+#   'downsample'  'disk' on the image area-downsampled by scale, upsampled again, eg for spot finding where detail doesn't matter
+#   'cv2'         opencv's constant time medianBlur on a square footprint, of the image scaled to 8 bits between its min and max
+# (raspberry pi opencv by default doesn't deal with 16 bit images, hence 'cv2' has to go through 8 bits)
+# See ZionBenchmarks median for their speed and how much the ROIs found with them overlap those of 'disk'
+MEDIAN_BACKENDS = ('disk', 'rank', 'separable', 'square', 'downsample', 'cv2')
 
-# TODO rebase to opencv to preserve 16bit images (port to C for speed?)
-# (raspberry pi opencv by default doesn't deal with 16 bit images)
-def median_filter(in_img, kernel_size, behavior='ndimage'): #rank?
+def _median_filter_2d(img, kernel_size, backend, behavior, scale):
+    if backend == 'disk':
+        return filters.median(img, morphology.disk(kernel_size), behavior=behavior)
+    elif backend == 'rank':
+        # skimage warns about the 4096 bins of 12-bit images with every call, fewer bits would lose the sensor's precision
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message="Bad rank filter performance", category=UserWarning)
+            return rank.median(img >> 4, morphology.disk(kernel_size)) << 4
+    elif backend == 'separable':
+        return ndimage.median_filter(ndimage.median_filter(img, size=(1, 2*kernel_size+1)), size=(2*kernel_size+1, 1))
+    elif backend == 'square':
+        return ndimage.median_filter(img, size=2*kernel_size+1)
+    elif backend == 'downsample':
+        h, w = img.shape
+        small = cv2.resize(img, (max(1, w//scale), max(1, h//scale)), interpolation=cv2.INTER_AREA)
+        small = filters.median(small, morphology.disk(max(1, round(kernel_size/scale))), behavior=behavior)
+        return cv2.resize(small, (w, h), interpolation=cv2.INTER_LINEAR)
+    elif backend == 'cv2':
+        low, high = int(img.min()), int(img.max())
+        step = max(1, -(-(high - low) // 255))
+        img8 = ((img - low) // step).astype(np.uint8)
+        return cv2.medianBlur(img8, 2*kernel_size+1).astype(img.dtype) * step + low
+    raise ValueError(f"Invalid median backend {backend}, options are {MEDIAN_BACKENDS}")
+
+def median_filter(in_img, kernel_size, behavior='ndimage', backend='disk', scale=4):
     #TODO make for whole imageset (aka ZionImage)?
+    # behavior is skimage.filters.median's, for the 'disk' and 'downsample' backends
+    if in_img.dtype != np.uint16 and backend in ('rank', 'cv2'):
+        raise ValueError(f"The {backend} median backend needs uint16 images!")
     if len(in_img.shape) == 2: # grayscale
-        out_img = filters.median(in_img, morphology.disk(kernel_size), behavior=behavior)
+        out_img = _median_filter_2d(in_img, kernel_size, backend, behavior, scale)
     elif len(in_img.shape) == 3: # multi-channel
-        if behavior == 'cv2':
-            # see above TODO
-            raise ValueError("Invalid behavior option!")
-        else:
-            for ch in range(in_img.shape[-1]):
-                out_img[:,:,ch] = filters.median(in_img[:,:,ch], morphology.disk(kernel_size), behavior=behavior)
+        out_img = np.empty_like(in_img)
+        for ch in range(in_img.shape[-1]):
+            out_img[:,:,ch] = _median_filter_2d(in_img[:,:,ch], kernel_size, backend, behavior, scale)
     return out_img
 
+# Binary erosion/dilation with disk footprints of ROI detection (see open_spots):
+#   'exact'       skimage binary_erosion/binary_dilation with morphology.disk, the reference
+#   'edt'         thresholding the euclidean distance transform (cv2's exact one), identical to 'exact' and about as fast for any radius
+#   'decomposed'  skimage's disks decomposed into a sequence of small footprints, an approximation of 'exact'
+#   'validate'    'edt', diffed against 'exact' (whose mask is returned), to check on real images
+MORPHOLOGY_MODES = ('exact', 'edt', 'decomposed', 'validate')
+
+def _squared_distances(img_bin):
+    ''' Squared distance of every pixel to the nearest False pixel, the image being surrounded by True ones '''
+    return np.rint(np.square(cv2.distanceTransform(np.ascontiguousarray(img_bin).view(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE), dtype=np.float64))
+
+def binary_erosion(img_bin, radius, mode='edt'):
+    if mode == 'edt':
+        # a pixel stays if every pixel of the disk around it is set, ie the nearest unset pixel is further than radius
+        return _squared_distances(img_bin) > radius*radius
+    elif mode == 'decomposed':
+        return morphology.binary_erosion(img_bin, morphology.disk(radius, decomposition='sequence'))
+    return morphology.binary_erosion(img_bin, morphology.disk(radius))
+
+def binary_dilation(img_bin, radius, mode='edt'):
+    if mode == 'edt':
+        if not img_bin.any():
+            return img_bin.copy()
+        return _squared_distances(~img_bin) <= radius*radius
+    elif mode == 'decomposed':
+        return morphology.binary_dilation(img_bin, morphology.disk(radius, decomposition='sequence'))
+    return morphology.binary_dilation(img_bin, morphology.disk(radius))
+
+def open_spots(img_bin, erode_ks=16, dilate_ks=13, shrink_ks=4, mode='edt'):
+    ''' Spot mask with the specks (and thin bridges between spots) of a thresholded image eroded away '''
+    if mode not in MORPHOLOGY_MODES:
+        raise ValueError(f"Invalid morphology mode {mode}, options are {MORPHOLOGY_MODES}")
+    if mode == 'validate':
+        fast = open_spots(img_bin, erode_ks, dilate_ks, shrink_ks, mode='edt')
+        exact = open_spots(img_bin, erode_ks, dilate_ks, shrink_ks, mode='exact')
+        nDiff = np.count_nonzero(fast != exact)
+        print(f"Morphology validation: {nDiff} of {exact.size} pixels differ between edt and exact ({np.count_nonzero(exact)} set)")
+        return exact
+    img_bin = binary_erosion(img_bin, erode_ks, mode)
+    img_bin = binary_dilation(img_bin, dilate_ks, mode)
+    return binary_erosion(img_bin, shrink_ks, mode)
+
+def segment_spots(img_gs, median_ks=9, erode_ks=16, dilate_ks=13, threshold_scale=1, median_backend='disk', median_scale=4, morphology_mode='edt'):
+    ''' Spot candidate labels (and their number) of a grayscale UV image: median filtered, thresholded at its mean and opened up '''
+    img_gs = median_filter(img_gs, median_ks, backend=median_backend, scale=median_scale)
+    thresh = threshold_scale * filters.threshold_mean(img_gs)
+    #TODO: adjust threshold? eg make it based on stats?
+    img_bin = open_spots(img_gs > thresh, erode_ks, dilate_ks, mode=morphology_mode)
+    return measure.label(img_bin, return_num=True)
+
+def segment_spots_multiscale(img_gs, median_ks=9, erode_ks=16, dilate_ks=13, threshold_scale=1, median_backend='disk', scale=4, morphology_mode='edt'):
+    ''' Coarse to fine segment_spots: spot candidates are found on the image area-downsampled by scale (with kernels scaled down too),
+        then each one's mask is made again at full resolution within its bounding box, padded by how far the filters reach.
+        Masks match segment_spots' away from where spots touch (and the threshold is the mean of the downsampled image);
+        a full resolution spot is kept if it overlaps a candidate, and labels are in raster order like measure.label's.
+    '''
+    h, w = img_gs.shape
+    small = cv2.resize(img_gs[:h//scale*scale, :w//scale*scale], (w//scale, h//scale), interpolation=cv2.INTER_AREA)
+    small = median_filter(small, max(1, round(median_ks/scale)), backend=median_backend)
+    thresh = threshold_scale * filters.threshold_mean(small)
+    coarse_labels = measure.label(open_spots(small > thresh, max(1, round(erode_ks/scale)), max(1, round(dilate_ks/scale)), max(1, round(4/scale)), mode=morphology_mode))
+
+    pad = median_ks + erode_ks + dilate_ks + 4 + scale
+    spot_labels = np.zeros((h, w), dtype=np.int32)
+    nSpots = 0
+    for label, box in enumerate(ndimage.find_objects(coarse_labels), start=1):
+        if box is None:
+            continue
+        y0, x0 = max(box[0].start*scale - pad, 0), max(box[1].start*scale - pad, 0)
+        y1, x1 = min(box[0].stop*scale + pad, h), min(box[1].stop*scale + pad, w)
+        fine_bin = open_spots(median_filter(img_gs[y0:y1, x0:x1], median_ks, backend=median_backend) > thresh, erode_ks, dilate_ks, mode=morphology_mode)
+        fine_labels = measure.label(fine_bin)
+        # candidate's mask in the box's full resolution pixels
+        candidate = np.zeros(fine_bin.shape, dtype=bool)
+        cand = np.kron(coarse_labels[box] == label, np.ones((scale, scale), dtype=bool))
+        cy, cx = box[0].start*scale - y0, box[1].start*scale - x0
+        candidate[cy:cy+cand.shape[0], cx:cx+cand.shape[1]] = cand[:fine_bin.shape[0]-cy, :fine_bin.shape[1]-cx]
+        out = spot_labels[y0:y1, x0:x1]
+        for fine_label in np.unique(fine_labels[candidate & fine_bin]):
+            spot = fine_labels == fine_label
+            if out[spot].any(): # already labeled from a neighbouring candidate's box
+                continue
+            nSpots += 1
+            out[spot] = nSpots
+
+    # raster order, by each spot's first pixel
+    flat = spot_labels.ravel()
+    nz = np.flatnonzero(flat)
+    labels, first = np.unique(flat[nz], return_index=True)
+    lut = np.zeros(nSpots + 1, dtype=np.int32)
+    lut[labels[np.argsort(first)]] = np.arange(1, labels.size + 1, dtype=np.int32)
+    return lut[spot_labels], labels.size
+
+def filter_spot_labels(spot_labels, minSize=None, maxSize=None, bCompact=False):
+    ''' Removes spots with fewer than minSize or more than maxSize pixels (either can be None) from a label image.
+        Sizes come from one bincount of the labels, and removed spots are zeroed with one lookup table pass over the image.
+        With bCompact the remaining spots are renumbered 1..nSpots (in label order), otherwise they keep their labels.
+        Returns the new labels and the number of spots.
+    '''
+    sizes = np.bincount(spot_labels.ravel())
+    keep = sizes > 0
+    keep[0] = False
+    nCandidates = np.count_nonzero(keep)
+    if maxSize is not None:
+        too_large = keep & (sizes > maxSize)
+        if too_large.any():
+            print(f"removing {np.count_nonzero(too_large)} spots with area > {maxSize} -- too large")
+        keep &= ~too_large
+    if minSize is not None:
+        too_small = keep & (sizes < minSize)
+        if too_small.any():
+            print(f"removing {np.count_nonzero(too_small)} spots with area < {minSize} -- too small")
+        keep &= ~too_small
+    nSpots = int(np.count_nonzero(keep))
+    bGaps = nSpots != sizes.size - 1
+    if nSpots == nCandidates and not (bCompact and bGaps):
+        return spot_labels, nSpots
+    lut = np.zeros(sizes.size, dtype=spot_labels.dtype)
+    lut[keep] = np.arange(1, nSpots+1) if bCompact else np.flatnonzero(keep)
+    return lut[spot_labels], nSpots
+
 def create_labeled_rois(labels, filepath=None, color=[1,0,1], img=None, font=cv2.FONT_HERSHEY_SIMPLEX, notebook=False):
     img = np.zeros_like(labels) if img is None else img
     h,w = labels.shape
     out_img = segmentation.mark_boundaries(img, labels, color=color, outline_color=color, mode='thick')
     out_img = (255*out_img).astype('uint8')
-    rp = measure.regionprops(labels)
-    s_idx = 0
-    for s in range(1, np.max(labels)+1):
-        if labels[labels==s].size > 0:
-            centroid = rp[s_idx]['centroid']
-            s_idx += 1
-            text = str(s)
-            text_size = cv2.getTextSize(text, font,1,2)[0]
-            cv2.putText(out_img, str(s), (int(centroid[1]-text_size[0]/2), int(centroid[0]+text_size[1]/2)), font, 1, (255, 0, 255), 2)
+    # regionprops only has the labels that are there (sorted), so removed spots don't cost anything
+    for p in measure.regionprops(labels):
+        s, centroid = p.label, p.centroid
+        text = str(s)
+        text_size = cv2.getTextSize(text, font,1,2)[0]
+        cv2.putText(out_img, str(s), (int(centroid[1]-text_size[0]/2), int(centroid[0]+text_size[1]/2)), font, 1, (255, 0, 255), 2)
     if filepath is not None:
         cv2.imwrite(filepath+".jpg", out_img)
     return out_img
@@ -84,156 +334,322 @@ class ZionImage(UserDict):
     '''
     This class is designed to hold a multichannel RGB imageset for a given timepoint (or cycle)
     eg one RGB per excitation channel (000, 445, 525, 590, 645, 365)
+    If a ZionRawStore is given, lstImageFiles (and subtrahends) are frame names in that store instead of tif files.
+    If the frames were dark corrected while decoding (see ZionCalibration), the dark ('000') image isn't subtracted again.
+    Images are only read on first access, into one contiguous (channels, H, W, 3) buffer (wavelengths in sorted order,
+    no dark channel), and img[wavelength] is a view into it. view_4D is the buffer itself, view_3D and view_8bit are made
+    once and cached, so call invalidate_views() after changing the images in place (assigning img[wavelength] does it).
+    Dark and difference subtraction never wrap around (see subtract_image): with diffDtype None the images stay unsigned
+    and saturate at 0, with 'int32' or 'float32' they keep negative differences, optionally clipped to diffClamp.
+    out is a buffer to load into if it has the right shape and dtype, eg the view_4D of the previous cycle's ZionImage
+    once that isn't used anymore, so loading a cycle doesn't allocate.
+    With bgSubtract, a smooth background (see estimate_background, bgRadius should be larger than the spots) is
+    estimated per channel after the dark/difference subtraction and subtracted too (also subject to diffDtype/diffClamp).
+    The low resolution backgrounds are kept in backgrounds[wavelength].
+    crop is the raw_converter.Crop the images are in (eg frames decoded with it), whole frames are cropped to it as they're read.
+    Either way the ZionImage only holds the crop, and pixel coordinates (eg of detect_rois) are relative to it.
     '''
-    def __init__(self, lstImageFiles, lstWavelengths, cycle=None, subtrahends=None, bgIntensity=None):
+    def __init__(self, lstImageFiles, lstWavelengths, cycle=None, subtrahends=None, bgIntensity=None, store=None, bDarkCorrected=False, diffDtype=None, diffClamp=None, out=None,
+                 bgSubtract=False, bgRadius=64, bgScale=8, crop=None):
+        if diffDtype not in DIFF_DTYPES:
+            raise ValueError(f"Invalid difference image dtype {diffDtype}, options are {DIFF_DTYPES}")
 
-        d = dict()
-        wl_subs = [get_wavelength_from_filename(fp) for fp in subtrahends] if subtrahends is not None else []
+        self._lstImageFiles = list(lstImageFiles)
+        self._lstWavelengths = list(lstWavelengths)
+        self._subtrahends = subtrahends
+        self._store = store
+        self._bDarkCorrected = bDarkCorrected
+        self._diffDtype = diffDtype
+        self._diffClamp = diffClamp
+        self._out = out
+        self._bgSubtract = bgSubtract
+        self._bgRadius = bgRadius
+        self._bgScale = bgScale
+        self.crop = crop
+        self.rois = None # ZionRois of detect_rois
+        self.backgrounds = dict()
+        self._buffer = None
+        self._data = None
+        self._view_3D = None
+        self._view_8bit = None
 
         self.times = []
         self.filenames = dict()
         for wavelength, imagefile in zip(lstWavelengths, lstImageFiles):
-            #TODO check validity (uint16, RGB, consistent sizes)
-            image = imread(imagefile)
             self.filenames[wavelength] = imagefile
-
-            if subtrahends is not None:
-                if wavelength == '000':  #skip dark images
-                    continue
-                elif wavelength in wl_subs:
-                    d[wavelength] = image - imread(subtrahends[wl_subs.index(wavelength)])
-                    self.times.append( get_time_from_filename(imagefile) )
-                    # ~ print(f"adding {imagefile} - {subtrahends[wl_subs.index(wavelength)]}")
-                    # ~ print(f"image shape: {image.shape}")
-                else:
-                    d[wavelength] = image
-                    self.times.append( get_time_from_filename(imagefile) )
-                    # ~ print(f"adding {imagefile}")
-                    # ~ print(f"image shape: {image.shape}")
-            else: #not using difference image
-                if wavelength == '000':
-                    continue
-                if '000' in lstWavelengths:
-                    d[wavelength] = image - imread(lstImageFiles[lstWavelengths.index('000')])
-                    self.times.append( get_time_from_filename(imagefile) )
-                    # ~ print(f"adding {imagefile} - {lstImageFiles[lstWavelengths.index('000')]}")
-                    # ~ print(f"image shape: {image.shape}")
-                else:
-                    d[wavelength] = image
-                    self.times.append( get_time_from_filename(imagefile) )
-                    # ~ print(f"adding {imagefile}")
-                    # ~ print(f"image shape: {image.shape}")
-
-        super().__init__(d)
-        #TODO check that all images are same dtype, shape, and dimensionality
-        self.dtype = image.dtype
-        self.dims = image.shape[:2]
+            if wavelength == '000':  #skip dark images
+                continue
+            self.times.append( get_time_from_filename(imagefile) )
+        # wavelengths in the given order (eg for spot data columns), the buffer's channels are sorted
+        self._wavelengths = [wl for wl in lstWavelengths if wl != '000']
+        self._channel_idx = {wl : ch_idx for ch_idx, wl in enumerate(sorted(self._wavelengths))}
+        # including the dark channel, if any
         self.nChannels = len(lstWavelengths)
         self.cycle = cycle
         self.time_avg = round(sum(self.times)/len(self.times))
 
+    def _get_buffer_info(self):
+        ''' (shape, dtype) of the buffer, from the first image's without reading it '''
+        shape, dtype = read_raw_image_info(self.filenames[self._wavelengths[0]], self._store)
+        if self.crop is not None:
+            shape = (self.crop.h, self.crop.w) + tuple(shape[2:])
+        return (len(self._wavelengths),)+tuple(shape), np.dtype(self._diffDtype if self._diffDtype is not None else dtype)
+
+    @property
+    def nbytes(self):
+        ''' Size of the images, whether they're loaded yet or not '''
+        if self._buffer is not None:
+            return self._buffer.nbytes
+        shape, dtype = self._get_buffer_info()
+        return int(np.prod(shape)) * dtype.itemsize
+
+    def _load(self):
+        if self._buffer is not None:
+            return
+        store = self._store
+        subtrahends = self._subtrahends
+        wl_subs = [get_wavelength_from_filename(fp) for fp in subtrahends] if subtrahends is not None else []
+
+        shape, dtype = self._get_buffer_info()
+        if self._out is not None and self._out.shape == shape and self._out.dtype == dtype and self._out.flags.c_contiguous:
+            buffer = self._out
+        else:
+            buffer = np.empty(shape, dtype=dtype)
+        self._out = None
+        pool = get_load_pool()
+
+        # without difference images, the dark image is read once and subtracted from every wavelength
+        # (submitted first, so it's already being read by the time any channel waits for it)
+        dark = None
+        if subtrahends is None and not self._bDarkCorrected and '000' in self._lstWavelengths:
+            darkfile = self._lstImageFiles[self._lstWavelengths.index('000')]
+            if pool is not None:
+                dark = pool.submit(self._read, darkfile)
+            else:
+                dark = Future()
+                dark.set_result(self._read(darkfile))
+
+        # one task per channel, reading and subtracting straight into its slot of the buffer
+        args = [(wavelength, buffer[self._channel_idx[wavelength]], dark, wl_subs) for wavelength in self._wavelengths]
+        if pool is not None:
+            for task in [pool.submit(self._load_channel, *a) for a in args]:
+                task.result()
+        else:
+            for a in args:
+                self._load_channel(*a)
+
+        self._buffer = buffer
+        self._data = {wl : buffer[self._channel_idx[wl]] for wl in self._wavelengths}
+        # the images are copied, the frames don't have to be held on to
+        self._store = None
+
+    def _read(self, imagefile):
+        image = read_raw_image(imagefile, self._store)
+        # a whole frame, rather than one decoded with the crop
+        if self.crop is not None and image.shape[:2] != (self.crop.h, self.crop.w):
+            image = image[self.crop.slices]
+        return image
+
+    def _load_channel(self, wavelength, slot, dark, wl_subs):
+        imagefile = self.filenames[wavelength]
+        image = self._read(imagefile)
+        #TODO check validity (uint16, RGB)
+        if image.shape != slot.shape:
+            raise ValueError(f"{imagefile} has shape {image.shape}, other images of the set {slot.shape}!")
+
+        if self._subtrahends is not None and wavelength in wl_subs:
+            subtract_image(image, self._read(self._subtrahends[wl_subs.index(wavelength)]), slot, clamp=self._diffClamp)
+            # ~ print(f"adding {imagefile} - {subtrahends[wl_subs.index(wavelength)]}")
+        elif dark is not None:
+            subtract_image(image, dark.result(), slot, clamp=self._diffClamp)
+            # ~ print(f"adding {imagefile} - {lstImageFiles[lstWavelengths.index('000')]}")
+        else:
+            slot[...] = image
+            # ~ print(f"adding {imagefile}")
+
+        if self._bgSubtract:
+            background = estimate_background(slot, radius=self._bgRadius, scale=self._bgScale)
+            self.backgrounds[wavelength] = background
+            subtract_image(slot, upsample_background(background, slot.shape[:2], slot.dtype), slot, clamp=self._diffClamp)
+
+    def __getstate__(self):
+        # eg put on a multiprocessing queue, send the images rather than the (unpicklable) store
+        self._load()
+        state = self.__dict__.copy()
+        state["_view_3D"] = None
+        state["_view_8bit"] = None
+        state["_out"] = None
+        return state
+
+    @property
+    def data(self):
+        self._load()
+        return self._data
+
+    def __setitem__(self, wavelength, image):
+        self.data[wavelength][...] = image
+        self.invalidate_views()
+
+    def __delitem__(self, wavelength):
+        raise TypeError("Can't remove images from a ZionImage!")
+
+    # these don't need the images
+    def __contains__(self, wavelength):
+        return wavelength in self._channel_idx
+
+    def __iter__(self):
+        return iter(self._wavelengths)
+
+    def __len__(self):
+        return len(self._wavelengths)
+
+    def invalidate_views(self):
+        self._view_3D = None
+        self._view_8bit = None
+
+    @property
+    def dtype(self):
+        return self.view_4D.dtype
+
+    @property
+    def dims(self):
+        return self.view_4D.shape[1:3]
+
     def get_mean_spot_vector(self, indices):
         out = []
-        for k in self.data.keys():
+        for k in self.wavelengths:
             out.extend( np.mean(self.data[k][indices], axis=0).tolist() )
         return out
 
     @property
     def wavelengths(self):
-        wls = self.data.keys()
-        # should be no dark key in here, but just in case
-        if '000' in wls:
-            wls.remove('000')
-        return wls
+        # no dark key in here
+        return list(self._wavelengths)
 
     @property
     def view_4D(self):
-        out_arr = np.zeros(shape=(self.nChannels,)+self.dims+(3,), dtype=self.dtype)
-        for ch_idx, wl in enumerate(sorted(self.data.keys())):
-            out_arr[ch_idx,:,:,:] = self.data[wl]
-        return out_arr
+        self._load()
+        return self._buffer
 
     @property
     def view_3D(self):
-        out_arr = np.zeros(shape=self.dims+(3*self.nChannels,), dtype=self.dtype)
-        for ch_idx, wl in enumerate(sorted(self.data.keys())):
-            out_arr[:,:,(3*ch_idx):(3*(ch_idx+1))] = self.data[wl]
-        return out_arr
+        if self._view_3D is None:
+            # channels next to each other, (H, W, 3*channels)
+            buffer = self.view_4D
+            self._view_3D = np.ascontiguousarray(buffer.transpose(1, 2, 0, 3)).reshape(self.dims+(3*buffer.shape[0],))
+        return self._view_3D
 
     @property
     def view_8bit(self):
         #contingent on being 16bit data
-        if self.dtype == 'uint16':
-            img_8b = np.right_shift(self.view_4D, 8).astype('uint8')
-        elif self.dtype =='uint8':
-            img_8b = self.view_4D
+        if self._view_8bit is None:
+            if self.dtype == 'uint16':
+                self._view_8bit = np.empty(self.view_4D.shape, dtype='uint8')
+                np.right_shift(self.view_4D, 8, out=self._view_8bit, casting='unsafe')
+            elif self.dtype =='uint8':
+                self._view_8bit = self.view_4D
+            elif self.dtype in ('int32', 'float32'):
+                # difference images, negative values show as black
+                self._view_8bit = (np.clip(self.view_4D, 0, 65535) // 256).astype('uint8')
+            else:
+                raise ValueError(f"Invalid datatype given!")
+        return self._view_8bit
+
+    def detect_rois(self, out_path, uv_wl='365', median_ks=9, erode_ks=16, dilate_ks=13, threshold_scale=1, minSize=None, maxSize=None, gray_weights=None, bCompactLabels=False, median_backend='disk', detect_scale=1, morphology_mode='edt', bReuse=False):
+        ''' Spot labels of the UV channel, of spots between minSize and maxSize pixels (see filter_spot_labels).
+            With bCompactLabels they're numbered 1..nSpots, otherwise removed spots leave gaps in the labels.
+            detect_scale > 1 finds the spots coarse to fine (see segment_spots_multiscale), much faster than at full resolution.
+            morphology_mode is one of MORPHOLOGY_MODES, 'validate' to print how the fast morphology's mask differs from the exact one.
+            The result is saved as a ZionRois in out_path (see self.rois), with bReuse it's loaded from there instead of detecting the
+            spots again if they were detected with the same parameters in the same image.
+        '''
+        params = {"uv_wl": uv_wl, "median_ks": median_ks, "erode_ks": erode_ks, "dilate_ks": dilate_ks, "threshold_scale": threshold_scale,
+                  "minSize": minSize, "maxSize": maxSize, "gray_weights": gray_weights, "bCompactLabels": bCompactLabels, "median_backend": median_backend,
+                  "detect_scale": detect_scale, "morphology_mode": morphology_mode, "crop": [self.crop.y, self.crop.x, self.crop.h, self.crop.w] if self.crop is not None else None}
+        source_hash = get_image_hash(self.data[uv_wl])
+        rois = ZionRois.load_matching(out_path, params, source_hash) if bReuse else None
+        if rois is not None:
+            print(f"Reusing the {rois.numSpots} ROIs detected before in {out_path}")
+            spot_labels, nSpots = rois.labels, rois.numSpots
         else:
-            raise ValueError(f"Invalid datatype given!")
-        return img_8b
+            spot_labels, nSpots = self._detect_spot_labels(uv_wl, median_ks, erode_ks, dilate_ks, threshold_scale, minSize, maxSize, gray_weights, bCompactLabels,
+                                                           median_backend, detect_scale, morphology_mode)
+            rois = ZionRois(spot_labels, nSpots, params, source_hash)
+            rois.save(out_path)
+        self.rois = rois
 
-    def detect_rois(self, out_path, uv_wl='365', median_ks=9, erode_ks=16, dilate_ks=13, threshold_scale=1, minSize=None, maxSize=None, gray_weights=None):
+        # rois are in crop coordinates, keep the offsets with them
+        if self.crop is not None:
+            self.crop.save(out_path)
+        roi_img = [create_labeled_rois(spot_labels, filepath=os.path.join(out_path, f"rois"), color=[1,0,1])]
+        for w_ind, w in enumerate(self.wavelengths):
+            roi_img.append( create_labeled_rois(spot_labels, filepath=os.path.join(out_path, f"rois_{w}"), color=[1,0,1], img=self[w]) )
+        return roi_img, spot_labels, nSpots
 
-        print(f"Detecting ROIs using median={median_ks}, erode={erode_ks}, dilate={dilate_ks}, scale={threshold_scale}")
+    def _detect_spot_labels(self, uv_wl, median_ks, erode_ks, dilate_ks, threshold_scale, minSize, maxSize, gray_weights, bCompactLabels, median_backend, detect_scale, morphology_mode):
+
+        print(f"Detecting ROIs using median={median_ks} ({median_backend}), detect_scale={detect_scale}, erode={erode_ks}, dilate={dilate_ks}, scale={threshold_scale}")
 
         #Convert to grayscale (needs to access UV channel here when above change occurs):
         img_gs = rgb2gray(self.data[uv_wl], weights=gray_weights)
 
-        img_gs = median_filter(img_gs, median_ks)
-        thresh = threshold_scale * filters.threshold_mean(img_gs)
-        #TODO: adjust threshold? eg make it based on stats?
-        img_bin = img_gs > thresh
-
-        img_bin = morphology.binary_erosion(img_bin, morphology.disk(erode_ks))
-        img_bin = morphology.binary_dilation(img_bin, morphology.disk(dilate_ks))
-        img_bin = morphology.binary_erosion(img_bin, morphology.disk(4))
-
-        spot_labels, nSpots = measure.label(img_bin, return_num=True)
+        if detect_scale > 1:
+            spot_labels, nSpots = segment_spots_multiscale(img_gs, median_ks, erode_ks, dilate_ks, threshold_scale, median_backend=median_backend, scale=detect_scale, morphology_mode=morphology_mode)
+        else:
+            spot_labels, nSpots = segment_spots(img_gs, median_ks, erode_ks, dilate_ks, threshold_scale, median_backend=median_backend, morphology_mode=morphology_mode)
         print(f"{nSpots} spot candidates found")
-        spot_props = measure.regionprops(spot_labels)
         # sort spot labels by centroid locations because we want to identify homopolymer spots by array coords
         # sorted left to right, top to bottom (like 
         # TODO: add some additional channel (eg 525) that suffers from scatter/noise, and test against it to invalidate spots that include bloom of scatter.
-        centroids = [p.centroid for p in spot_props]
         # snew_cnew_orted(centroids, key=lambda c: [c[1], c[0])
 
-        # TODO: get stats, centroids of spots, further invalidate improper spots.
-        for s in range(1, nSpots+1):
-            size = spot_labels[spot_labels==s].shape[0]
-            if maxSize is not None and size > maxSize:
-                print(f"removing spot {s} with area {size} -- too large")
-                spot_labels[spot_labels==s] = 0
-                nSpots -= 1
-            elif minSize is not None and size < minSize:
-                print(f"removing spot {s} with area {size} -- too small")
-                spot_labels[spot_labels==s] = 0
-                nSpots -= 1
-
-        np.save(os.path.join(out_path, f"rois.npy"), spot_labels)
-        roi_img = [create_labeled_rois(spot_labels, filepath=os.path.join(out_path, f"rois"), color=[1,0,1])]
-        for w_ind, w in enumerate(self.wavelengths):
-            roi_img.append( create_labeled_rois(spot_labels, filepath=os.path.join(out_path, f"rois_{w}"), color=[1,0,1], img=self[w]) )
-        return roi_img, spot_labels, nSpots
-
-# This is a useful way to construct a Zion Image given a directory of images and a cycle index of interest
-def get_imageset_from_cycle(new_cycle, input_dir_path, uv_wl, useDifferenceImage, useTiff=False):
-    cycle_str = f"C{new_cycle:03d}"
-    cycle_files = sorted(glob(os.path.join(input_dir_path, f"*_{cycle_str}_*.tiff"))) if useTiff else sorted(glob(os.path.join(input_dir_path, f"*_{cycle_str}_*.tif")))
-    wls = list(set(sorted([get_wavelength_from_filename(f) for f in cycle_files])))
-    if not uv_wl in wls:
-        raise ValueError(f"No {uv_wl} images in cycle {new_cycle}!")
-    nWls = len(wls)-1
+        # TODO: get stats, centroids of spots, further invalidate improper spots (eg from one measure.regionprops_table pass, like the sizes)
+        return filter_spot_labels(spot_labels, minSize=minSize, maxSize=maxSize, bCompact=bCompactLabels)
 
+def select_cycle_frames(wl_files, uv_wl):
+    ''' Picks the frames of a cycle (wl_files maps wavelength to frames in capture order) that make up its imageset.
+        Returns the wavelengths, their frames, and the subtrahends for difference images.
+    '''
+    wls = list(wl_files.keys())
     # Find earliest images of UV wavelength, but the latest of others:
     imgFileList = []
     diffImgSubtrahends = []
     for wl in wls:
         if wl==uv_wl:
-            imgFileList.append(cycle_files[[f"_{wl}_" in fp for fp in cycle_files].index(True)]) #first uv image
+            imgFileList.append(wl_files[wl][0]) #first uv image
         else:
-            lst_tmp = [f"_{wl}_" in fp for fp in cycle_files]
-            imgFileList.append(cycle_files[ len(lst_tmp) - lst_tmp[-1::-1].index(True) - 1]) # last vis led image
-            diffImgSubtrahends.append(cycle_files[[f"_{wl}_" in fp for fp in cycle_files].index(True)]) # first vis led image
-    currImageSet = ZionImage(imgFileList, wls, cycle=new_cycle, subtrahends=diffImgSubtrahends) if useDifferenceImage else ZionImage(imgFileList, wls, cycle=new_cycle)
+            imgFileList.append(wl_files[wl][-1]) # last vis led image
+            diffImgSubtrahends.append(wl_files[wl][0]) # first vis led image
+    return wls, imgFileList, diffImgSubtrahends
+
+# This is a useful way to construct a Zion Image given a directory of images and a cycle index of interest
+# If the directory holds a ZionRawStore (or one is passed in) the frames come from there instead of tif files
+# calibration is the session's ZionCalibration, if its frames were calibrated while converting
+# diffDtype, diffClamp, out and the background subtraction options (bgSubtract, bgRadius, bgScale) are passed on to ZionImage
+# crop is the raw_converter.Crop to hold, by default the one the frames were converted with (if any)
+def get_imageset_from_cycle(new_cycle, input_dir_path, uv_wl, useDifferenceImage, useTiff=False, store=None, calibration=None, diffDtype=None, diffClamp=None, out=None, crop=None, **bg_kwargs):
+    if store is None and ZionRawStore.exists(input_dir_path):
+        store = ZionRawStore(input_dir_path, readonly=True)
+    frames_crop = store.crop if store is not None else Crop.load(input_dir_path)
+    if crop is None:
+        crop = frames_crop
+    elif frames_crop is not None and crop != frames_crop:
+        raise ValueError(f"Frames of {input_dir_path} are cropped to {frames_crop}, not {crop}!")
+
+    # files (or store frame names) of each wavelength, in capture order
+    if store is not None:
+        wl_files = {wl : store.get_names(new_cycle, wl) for wl in store.get_wavelengths(new_cycle)}
+    else:
+        index = get_session_index(input_dir_path, ext=".tiff" if useTiff else ".tif")
+        if uv_wl not in index.get_wavelengths(new_cycle): # eg converted by another process since the index was made
+            index.refresh()
+        wl_files = {wl : [index.get_path(name) for name in index.get_names(new_cycle, wl)] for wl in index.get_wavelengths(new_cycle)}
+    if not uv_wl in wl_files:
+        raise ValueError(f"No {uv_wl} images in cycle {new_cycle}!")
+    wls, imgFileList, diffImgSubtrahends = select_cycle_frames(wl_files, uv_wl)
+    bDarkCorrected = calibration is not None and calibration.is_applied(new_cycle)
+    currImageSet = ZionImage(imgFileList, wls, cycle=new_cycle, subtrahends=diffImgSubtrahends if useDifferenceImage else None, store=store, bDarkCorrected=bDarkCorrected,
+                             diffDtype=diffDtype, diffClamp=diffClamp, out=out, crop=crop, **bg_kwargs)
     return currImageSet
 
 def create_color_matrix_from_spots(img:ZionImage, spot_labels:np.ndarray, spotlists:tuple, out_path:str=None):
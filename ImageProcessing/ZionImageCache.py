@@ -0,0 +1,78 @@
+import os
+import threading
+from collections import OrderedDict
+from tifffile import imread
+
+'''
+    This module defines the ZionImageCache, a byte-budgeted LRU cache of decoded image files, and image_cache,
+    the process-wide instance that ZionImage reads tifs through. Revisiting a cycle (redoing ROI detection,
+    stepping cycles in a viewer, re-running notebook cells) then doesn't read and decode the same tifs again.
+    Entries are keyed by path and checked against the file's mtime and size, so a re-converted tif is read again.
+    Cached images are read-only, since every reader of the file shares the same array.
+    Frames of a ZionRawStore don't go through here, they're already views into its memory mapping.
+'''
+
+class ZionImageCache:
+
+    # ~2 cycles of 6 half resolution rgb frames
+    DEFAULT_MAX_BYTES = 256 * 2**20
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # path -> (stamp, image)
+        self.nBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _get_stamp(filepath):
+        st = os.stat(filepath)
+        return (st.st_mtime_ns, st.st_size)
+
+    def _evict(self, max_bytes):
+        while self._entries and self.nBytes > max_bytes:
+            _, (_, img) = self._entries.popitem(last=False)
+            self.nBytes -= img.nbytes
+            self.evictions += 1
+
+    def get(self, filepath, loader=imread):
+        ''' Image of a file, read with loader on a miss (or if the file changed since it was cached) '''
+        filepath = os.path.abspath(filepath)
+        stamp = self._get_stamp(filepath)
+        with self._lock:
+            entry = self._entries.get(filepath)
+            if entry is not None and entry[0] == stamp:
+                self._entries.move_to_end(filepath)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        # read outside the lock, so other threads can hit the cache meanwhile
+        img = loader(filepath)
+        img.flags.writeable = False
+        with self._lock:
+            old = self._entries.pop(filepath, None)
+            if old is not None:
+                self.nBytes -= old[1].nbytes
+            if img.nbytes <= self.max_bytes:
+                self._entries[filepath] = (stamp, img)
+                self.nBytes += img.nbytes
+                self._evict(self.max_bytes)
+        return img
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict(max_bytes)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nBytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": len(self._entries), "bytes": self.nBytes, "max_bytes": self.max_bytes}
+
+image_cache = ZionImageCache()
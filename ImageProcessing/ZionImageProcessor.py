@@ -2,15 +2,26 @@ import os
 import time
 import multiprocessing
 import threading
+import queue
+from collections import OrderedDict
 from multiprocessing.managers import Namespace
 import numpy as np
 from tifffile import imread, imwrite
 from matplotlib import pyplot as plt
 
-from ImageProcessing.ZionImage import ZionImage, jpg_to_raw, get_imageset_from_cycle, get_cycle_from_filename, get_wavelength_from_filename, create_color_matrix_from_spots
+from ImageProcessing.ZionImage import ZionImage, set_load_threads, jpg_to_raw, get_imageset_from_cycle, select_cycle_frames, get_cycle_from_filename, get_wavelength_from_filename, get_time_from_filename, create_color_matrix_from_spots, MEDIAN_BACKENDS, MORPHOLOGY_MODES
 from ImageProcessing.ZionData import df_cols, extract_spot_data, csv_to_data, add_basecall_result_to_dataframe
 from ImageProcessing.ZionBaseCaller import project_color, base_call, crosstalk_correct, display_signals
 from ImageProcessing.ZionReport import ZionReport
+from ImageProcessing.ZionFrameRing import ZionFrameRing
+from ImageProcessing.ZionRawStore import ZionRawStore
+from ImageProcessing.raw_converter import Crop, get_unpack_backend, get_decoded_shape, get_raw_geometry
+from ImageProcessing.ZionSpotIndex import ZionSpotIndex, ZionSpotSet
+from ImageProcessing.ZionCalibration import ZionCalibration
+from ImageProcessing.ZionImageCache import image_cache
+from ImageProcessing.ZionSessionIndex import get_session_index
+from ImageProcessing.ZionKinetics import ZionKineticsCube
+from ImageProcessing.ZionRegistration import ZionRegistration, REGISTRATION_MODES, shift_labels, get_transform_key, get_key_transform, get_transform_distance
 
 '''
     This module defines the runtime image handler thread (really a multiprocessing.Process). Also contains child threads which perform image processing functions.
@@ -20,17 +31,82 @@ class ZionImageProcessor(multiprocessing.Process):
 
     # TODO: is this the best way to handle versions?
     IMAGE_PROCESS_VERSION = 1
+    # how often threads paused from the GUI check whether they're enabled again, every check is a round trip to the manager
+    ENABLE_POLL_S = 0.05
 
-    def __init__(self, gui, session_path, bJpgConverter=True, uvWavelength='365'):
+    def __init__(self, gui, session_path, bJpgConverter=True, uvWavelength='365', nFrameSlots=6, bRawStore=True, rawCompression=None, rawCompressionLevel=None, rawMode='rgb', calibrationPath=None, nDarkFrames=5, flatWavelength=None, nFlatFrames=5, imageCacheMB=None, nLoadThreads=None, diffDtype=None, diffClamp=None, bgRadius=64, bKinetics=True, registrationMode='translation', registrationScale=4, cropping=None,
+                 nPrefetchCycles=2, prefetchMB=256, bCompactLabels=False, medianBackend='disk', detectScale=1, morphologyMode='edt', bReuseRois=True):
         super().__init__()
 
         self.gui = gui
         self.session_path = session_path
         self.file_output_path = os.path.join(session_path, f"processed_images_v{self.IMAGE_PROCESS_VERSION}")
         self.raws_path = os.path.join(session_path, f"raws")
+        # converted frames go into a ZionRawStore in raws_path (opened in the child process) instead of one tif each
+        self.bRawStore = bRawStore
+        self.raw_store = None
+        # codec and level for raw tifs (the raw store itself is always uncompressed since it's memory-mapped)
+        self.rawCompression = rawCompression
+        self.rawCompressionLevel = rawCompressionLevel
+        # decode mode (see raw_converter.DECODE_MODES), eg 'binned' for quarter size images when coarse intensities are enough
+        self.rawMode = rawMode
+        # only the part of the frames in the cropping box (picamera zoom style (x, y, w, h), see ZionCamera.capture) is decoded
+        # and processed, everything from the raw store to the ROIs is in the coordinates of that Crop. It's made from the first
+        # frame's raw geometry and kept in the raws directory, so the session's frames all have the same one.
+        self.cropping = cropping
+        self.crop = None
+        # master dark (and flat field) applied while decoding, see ZionCalibration. Either kept from an earlier run of the session,
+        # copied from calibrationPath, or built from the first nDarkFrames dark frames of the session (0 to disable), and the
+        # first nFlatFrames captures of flatWavelength (eg uniformly lit frames of a cycle 0 calibration step) if it's given
+        self.calibration = None
+        self.calibrationPath = calibrationPath
+        self.nDarkFrames = nDarkFrames
+        self._dark_frames = []
+        self.flatWavelength = flatWavelength
+        self.nFlatFrames = nFlatFrames
+        self._flat_frames = []
+        # latest cycle the converter started on, a calibration applies from the next one (see _set_calibration)
+        self._last_converted_cycle = None
+        self._calibration_lock = threading.Lock()
+        # budget of the process-wide tif cache ZionImage reads through (set before the process is forked in start())
+        if imageCacheMB is not None:
+            image_cache.set_max_bytes(int(imageCacheMB * 2**20))
+        # threads ZionImages read a cycle's frames with (the pool itself is made in the process on first use)
+        if nLoadThreads is not None:
+            set_load_threads(nLoadThreads)
 
         self.roi_labels = None
         self.numSpots = None
+        # number spots 1..numSpots, instead of keeping the labels of spot candidates (see ZionImage.filter_spot_labels)
+        self.bCompactLabels = bCompactLabels
+        # median filter of ROI detection (see ZionImage.MEDIAN_BACKENDS)
+        if medianBackend not in MEDIAN_BACKENDS:
+            raise ValueError(f"Unknown median backend {medianBackend}, should be one of {MEDIAN_BACKENDS}")
+        self.medianBackend = medianBackend
+        # ROIs are found coarse to fine on the UV image downsampled by this (see ZionImage.segment_spots_multiscale), 1 for full resolution
+        self.detectScale = detectScale
+        # erosions/dilations of ROI detection (see ZionImage.MORPHOLOGY_MODES), 'validate' to check 'edt' against 'exact'
+        if morphologyMode not in MORPHOLOGY_MODES:
+            raise ValueError(f"Unknown morphology mode {morphologyMode}, should be one of {MORPHOLOGY_MODES}")
+        self.morphologyMode = morphologyMode
+        # load cycle 1's ROIs and basis spots back from the processed directory if they match (see ZionRois)
+        self.bReuseRois = bReuseRois
+        # once ROIs are detected, spot pixels are gathered straight from the raw buffers of later cycles (see ZionSpotIndex)
+        self.spot_index = None
+        self.spot_pixels = dict() # frame name -> spot pixels
+        self.spot_frames = dict() # cycle -> wavelength -> frame names
+        self._converted_cycles = set()
+        # drift of each cycle relative to cycle 1 (see ZionRegistration, None to disable), which the ROIs are moved by.
+        # Moved ROIs are kept by transform key (see _get_rois), and every frame of a cycle is gathered with the same ones.
+        if registrationMode is not None and registrationMode not in REGISTRATION_MODES:
+            raise ValueError(f"Unknown registration mode {registrationMode}, should be one of {REGISTRATION_MODES} or None")
+        self.registrationMode = registrationMode
+        self.registrationScale = registrationScale
+        self.registration = None
+        self.roi_key = None # ROIs the next cycle is gathered with
+        self._cycle_roi_keys = dict() # cycle -> ROIs its spot pixels are gathered with
+        self._roi_maps = OrderedDict() # transform key -> (labels, ZionSpotIndex)
+        self._roi_maps_lock = threading.Lock()
         self.M = None
         self.Reports = []
 
@@ -46,8 +122,29 @@ class ZionImageProcessor(multiprocessing.Process):
         self.mp_namespace.bConvertEnable = False
 
         self.bUseDifferenceImages = False
+        # dtype and clamp of dark/difference subtracted images (see ZionImage)
+        self.diffDtype = diffDtype
+        self.diffClamp = diffClamp
+        # cycles are loaded by _prefetch_cycles as the converter reports them, up to nPrefetchCycles ahead of the image handler
+        # and prefetchMB of ZionImages (at least one cycle is always loaded). Buffers of handled cycles are loaded into again.
+        self.nPrefetchCycles = nPrefetchCycles
+        self.prefetchBytes = int(prefetchMB * 2**20) if prefetchMB is not None else None
+        self.prefetched_cycle_queue = queue.Queue(maxsize=max(1, nPrefetchCycles))
+        self._prefetch_condition = threading.Condition()
+        self._prefetched_bytes = 0
+        self._free_buffers = []
+        # set once cycle 1's ROIs are there, later cycles are registered and gathered with them
+        self._rois_ready = threading.Event()
+        # smooth background subtraction (see ZionImage), switched on and off from the GUI
+        self.bgRadius = bgRadius
+        # spot statistics of every (non dark, non uv) frame, from the spot pixels gathered while converting
+        self.bKinetics = bKinetics
+        self.uvWavelength = uvWavelength
+        self.kinetics_cube = None
+        self._kinetics_lock = threading.Lock() # the cube is saved by the analyzer at each new cycle, and at shutdown
         self.mp_namespace.bShowSpots = False
         self.mp_namespace.bShowBases = False
+        self.mp_namespace.bSubtractBg = False
         self.mp_namespace.ip_cycle_ind = 0
         self.mp_namespace.convert_cycle_ind = 0
         self.mp_namespace.view_cycle_ind = 0
@@ -61,11 +158,15 @@ class ZionImageProcessor(multiprocessing.Process):
 
         self.base_caller_queue = self._mp_manager.Queue()
         self.bases_called_event = self._mp_manager.Event()
-        self.kinetics_analyzer_queue = self._mp_manager.Queue()
+        # (frame name, spot pixels) from the converter thread, only used within the process
+        self.kinetics_analyzer_queue = queue.Queue()
         self.kinetics_analyzed_event = self._mp_manager.Event()
 
         self._image_viewer_queue = self._mp_manager.Queue()
 
+        # captured frames are handed to _convert_jpeg through these shared memory slots
+        self.frame_ring = ZionFrameRing(self._mp_manager, nSlots=nFrameSlots)
+
         self.start()
 
     def run(self):
@@ -84,6 +185,14 @@ class ZionImageProcessor(multiprocessing.Process):
         self._convert_image_thread.join(12.0)
         if self._convert_image_thread.is_alive():
             print("_convert_image_thread is still alive!")
+        if self.raw_store is not None:
+            self.raw_store.close()
+        # the analyzer only saves the cube when the next cycle starts, so the last cycle's frames would be lost,
+        # it's paused (bEnable) once it's done with the frame it may be adding
+        with self._kinetics_lock:
+            if self.kinetics_cube is not None:
+                self.kinetics_cube.save(self.file_output_path)
+                print(f"Saved the kinetics cube to {self.file_output_path}")
         # ~ self._image_processing_thread.join(10.0)
         # ~ if self._image_processing_thread.is_alive():
             # ~ print("_image_processing_thread is still alive!")
@@ -98,6 +207,35 @@ class ZionImageProcessor(multiprocessing.Process):
 
     def _start_child_threads(self):
 
+        if self.bRawStore:
+            self.raw_store = ZionRawStore(self.raws_path, mode=self.rawMode)
+            print(f"Converting to the raw store using the {get_unpack_backend()} unpacker")
+
+        if Crop.exists(self.raws_path):
+            self.crop = Crop.load(self.raws_path)
+            print(f"Frames of this session are cropped to {self.crop}")
+        elif self.cropping is not None and ((self.raw_store is not None and len(self.raw_store)) or len(get_session_index(self.raws_path, ext=".tif"))):
+            print(f"Not cropping, this session already has whole frames")
+            self.cropping = None
+
+        # frames converted before this run aren't calibrated again
+        converted_cycles = self.raw_store.cycles if self.raw_store is not None else get_session_index(self.raws_path, ext=".tif").cycles
+        self._last_converted_cycle = max((c for c in converted_cycles if c is not None), default=None)
+        # calibration only applies to 'rgb' decoding
+        if self.rawMode == 'rgb':
+            calibration = None
+            if ZionCalibration.exists(self.file_output_path):
+                calibration = ZionCalibration.load(self.file_output_path)
+            elif self.calibrationPath is not None:
+                calibration = ZionCalibration.load(self.calibrationPath)
+                calibration.first_cycle = None
+            if calibration is not None:
+                print(f"Using calibration with {calibration.nDarkFrames} dark frames, flat field: {calibration.gain is not None}")
+                if calibration.first_cycle is None:
+                    self._set_calibration(calibration)
+                else:
+                    self.calibration = calibration
+
         self._convert_image_thread = threading.Thread(
             target=self._convert_jpeg,
             args=(self.mp_namespace, self.convert_files_queue, self.new_cycle_detected, self.spot_extraction_queue)
@@ -105,9 +243,16 @@ class ZionImageProcessor(multiprocessing.Process):
         self._convert_image_thread.daemon = True
         self._convert_image_thread.start()
 
+        self._prefetch_thread = threading.Thread(
+            target=self._prefetch_cycles,
+            args=(self.mp_namespace, self.new_cycle_detected, self.prefetched_cycle_queue)
+        )
+        self._prefetch_thread.daemon = True
+        self._prefetch_thread.start()
+
         self._image_processing_thread = threading.Thread(
             target=self._image_handler,
-            args=(self.mp_namespace, self.new_cycle_detected, self.rois_detected_event, self.basis_spots_chosen_queue, self.base_caller_queue, self.kinetics_analyzer_queue)
+            args=(self.mp_namespace, self.prefetched_cycle_queue, self.rois_detected_event, self.basis_spots_chosen_queue, self.base_caller_queue, self.kinetics_analyzer_queue)
         )
         self._image_processing_thread.daemon = True
         self._image_processing_thread.start()
@@ -120,14 +265,14 @@ class ZionImageProcessor(multiprocessing.Process):
         self._base_calling_thread.daemon = True
         self._base_calling_thread.start()
 
-        #TODO re-enable kinetics thread once metrics are well-defined
-        # ~ self._kinetics_thread = threading.Thread(
-            # ~ target=self._kinetics_analyzer,
-            # ~ args=(self.mp_namespace, self.kinetics_analyzer_queue, self.kinetics_analyzed_event)
-        # ~ )
+        if self.bKinetics:
+            self._kinetics_thread = threading.Thread(
+                target=self._kinetics_analyzer,
+                args=(self.mp_namespace, self.kinetics_analyzer_queue, self.kinetics_analyzed_event)
+            )
 
-        # ~ self._kinetics_thread.daemon = True
-        # ~ self._kinetics_thread.start()
+            self._kinetics_thread.daemon = True
+            self._kinetics_thread.start()
 
         # ~ #todo: same for other threads
 
@@ -140,14 +285,13 @@ class ZionImageProcessor(multiprocessing.Process):
             print(f"Creating directory {self.raws_path} for raws")
         while True:
             filepath_args = image_file_queue.get()
-            filepath = filepath_args[0]
+            filepath, frame_slot = filepath_args
             if filepath is None: # basically a stop signal
                 print("_convert_jpeg -- received stop signal!")
                 break
             if mp_namespace.bConvertEnable:
                 print(f"Converting jpeg {filepath}")
-                filename = os.path.splitext(os.path.basename(filepath))[0]
-                jpg_to_raw(filepath, os.path.join(self.raws_path, filename+".tif"))
+                filename = self._convert_to_raw(filepath, frame_slot)
                 cycle = get_cycle_from_filename(filename)
                 if cycle is not None:
                     if cycle != mp_namespace.convert_cycle_ind:
@@ -161,19 +305,160 @@ class ZionImageProcessor(multiprocessing.Process):
                         print(f"_convert_jpg thread: Cycle {mp_namespace.convert_cycle_ind} event being set")
                         lock = True # only do this once
             else:
-                while not mp_namespace.bConvertEnable:
-                    continue
+                self._wait_until_enabled(mp_namespace, "bConvertEnable")
                 print(f"Converting jpeg {filepath} after wait")
-                filename = os.path.splitext(os.path.basename(filepath))[0]
-                jpg_to_raw(filepath, os.path.join(self.raws_path, filename+".tif"))
+                self._convert_to_raw(filepath, frame_slot)
+
+    def _wait_until_enabled(self, mp_namespace : Namespace, flag : str = "bEnable"):
+        ''' Blocks (sleeping, rather than spinning on the manager) while processing is paused, ie flag of mp_namespace is False '''
+        while not getattr(mp_namespace, flag):
+            time.sleep(self.ENABLE_POLL_S)
+
+    def _convert_to_raw(self, filepath, frame_slot=None):
+        ''' Converts from the frame's shared memory slot if it has one (then releases it), otherwise from the file '''
+        filename = os.path.splitext(os.path.basename(filepath))[0]
+        cycle = get_cycle_from_filename(filename)
+        bNewCycle = cycle not in self._converted_cycles
+        self._converted_cycles.add(cycle)
+        buffer = self.frame_ring.view(frame_slot) if frame_slot is not None else None
+        try:
+            if buffer is None and (self.raw_store is not None or self.spot_index is not None or self.calibration is not None or self.cropping is not None):
+                with open(filepath, "rb") as f:
+                    buffer = f.read()
+            crop = self._get_crop(buffer) if buffer is not None else self.crop
+
+            # like spots below, calibration is applied to whole cycles, starting with the first one converted after it's available
+            with self._calibration_lock:
+                if cycle is not None and (self._last_converted_cycle is None or cycle > self._last_converted_cycle):
+                    self._last_converted_cycle = cycle
+                calibration = self.calibration
+                if calibration is not None and calibration.is_applied(cycle):
+                    if crop is not None and calibration.shape == get_decoded_shape('rgb', get_raw_geometry(buffer)): # eg from calibrationPath
+                        calibration = calibration.crop(crop)
+                        calibration.save(self.file_output_path)
+                        self.calibration = calibration
+                else:
+                    calibration = None
+            if calibration is not None and calibration.shape != get_decoded_shape('rgb', get_raw_geometry(buffer), crop): # eg camera binning changed
+                print(f"Not calibrating {filename}, its size doesn't match the calibration's {calibration.shape}")
+                calibration = None
+
+            # only gather whole cycles, ie not one that was already being converted when the index was made,
+            # and with the same ROIs (those of the last registered cycle) for all of its frames
+            if self.spot_index is not None and cycle is not None and bNewCycle:
+                self._cycle_roi_keys[cycle] = self.roi_key
+            roi_key = self._cycle_roi_keys.get(cycle)
+            if roi_key is not None:
+                try:
+                    pixels = self._get_rois(roi_key)[1].gather(buffer, calibration=calibration)
+                    self.spot_pixels[filename] = pixels
+                    wavelength = get_wavelength_from_filename(filename)
+                    self.spot_frames.setdefault(cycle, dict()).setdefault(wavelength, []).append(filename)
+                    if self.bKinetics and wavelength not in ('000', self.uvWavelength):
+                        self.kinetics_analyzer_queue.put( (filename, pixels, roi_key) )
+                except ValueError as e: # eg different raw geometry than the rois, the cycle falls back to full images
+                    print(f"Can't gather spots of {filename}: {e}")
+                    self._cycle_roi_keys.pop(cycle, None)
+                    for wl_files in self.spot_frames.pop(cycle, dict()).values():
+                        for name in wl_files:
+                            self.spot_pixels.pop(name, None)
+
+            stored = False
+            if self.raw_store is not None:
+                try:
+                    self.raw_store.append(filename, cycle, get_wavelength_from_filename(filename), get_time_from_filename(filename), buffer=buffer, calibration=calibration, crop=crop)
+                    stored = True
+                except ValueError as e: # eg camera binning changed mid-session, so the frame size doesn't match the store
+                    print(f"Not adding {filename} to the raw store ({e}), converting to tif instead")
+            if not stored:
+                target_path = os.path.join(self.raws_path, filename+".tif")
+                jpg_to_raw(filepath, target_path, buffer=buffer, compression=self.rawCompression, level=self.rawCompressionLevel, mode=self.rawMode, calibration=calibration, crop=crop)
+                get_session_index(self.raws_path, ext=".tif").add(target_path)
+        finally:
+            if frame_slot is not None:
+                buffer.release()
+                self.frame_ring.release(frame_slot)
+        return filename
+
+    def _get_crop(self, buffer):
+        ''' The session's Crop (None for whole frames), made from the cropping box with the first frame's raw geometry '''
+        geometry = get_raw_geometry(buffer)
+        if self.crop is None and self.cropping is not None:
+            self.crop = Crop.from_normalized(self.cropping, geometry)
+            self.cropping = None
+            if self.crop is not None:
+                self.crop.save(self.raws_path)
+                print(f"Cropping frames to {self.crop}")
+        if self.crop is not None:
+            try:
+                self.crop.check(geometry)
+            except ValueError as e: # eg camera binning changed
+                print(f"Not cropping: {e}")
+                return None
+        return self.crop
+
+    def _prefetch_cycles(self, mp_namespace : Namespace, new_cycle_queue : multiprocessing.Queue, prefetched_queue : queue.Queue):
+        ''' Gets each cycle the converter reports ready for the image handler, in order: its spot pixels if they were all
+            gathered (and still match its drift), otherwise a loaded ZionImage. Loading overlaps with the handler and base caller
+            working on earlier cycles, within nPrefetchCycles and prefetchBytes.
+        '''
+        uv_wl = self.uvWavelength
+        while True:
+            new_cycle = new_cycle_queue.get()
+            self._wait_until_enabled(mp_namespace)
+            self._update_calibration(new_cycle)
+            if new_cycle == 0:
+                prefetched_queue.put( (new_cycle, None) )
+                continue
+
+            bSubtractBg = mp_namespace.bSubtractBg
+            roi_key, spot_set = None, None
+            if new_cycle > 1:
+                if not self._rois_ready.is_set():
+                    print(f"Waiting for cycle 1's ROIs before preparing cycle {new_cycle}")
+                self._rois_ready.wait()
+                roi_key = self._register_cycle(new_cycle, uv_wl)
+                spot_set = self._get_spot_set(new_cycle, uv_wl)
+                if bSubtractBg: # needs whole images
+                    spot_set = None
+                elif spot_set is not None and spot_set.roi_key != roi_key:
+                    print(f"Cycle {new_cycle} drifted from the ROIs its spot pixels were gathered with, using full images")
+                    spot_set = None
+            if spot_set is not None:
+                prefetched_queue.put( (new_cycle, spot_set) )
+                continue
 
-    def _image_handler(self, mp_namespace : Namespace, image_ready_queue : multiprocessing.Queue, rois_detected_event, basis_chosen_queue, base_caller_queue, kinetics_queue):
-        ''' High level handler... will use cycle number (before incrementing)
-            to check raws directory for cycles, make decisions on where to send imageset
+            with self._prefetch_condition:
+                out = self._free_buffers.pop() if self._free_buffers else None
+            currImageSet = get_imageset_from_cycle(new_cycle, self.raws_path, uv_wl, self.bUseDifferenceImages, store=self.raw_store, calibration=self.calibration,
+                                                   diffDtype=self.diffDtype, diffClamp=self.diffClamp, out=out,
+                                                   bgSubtract=bSubtractBg, bgRadius=self.bgRadius)
+            currImageSet.roi_key = roi_key
+            nbytes = currImageSet.nbytes
+            with self._prefetch_condition:
+                # there's always room for one cycle, however big
+                self._prefetch_condition.wait_for(lambda: self.prefetchBytes is None or self._prefetched_bytes == 0 or self._prefetched_bytes + nbytes <= self.prefetchBytes)
+                self._prefetched_bytes += nbytes
+            currImageSet.view_4D # loads it
+            if out is not None and currImageSet.view_4D is not out: # eg a different dtype
+                self._release_buffer(out, 0)
+            print(f"Cycle {new_cycle} prefetched ({nbytes/2**20:.0f} MB)")
+            prefetched_queue.put( (new_cycle, currImageSet) )
+
+    def _release_buffer(self, buffer, nbytes):
+        ''' Makes a handled cycle's buffer available to load another into, and frees its share of the prefetch budget '''
+        with self._prefetch_condition:
+            if len(self._free_buffers) < self.nPrefetchCycles:
+                self._free_buffers.append(buffer)
+            self._prefetched_bytes -= nbytes
+            self._prefetch_condition.notify_all()
+
+    def _image_handler(self, mp_namespace : Namespace, image_ready_queue : queue.Queue, rois_detected_event, basis_chosen_queue, base_caller_queue, kinetics_queue):
+        ''' High level handler... takes each cycle's imageset (or spot set) from _prefetch_cycles,
+            make decisions on where to send imageset
         '''
 
         mp_namespace.ip_cycle_ind = 0
-        in_path = self.raws_path
         out_path = self.file_output_path
         if not os.path.isdir(self.file_output_path):
             os.makedirs(self.file_output_path)
@@ -181,13 +466,11 @@ class ZionImageProcessor(multiprocessing.Process):
         rois_detected_event.clear()
         # ~ lock = False
 
-        #TODO: this should come from a ZionLED property or something
-        uv_wl = '365'
+        uv_wl = self.uvWavelength
 
         while True:
-            new_cycle = image_ready_queue.get()
-            while not mp_namespace.bEnable:
-                continue
+            new_cycle, currImageSet = image_ready_queue.get()
+            self._wait_until_enabled(mp_namespace)
             print(f"_image_handler thread: begin processing new cycle {new_cycle}")
             self.mp_namespace.ip_cycle_ind = new_cycle
 
@@ -201,17 +484,28 @@ class ZionImageProcessor(multiprocessing.Process):
                 continue
 
             else:
-                currImageSet = get_imageset_from_cycle(new_cycle, in_path, uv_wl, self.bUseDifferenceImages)
-                # Now currImageSet is a ZionImage
+                # currImageSet is a ZionImage, or a ZionSpotSet for cycles whose spot pixels were gathered while converting
 
                 if new_cycle == 1:
                     done = False
+                    # ROIs (and basis spots) of a run that was interrupted, or of processing the session before, unless redone from the GUI
+                    bReuse = self.bReuseRois
                     while not done:
-                        while not mp_namespace.bEnable:
-                            continue
+                        self._wait_until_enabled(mp_namespace)
                         # TODO add minSize and maxSize and gray_weights to GUI and to self.mp_namespace
                         _, self.roi_labels, self.numSpots = currImageSet.detect_rois(self.file_output_path, uv_wl=uv_wl, median_ks=self.mp_namespace.median_ks, erode_ks=self.mp_namespace.erode_ks, dilate_ks=self.mp_namespace.dilate_ks, threshold_scale=mp_namespace.threshold_scale,
-                                                                                                 minSize=self.mp_namespace.minSpotSize, maxSize=self.mp_namespace.maxSpotSize, gray_weights=self.mp_namespace.grayWeights)
+                                                                                                 minSize=self.mp_namespace.minSpotSize, maxSize=self.mp_namespace.maxSpotSize, gray_weights=self.mp_namespace.grayWeights,
+                                                                                                 bCompactLabels=self.bCompactLabels, median_backend=self.medianBackend,
+                                                                                                 detect_scale=self.detectScale, morphology_mode=self.morphologyMode, bReuse=bReuse)
+                        rois = currImageSet.rois
+                        if rois.bReused and rois.basis_spotlists is not None:
+                            basis_spotlists = rois.basis_spotlists
+                            print(f"Reusing basis spotlists: {basis_spotlists}")
+                            # the GUI's ROI and spot views wait for this, detect_rois wrote the rois_<wl>.jpg images either way
+                            rois_detected_event.set()
+                            done = True
+                            continue
+
                         # This is to notify that rois were detected:
                         print(f"About to set roi detected event with {self.numSpots} spots")
                         rois_detected_event.set()
@@ -222,38 +516,143 @@ class ZionImageProcessor(multiprocessing.Process):
 
                         #TODO this will turn into a tuple of lists (of spot labels)
                         if isinstance(basis_spotlists, tuple) and len(basis_spotlists)==4:
+                            rois.save_basis(self.file_output_path, basis_spotlists)
                             done = True
                         else:
                             done = False
+                            bReuse = False
                             rois_detected_event.clear()
 
                     #todo call new function for creating basis vector matrix
                     self.create_basis_vector_matrix(currImageSet, basis_spotlists, self.file_output_path)
                     print(f"\n\nBasis Vector = {self.M}, with shape {self.M.shape}\n\n")
+                    self._roi_maps.clear()
+                    self._cycle_roi_keys.clear()
+                    roi_key = get_transform_key(np.eye(2, 3))
+                    # roi labels are in 'rgb' decode coordinates
+                    spot_index = ZionSpotIndex(self.roi_labels, crop=currImageSet.crop) if self.rawMode == 'rgb' else None
+                    self._roi_maps[roi_key] = (self.roi_labels, spot_index)
+                    self.roi_key = roi_key
+                    if self.registrationMode is not None:
+                        self.registration = ZionRegistration(currImageSet[uv_wl], scale=self.registrationScale, mode=self.registrationMode)
+                        self.registration.save(self.file_output_path)
+                    # set last, the converter starts gathering spots of the next cycle once it's there
+                    self.spot_index = spot_index
+                    self._rois_ready.set()
                     # done with all cycle-1 exclusive stuff
 
+                    currImageSet.roi_key = roi_key
                     base_caller_queue.put(currImageSet)
 
-                    #TODO re-enable kinetics thread once metrics are well-defined
-                    # ~ vis_cycle_files = [ f for f in cycle_files if not get_wavelength_from_filename(f)==uv_wl]
-                    # ~ print(f"kineticsImageSet = {vis_cycle_files}")
-                    # ~ for cf in range(0, len(vis_cycle_files), nWls):
-                        # ~ wls = [ get_wavelength_from_filename(f) for f in vis_cycle_files[cf:cf+nWls] ]
-                        # ~ kinetics_queue.put( ZionImage(vis_cycle_files[cf:cf+nWls], wls, cycle=new_cycle) )
-
                 elif new_cycle > 1:
                     base_caller_queue.put(currImageSet)
 
-                    #TODO re-enable kinetics thread once metrics are well-defined
-                    # ~ vis_cycle_files = [ f for f in cycle_files if not get_wavelength_from_filename(f)==uv_wl]
-                    # ~ print(f"kineticsImageSet = {vis_cycle_files}")
-                    # ~ for cf in range(0, len(vis_cycle_files), nWls):
-                        # ~ wls = [ get_wavelength_from_filename(f) for f in vis_cycle_files[cf:cf+nWls] ]
-                        # ~ kinetics_queue.put( ZionImage(vis_cycle_files[cf:cf+nWls], wls, cycle=new_cycle) )
-
                 else:
                     raise ValueError(f"Invalid cycle index {new_cycle}!")
 
+                if isinstance(currImageSet, ZionImage):
+                    # the queue has its own copy, another cycle can be loaded into this one's buffer
+                    self._release_buffer(currImageSet.view_4D, currImageSet.nbytes)
+
+    def _get_spot_set(self, cycle, uv_wl):
+        ''' ZionSpotSet of a cycle whose spot pixels were all gathered during conversion, otherwise None '''
+        wl_files = self.spot_frames.pop(cycle, None)
+        roi_key = self._cycle_roi_keys.pop(cycle, None)
+        if wl_files is None or not uv_wl in wl_files:
+            return None
+        wls, names, subtrahends = select_cycle_frames(wl_files, uv_wl)
+        frame_pixels = {name : self.spot_pixels.pop(name) for wl in wl_files for name in wl_files[wl]}
+        print(f"Cycle {cycle}: using spot pixels gathered from the raw data")
+        bDarkCorrected = self.calibration is not None and self.calibration.is_applied(cycle)
+        spot_set = ZionSpotSet(names, wls, frame_pixels, cycle=cycle, subtrahends=subtrahends if self.bUseDifferenceImages else None, bDarkCorrected=bDarkCorrected,
+                          diffDtype=self.diffDtype, diffClamp=self.diffClamp)
+        spot_set.roi_key = roi_key
+        return spot_set
+
+    # moved ROIs kept around (they're made again from their key if needed after that)
+    MAX_ROI_MAPS = 8
+
+    def _get_rois(self, roi_key):
+        ''' (labels, ZionSpotIndex) of the ROIs moved by the transform of a key (see ZionRegistration.get_transform_key),
+            the ROI index is None if spots aren't gathered from raw data
+        '''
+        with self._roi_maps_lock:
+            rois = self._roi_maps.get(roi_key)
+            if rois is not None:
+                self._roi_maps.move_to_end(roi_key)
+                return rois
+        labels = shift_labels(self.roi_labels, get_key_transform(roi_key))
+        rois = (labels, ZionSpotIndex(labels, crop=self.spot_index.crop) if self.spot_index is not None else None)
+        with self._roi_maps_lock:
+            self._roi_maps[roi_key] = rois
+            # never drop cycle 1's ROIs
+            while len(self._roi_maps) > self.MAX_ROI_MAPS:
+                oldest = next(k for k in self._roi_maps if k != get_transform_key(np.eye(2, 3)))
+                del self._roi_maps[oldest]
+        return rois
+
+    def _register_cycle(self, cycle, uv_wl):
+        ''' Estimates a cycle's drift from its first UV frame and moves the ROIs with it, returns the key of the cycle's ROIs.
+            ROIs only move once the drift is half a pixel away from where they are, so cycles gathered with them can still use them.
+        '''
+        if self.registration is None:
+            return self.roi_key
+        if self.raw_store is not None and self.raw_store.get_names(cycle, uv_wl):
+            uv_frame = self.raw_store[self.raw_store.get_names(cycle, uv_wl)[0]]
+        else:
+            raws_index = get_session_index(self.raws_path, ext=".tif")
+            name = raws_index.get_first(cycle, uv_wl)
+            if name is None:
+                print(f"Not registering cycle {cycle}, it has no {uv_wl} frame")
+                return self.roi_key
+            uv_frame = image_cache.get(raws_index.get_path(name))
+        try:
+            transform = self.registration.estimate(uv_frame, cycle=cycle)
+        except ValueError as e: # eg camera binning changed
+            print(f"Not registering cycle {cycle}: {e}")
+            return self.roi_key
+        self.registration.save_transforms(self.file_output_path)
+        if get_transform_distance(transform, get_key_transform(self.roi_key), self.roi_labels.shape) >= 0.5:
+            roi_key = get_transform_key(transform)
+            self._get_rois(roi_key)
+            print(f"Cycle {cycle}: drift of {np.round(transform[:,2], 1)} pixels, moving ROIs")
+            # later cycles are gathered with these
+            self.roi_key = roi_key
+        return self.roi_key
+
+    def _update_calibration(self, cycle):
+        ''' Collects each cycle's dark (and flat) frames until there are nDarkFrames to build the session's master dark from '''
+        if self.calibration is not None or self.rawMode != 'rgb' or self.nDarkFrames <= 0:
+            return
+        if self.raw_store is not None:
+            get_names, get_frame = self.raw_store.get_names, lambda name: np.array(self.raw_store[name])
+        else:
+            raws_index = get_session_index(self.raws_path, ext=".tif")
+            get_names, get_frame = raws_index.get_names, lambda name: image_cache.get(raws_index.get_path(name))
+        self._dark_frames.extend(get_frame(name) for name in get_names(cycle, '000'))
+        if self.flatWavelength is not None and len(self._flat_frames) < self.nFlatFrames:
+            self._flat_frames.extend(get_frame(name) for name in get_names(cycle, self.flatWavelength)[:self.nFlatFrames-len(self._flat_frames)])
+        if len(self._dark_frames) >= self.nDarkFrames:
+            # flats come with the first cycles (eg cycle 0), so whatever there is by now is all there will be
+            flat_frames = self._flat_frames if self._flat_frames else None
+            if self.flatWavelength is not None and len(self._flat_frames) < self.nFlatFrames:
+                print(f"Only {len(self._flat_frames)} of {self.nFlatFrames} {self.flatWavelength} flat frames for the flat field")
+            calibration = ZionCalibration.from_frames(self._dark_frames[:self.nDarkFrames], flat_frames)
+            self._dark_frames = []
+            self._flat_frames = []
+            print(f"Built master dark from {self.nDarkFrames} dark frames" + (f" and flat field from {len(flat_frames)} frames" if flat_frames else ""))
+            self._set_calibration(calibration)
+
+    def _set_calibration(self, calibration):
+        ''' Saves a new calibration and hands it to the converter, which applies it from the cycle after the one it's converting
+            (so every cycle is either calibrated or not). first_cycle isn't changed after this.
+        '''
+        calibration.save(self.file_output_path)
+        with self._calibration_lock:
+            calibration.first_cycle = 0 if self._last_converted_cycle is None else self._last_converted_cycle + 1
+            self.calibration = calibration
+        calibration.save_info(self.file_output_path)
+        print(f"Calibrating frames from cycle {calibration.first_cycle} on")
 
     def _base_caller(self, mp_namespace : Namespace, base_caller_queue : multiprocessing.Queue, bases_called_event : multiprocessing.Event, delay : int = 0):
         '''
@@ -269,39 +668,55 @@ class ZionImageProcessor(multiprocessing.Process):
             f.write(','.join(df_cols)+'\n')
         while True:
             imageset = base_caller_queue.get()
-            while not mp_namespace.bEnable:
-                continue
+            self._wait_until_enabled(mp_namespace)
             if self.roi_labels is None or self.numSpots is None:
                 raise RunTimeError("ROIs haven't been detected yet!")
             elif self.numSpots==0:
                 raise ValueError("No spots to use in basecalling!")
+            # ROIs moved with the cycle's drift (see _register_cycle)
+            roi_labels, spot_index = self._get_rois(imageset.roi_key) if getattr(imageset, "roi_key", None) is not None else (self.roi_labels, self.spot_index)
+            if isinstance(imageset, ZionSpotSet):
+                spot_data = spot_index.extract_spot_data(imageset, csvFileName = csvfile)
             else:
-                spot_data = extract_spot_data(imageset, self.roi_labels, csvFileName = csvfile)
+                spot_data = extract_spot_data(imageset, roi_labels, csvFileName = csvfile)
 
     def _kinetics_analyzer(self, mp_namespace : Namespace, kinetics_queue : multiprocessing.Queue, kinetics_analyzed_event : multiprocessing.Event):
 
         csvfile = os.path.join(self.file_output_path, "kinetics_spot_data.csv")
-        print(f"_base_caller_thread: creating csv file {csvfile}")
+        print(f"_kinetics_analyzer thread: creating csv file {csvfile}")
+        os.makedirs(self.file_output_path, exist_ok=True)
         with open(csvfile, "w") as f:
             f.write(','.join(df_cols)+'\n')
+        last_cycle = None
         while True:
-            imageset = kinetics_queue.get()
-            while not mp_namespace.bEnable:
-                continue
-            if self.roi_labels is None or self.numSpots is None:
-                raise RunTimeError("ROIs haven't been detected yet!")
-            elif self.numSpots==0:
+            # each frame only adds its own spot statistics to the cube (and lines to the csv)
+            filename, pixels, roi_key = kinetics_queue.get()
+            self._wait_until_enabled(mp_namespace)
+            if self.spot_index is None:
+                raise RuntimeError("ROIs haven't been detected yet!")
+            elif self.spot_index.numSpots==0:
                 raise ValueError("No spots to use in kinetics!")
-            else:
-                spot_data = extract_spot_data(imageset, self.roi_labels, csvFileName = csvfile, kinetic=True)
-                # ~ print(f"adding kinetics data to {csvfile}")
+            cycle, wavelength = get_cycle_from_filename(filename), get_wavelength_from_filename(filename)
+            # spots that drifted out of the image are left out of moved ROIs
+            spot_index = self._get_rois(roi_key)[1]
+            with self._kinetics_lock:
+                if self.kinetics_cube is None:
+                    self.kinetics_cube = ZionKineticsCube(self.spot_index.spot_ids)
+                frame = self.kinetics_cube.add_frame(wavelength, cycle, get_time_from_filename(filename), spot_index.spot_stats(pixels), spot_ids=spot_index.spot_ids)
+                with open(csvfile, "a") as f:
+                    f.writelines(','.join(str(v) for v in row) + '\n' for row in self.kinetics_cube.get_rows(wavelength, frame))
+                if cycle != last_cycle and last_cycle is not None:
+                    self.kinetics_cube.save(self.file_output_path)
+            last_cycle = cycle
+            kinetics_analyzed_event.set()
 
 
     def _image_view_thread(self, mp_namespace : Namespace, image_viewer_queue : multiprocessing.Queue ):
         return
 
-    def add_to_convert_queue(self, fpath):
-        self.convert_files_queue.put_nowait( (fpath,) )
+    def add_to_convert_queue(self, fpath, frame_slot=None):
+        # the converter releases frame_slot once it's done with it
+        self.convert_files_queue.put_nowait( (fpath, frame_slot) )
         # ~ self.convert_files_queue.put( (fpath,) )
 
     def set_roi_params(self, median_ks, erode_ks, dilate_ks, threshold_scale, minSpotSize=None, maxSpotSize=None):
@@ -313,6 +728,11 @@ class ZionImageProcessor(multiprocessing.Process):
         self.mp_namespace.maxSpotSize = maxSpotSize
         self.mp_namespace.grayWeights = None
 
+    def set_background_subtraction(self, bEnable):
+        # applies from the next cycle _prefetch_cycles prepares
+        self.mp_namespace.bSubtractBg = bEnable
+        print(f"Background subtraction {'enabled' if bEnable else 'disabled'}")
+
     def set_basecall_params(self, p, q, r=0):
         self.mp_namespace.p = p
         self.mp_namespace.q = q
@@ -0,0 +1,93 @@
+import os
+import numpy as np
+
+from ImageProcessing.ZionData import df_cols
+
+'''
+    This module defines the ZionKineticsCube, the spot statistics of every frame of a session (for kinetics),
+    built up one frame at a time from the spot pixels gathered while converting (see ZionSpotIndex), so no frame
+    has to be decoded or loaded again as a whole image.
+    data is a (spots, frames, wavelengths, stats) array, frame t of a wavelength being its t-th capture in the session,
+    and stats the per spot statistics of ZionData.extract_spot_data (STAT_NAMES, ie df_cols from mean_R to max_B).
+    It's allocated CHUNK_FRAMES frames at a time, unfilled entries are nan.
+'''
+
+# ZionSpotIndex.spot_stats keys, in df_cols order
+KINETIC_STATS = ("mean_rgb", "median_rgb", "mean_hsv", "median_hsv", "std_rgb", "std_hsv", "min_rgb", "max_rgb")
+STAT_NAMES = df_cols[2:26]
+
+class ZionKineticsCube:
+
+    CHUNK_FRAMES = 32
+    FILENAME = "kinetics_cube.npz"
+
+    def __init__(self, spot_ids, wavelengths=()):
+        self.spot_ids = np.asarray(spot_ids)
+        self.wavelengths = []
+        self._wl_idx = dict()
+        self.data = np.full((self.spot_ids.size, self.CHUNK_FRAMES, 0, len(STAT_NAMES)), np.nan)
+        self.times = np.full((self.CHUNK_FRAMES, 0), -1, dtype=np.int64)
+        self.cycles = np.full((self.CHUNK_FRAMES, 0), -1, dtype=np.int32)
+        self.nFrames = np.zeros(0, dtype=np.int64) # per wavelength
+        for wl in wavelengths:
+            self._add_wavelength(wl)
+
+    @property
+    def capacity(self):
+        return self.data.shape[1]
+
+    def _resize(self, nFrames, nWls):
+        ''' Reallocates for nFrames frames and nWls wavelengths, copying what's there '''
+        data = np.full((self.spot_ids.size, nFrames, nWls, len(STAT_NAMES)), np.nan)
+        times = np.full((nFrames, nWls), -1, dtype=np.int64)
+        cycles = np.full((nFrames, nWls), -1, dtype=np.int32)
+        f, w = self.data.shape[1], self.data.shape[2]
+        data[:, :f, :w] = self.data
+        times[:f, :w] = self.times
+        cycles[:f, :w] = self.cycles
+        self.data, self.times, self.cycles = data, times, cycles
+
+    def _add_wavelength(self, wavelength):
+        self._wl_idx[wavelength] = len(self.wavelengths)
+        self.wavelengths.append(wavelength)
+        self.nFrames = np.append(self.nFrames, 0)
+        self._resize(self.capacity, len(self.wavelengths))
+        return self._wl_idx[wavelength]
+
+    def add_frame(self, wavelength, cycle, time, stats, spot_ids=None):
+        ''' Adds the spot_stats of a frame, returns its frame index.
+            spot_ids are the spots of stats if they're only some of the cube's (eg some drifted out of the image), the rest stay nan.
+        '''
+        w = self._wl_idx.get(wavelength)
+        if w is None:
+            w = self._add_wavelength(wavelength)
+        frame = self.nFrames[w]
+        if frame >= self.capacity:
+            self._resize(self.capacity + self.CHUNK_FRAMES, len(self.wavelengths))
+        values = np.concatenate([stats[key] for key in KINETIC_STATS], axis=1)
+        if spot_ids is None or np.array_equal(spot_ids, self.spot_ids):
+            self.data[:, frame, w, :] = values
+        else:
+            # both are sorted (see ZionSpotIndex)
+            self.data[np.searchsorted(self.spot_ids, spot_ids), frame, w, :] = values
+        self.times[frame, w] = time
+        self.cycles[frame, w] = -1 if cycle is None else cycle
+        self.nFrames[w] += 1
+        return frame
+
+    def get_rows(self, wavelength, frame):
+        ''' Lines of a frame like the kinetic ones of ZionData.extract_spot_data (roi, wavelength, stats, cycle, time) '''
+        w = self._wl_idx[wavelength]
+        cycle, time = self.cycles[frame, w], self.times[frame, w]
+        return [[f"spot_{s_idx:03d}", wavelength] + self.data[s_ind, frame, w].tolist() + [int(cycle), int(time)]
+                for s_ind, s_idx in enumerate(self.spot_ids)]
+
+    @property
+    def view(self):
+        ''' The filled part of data '''
+        return self.data[:, :self.nFrames.max(initial=0)]
+
+    def save(self, dir_path):
+        nFrames = self.nFrames.max(initial=0)
+        np.savez(os.path.join(dir_path, self.FILENAME), data=self.view, times=self.times[:nFrames], cycles=self.cycles[:nFrames],
+                 spot_ids=self.spot_ids, wavelengths=np.array(self.wavelengths), stat_names=np.array(STAT_NAMES))
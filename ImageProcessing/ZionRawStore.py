@@ -0,0 +1,171 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from ImageProcessing.raw_converter import Crop, decode_raw_buffer, get_decoded_shape, get_raw_geometry
+
+'''
+    This module defines the ZionRawStore, an append-only memory-mapped store of converted raw frames for a session.
+    It replaces one tif per frame in the raws directory:
+        raw_store.dat           frames back to back, (nFrames, H, W, C) uint16, grown CHUNK_FRAMES at a time
+        raw_store.json          frame shape, dtype, decode mode and crop (if frames are only part of the image, see raw_converter.Crop)
+        raw_store_index.csv     one line per frame: index,name,cycle,wavelength,time
+    The frame shape depends on the decode mode the store was created with (see raw_converter.DECODE_MODES)
+    and on the raw geometry of the captures, so the header is only written with the first frame.
+    The file is mapped chunk by chunk (the Pi is 32-bit, a whole session doesn't fit in its address space),
+    and frames are returned as views into the mapping, so nothing is copied or re-read.
+'''
+
+class ZionRawStore:
+
+    DATA_FILENAME = "raw_store.dat"
+    HEADER_FILENAME = "raw_store.json"
+    INDEX_FILENAME = "raw_store_index.csv"
+    CHUNK_FRAMES = 8
+    MAX_MAPPED_CHUNKS = 4
+
+    def __init__(self, dir_path, mode='rgb', dtype='uint16', readonly=False):
+        self.dir_path = dir_path
+        self.readonly = readonly
+        self._lock = threading.Lock()
+        self._chunks = OrderedDict()
+
+        self._header_path = os.path.join(dir_path, self.HEADER_FILENAME)
+        self.frame_shape = None
+        self.crop = None
+        if os.path.exists(self._header_path):
+            with open(self._header_path) as f:
+                header = json.load(f)
+            mode, dtype = header.get("mode", 'rgb'), header["dtype"]
+            self.mode = mode
+            self.dtype = np.dtype(dtype)
+            self._set_frame_shape(header["frame_shape"])
+            self.crop = Crop(**header["crop"]) if header.get("crop") is not None else None
+        elif readonly:
+            raise FileNotFoundError(f"No raw store in {dir_path}!")
+        else:
+            os.makedirs(dir_path, exist_ok=True)
+            self.mode = mode
+            self.dtype = np.dtype(dtype)
+
+        self.names = []
+        self.cycles = []
+        self.wavelengths = []
+        self.times = []
+        self._name_to_idx = dict()
+        self._cycle_wl_to_idx = dict()
+        index_path = os.path.join(dir_path, self.INDEX_FILENAME)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                for line in f:
+                    idx, name, cycle, wl, t = line.strip().split(',')
+                    self._add_to_index(name, int(cycle) if cycle else None, wl, int(t) if t else None)
+        self._data_path = os.path.join(dir_path, self.DATA_FILENAME)
+        if not readonly:
+            open(self._data_path, "ab").close()
+            self._index_file = open(index_path, "a")
+
+    @staticmethod
+    def exists(dir_path):
+        return os.path.exists(os.path.join(dir_path, ZionRawStore.HEADER_FILENAME))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._name_to_idx
+
+    def __getitem__(self, name):
+        ''' View of a frame by capture name (filename without directory or extension) '''
+        return self.get_frame(self._name_to_idx[name])
+
+    def _set_frame_shape(self, frame_shape):
+        self.frame_shape = tuple(frame_shape)
+        self._frame_bytes = int(np.prod(self.frame_shape)) * self.dtype.itemsize
+        self._chunk_bytes = self.CHUNK_FRAMES * self._frame_bytes
+
+    def _check_frame_shape(self, frame_shape, crop=None):
+        ''' Fixes the frame shape (and crop) with the first frame, after that all frames have to match it '''
+        if self.frame_shape is None:
+            self._set_frame_shape(frame_shape)
+            self.crop = crop
+            with open(self._header_path, "w") as f:
+                json.dump({"frame_shape": list(self.frame_shape), "dtype": str(self.dtype), "mode": self.mode,
+                           "crop": vars(crop) if crop is not None else None}, f)
+        elif tuple(frame_shape) != self.frame_shape:
+            raise ValueError(f"Frame of shape {tuple(frame_shape)} doesn't match the raw store's {self.frame_shape}!")
+        elif crop != self.crop:
+            raise ValueError(f"Frame cropped to {crop} doesn't match the raw store's {self.crop}!")
+
+    def _add_to_index(self, name, cycle, wavelength, time):
+        idx = len(self.names)
+        self.names.append(name)
+        self.cycles.append(cycle)
+        self.wavelengths.append(wavelength)
+        self.times.append(time)
+        self._name_to_idx[name] = idx
+        self._cycle_wl_to_idx.setdefault((cycle, wavelength), []).append(idx)
+        return idx
+
+    def _get_chunk(self, chunk_idx):
+        chunk = self._chunks.get(chunk_idx)
+        if chunk is None:
+            offset = chunk_idx * self._chunk_bytes
+            if not self.readonly and os.path.getsize(self._data_path) < offset + self._chunk_bytes:
+                with open(self._data_path, "r+b") as f:
+                    f.truncate(offset + self._chunk_bytes)
+            mode = 'r' if self.readonly else 'r+'
+            nFrames = min(self.CHUNK_FRAMES, (os.path.getsize(self._data_path) - offset) // self._frame_bytes)
+            chunk = np.memmap(self._data_path, dtype=self.dtype, mode=mode, offset=offset, shape=(nFrames,)+self.frame_shape)
+            self._chunks[chunk_idx] = chunk
+            # views handed out keep their own reference to the mapping, this only bounds what we hold on to
+            if len(self._chunks) > self.MAX_MAPPED_CHUNKS:
+                self._chunks.popitem(last=False)
+        else:
+            self._chunks.move_to_end(chunk_idx)
+        return chunk
+
+    def get_frame(self, idx):
+        with self._lock:
+            return self._get_chunk(idx // self.CHUNK_FRAMES)[idx % self.CHUNK_FRAMES]
+
+    def get_names(self, cycle, wavelength):
+        ''' Names of all frames of a wavelength in a cycle, in capture order '''
+        return [self.names[idx] for idx in self._cycle_wl_to_idx.get((cycle, wavelength), [])]
+
+    def get_wavelengths(self, cycle):
+        return sorted(set(wl for (c, wl) in self._cycle_wl_to_idx.keys() if c == cycle))
+
+    def append(self, name, cycle, wavelength, time, frame=None, buffer=None, calibration=None, crop=None):
+        ''' Adds a frame, either copying an image (frame) or decoding a jpeg+raw buffer directly into the mapping
+            (applying a ZionCalibration while decoding, if given). crop is the Crop the frame is (or is decoded) in.
+        '''
+        if self.readonly:
+            raise PermissionError("Raw store opened read-only!")
+        with self._lock:
+            self._check_frame_shape(get_decoded_shape(self.mode, get_raw_geometry(buffer), crop) if buffer is not None else frame.shape, crop)
+            idx = len(self.names)
+            slot = self._get_chunk(idx // self.CHUNK_FRAMES)[idx % self.CHUNK_FRAMES]
+            if buffer is not None:
+                dark, gain = (calibration.master_dark, calibration.gain) if calibration is not None else (None, None)
+                decode_raw_buffer(buffer, out=slot, mode=self.mode, dark=dark, gain=gain, crop=crop)
+            else:
+                slot[...] = frame
+            # index line only goes in once the data is there
+            self._add_to_index(name, cycle, wavelength, time)
+            cycle_str = "" if cycle is None else str(cycle)
+            time_str = "" if time is None else str(time)
+            self._index_file.write(f"{idx},{name},{cycle_str},{wavelength},{time_str}\n")
+            self._index_file.flush()
+        return slot
+
+    def close(self):
+        with self._lock:
+            for chunk in self._chunks.values():
+                if not self.readonly:
+                    chunk.flush()
+            self._chunks.clear()
+            if not self.readonly:
+                self._index_file.close()
@@ -0,0 +1,134 @@
+import os
+import json
+import numpy as np
+import cv2
+
+'''
+    This module defines the ZionRegistration, which estimates the stage drift of each cycle relative to the cycle the
+    ROIs were detected in, so the ROIs can follow the spots instead of being dilated enough to cover any drift.
+    Transforms are estimated on the UV channel downsampled by scale: a translation by FFT phase correlation, and in 'affine'
+    mode an affine transform refined from it by ECC (falling back to the translation if that doesn't converge).
+    A transform is a 2x3 matrix in full resolution coordinates, mapping reference pixel positions to the cycle's
+    (like cv2.warpAffine's forward matrix), so the label map is moved with shift_labels rather than warping every image.
+    Transforms are kept per cycle in registration.json, along with the downsampled reference in registration_reference.npy.
+'''
+
+REGISTRATION_MODES = ('translation', 'affine')
+
+def downsample_gray(img, scale):
+    ''' Mean of the channels of an image, area-downsampled by an integer factor, as float32 '''
+    img = np.asarray(img)
+    gray = img.mean(axis=2, dtype=np.float32) if img.ndim == 3 else img.astype(np.float32)
+    if scale > 1:
+        h, w = (gray.shape[0]//scale)*scale, (gray.shape[1]//scale)*scale
+        gray = cv2.resize(gray[:h,:w], (w//scale, h//scale), interpolation=cv2.INTER_AREA)
+    return gray
+
+def upscale_transform(transform, scale):
+    ''' Transform of downsampled images (see downsample_gray) in full resolution coordinates '''
+    transform = np.array(transform, dtype=np.float64)
+    # downsampled pixel i covers full resolution pixels scale*i to scale*i+scale-1
+    c = (scale - 1) / 2
+    A = transform[:,:2]
+    transform[:,2] = scale*transform[:,2] + c - A @ np.array([c, c])
+    return transform
+
+def get_transform_key(transform):
+    ''' Hashable (and reversible, see get_key_transform) version of a transform, as label maps are moved by:
+        whole pixel translations, or affine transforms to 4 decimals
+    '''
+    transform = np.asarray(transform)
+    # a linear part this close to identity moves pixels of a 2028 wide image by less than half a pixel
+    if np.abs(transform[:,:2] - np.eye(2)).max() < 2e-4:
+        return tuple(int(t) for t in np.round(transform[:,2]))
+    return tuple(np.round(transform, 4).ravel().tolist())
+
+def get_key_transform(key):
+    if len(key) == 2:
+        return np.array([[1, 0, key[0]], [0, 1, key[1]]], dtype=np.float64)
+    return np.array(key, dtype=np.float64).reshape(2, 3)
+
+def get_transform_distance(transform1, transform2, shape):
+    ''' Furthest two transforms put a corner of an image of shape (H, W) from each other, in pixels '''
+    corners = np.array([[0, 0, 1], [shape[1], 0, 1], [0, shape[0], 1], [shape[1], shape[0], 1]], dtype=np.float64).T
+    return np.linalg.norm((np.asarray(transform1) - np.asarray(transform2)) @ corners, axis=0).max()
+
+def shift_labels(labels, transform):
+    ''' Label map moved by a transform (nearest neighbour, nothing outside the image), labels that leave it are dropped '''
+    key = get_transform_key(transform)
+    if len(key) == 2: # whole pixel translation
+        dx, dy = key
+        h, w = labels.shape
+        shifted = np.zeros_like(labels)
+        if abs(dx) < w and abs(dy) < h:
+            shifted[max(dy,0):h+min(dy,0), max(dx,0):w+min(dx,0)] = labels[max(-dy,0):h+min(-dy,0), max(-dx,0):w+min(-dx,0)]
+        return shifted
+    # warpAffine has no int32 support, labels are exact in float32 up to 2**24
+    shifted = cv2.warpAffine(labels.astype(np.float32), np.asarray(transform, dtype=np.float64), (labels.shape[1], labels.shape[0]),
+                             flags=cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    return shifted.astype(labels.dtype)
+
+class ZionRegistration:
+
+    FILENAME = "registration.json"
+    REFERENCE_FILENAME = "registration_reference.npy"
+    # ECC iterations and convergence
+    ECC_CRITERIA = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 100, 1e-5)
+
+    def __init__(self, reference, scale=4, mode='translation', reference_cycle=1, bDownsampled=False):
+        if mode not in REGISTRATION_MODES:
+            raise ValueError(f"Unknown registration mode {mode}, should be one of {REGISTRATION_MODES}")
+        self.scale = scale
+        self.mode = mode
+        self.reference_cycle = reference_cycle
+        self.reference = reference if bDownsampled else downsample_gray(reference, scale)
+        self._window = cv2.createHanningWindow(self.reference.shape[::-1], cv2.CV_32F)
+        self.transforms = {reference_cycle : np.eye(2, 3)} # cycle -> 2x3 transform
+        self.responses = dict() # cycle -> phase correlation peak (~1 for a clean match, ~0 for none)
+
+    def estimate(self, img, cycle=None):
+        ''' Transform from the reference to an image (eg a cycle's first UV frame), kept for cycle if given '''
+        moving = downsample_gray(img, self.scale)
+        if moving.shape != self.reference.shape:
+            raise ValueError(f"Image of shape {np.shape(img)} doesn't match the registration reference!")
+        (dx, dy), response = cv2.phaseCorrelate(self.reference, moving, self._window)
+        transform = np.array([[1, 0, dx], [0, 1, dy]], dtype=np.float32)
+        if self.mode == 'affine':
+            try:
+                _, transform = cv2.findTransformECC(self.reference, moving, transform, cv2.MOTION_AFFINE, self.ECC_CRITERIA, None, 5)
+            except cv2.error as e:
+                print(f"Affine registration didn't converge, using translation ({e})")
+        transform = upscale_transform(transform, self.scale)
+        if cycle is not None:
+            self.transforms[cycle] = transform
+            self.responses[cycle] = response
+        return transform
+
+    def get(self, cycle):
+        return self.transforms.get(cycle)
+
+    @staticmethod
+    def exists(dir_path):
+        return os.path.exists(os.path.join(dir_path, ZionRegistration.FILENAME)) and os.path.exists(os.path.join(dir_path, ZionRegistration.REFERENCE_FILENAME))
+
+    def save(self, dir_path):
+        os.makedirs(dir_path, exist_ok=True)
+        np.save(os.path.join(dir_path, self.REFERENCE_FILENAME), self.reference)
+        self.save_transforms(dir_path)
+
+    def save_transforms(self, dir_path):
+        info = {"scale": self.scale, "mode": self.mode, "reference_cycle": self.reference_cycle,
+                "transforms": {str(c): t.tolist() for c, t in sorted(self.transforms.items())},
+                "responses": {str(c): r for c, r in sorted(self.responses.items())}}
+        with open(os.path.join(dir_path, self.FILENAME), "w") as f:
+            json.dump(info, f, indent=1)
+
+    @classmethod
+    def load(cls, dir_path):
+        with open(os.path.join(dir_path, cls.FILENAME)) as f:
+            info = json.load(f)
+        registration = cls(np.load(os.path.join(dir_path, cls.REFERENCE_FILENAME)), scale=info["scale"], mode=info["mode"],
+                           reference_cycle=info["reference_cycle"], bDownsampled=True)
+        registration.transforms.update({int(c): np.array(t) for c, t in info["transforms"].items()})
+        registration.responses.update({int(c): r for c, r in info.get("responses", dict()).items()})
+        return registration
@@ -0,0 +1,86 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+'''
+    This module defines ZionRois, the result of cycle 1's ROI detection (see ZionImage.detect_rois) kept in the processed
+    images directory: the spot labels (rois.npy), and in rois.json the detection parameters, a hash of the UV image they
+    were detected in, and the basis spots chosen for each base once they are.
+    When the application restarts mid-run or a session is processed again, detect_rois(bReuse=True) loads the labels back
+    instead of detecting them again if the parameters and the image are the same, and the image processor (or the notebook)
+    can skip choosing basis spots again if they were saved.
+'''
+
+def get_image_hash(img):
+    ''' Hash of an image's pixels, shape and dtype '''
+    img = np.ascontiguousarray(img)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{img.shape}{img.dtype}".encode())
+    h.update(img.data)
+    return h.hexdigest()
+
+def _normalize_params(params):
+    ''' Parameters as they read back from json (eg tuples as lists, numpy scalars as python ones) '''
+    return json.loads(json.dumps(params, default=lambda v: v.item() if isinstance(v, np.generic) else list(v)))
+
+class ZionRois:
+
+    FILENAME = "rois.json"
+    LABELS_FILENAME = "rois.npy"
+
+    def __init__(self, labels, numSpots, params, source_hash, basis_spotlists=None):
+        self.labels = labels
+        self.numSpots = numSpots
+        self.params = _normalize_params(params)
+        self.source_hash = source_hash
+        self.basis_spotlists = basis_spotlists # (A, C, G, T) lists of spot labels
+        self.bReused = False # loaded instead of detected
+
+    def matches(self, params, source_hash):
+        return self.source_hash == source_hash and self.params == _normalize_params(params)
+
+    @staticmethod
+    def exists(dir_path):
+        return os.path.exists(os.path.join(dir_path, ZionRois.FILENAME)) and os.path.exists(os.path.join(dir_path, ZionRois.LABELS_FILENAME))
+
+    def save(self, dir_path):
+        os.makedirs(dir_path, exist_ok=True)
+        np.save(os.path.join(dir_path, self.LABELS_FILENAME), self.labels)
+        self.save_info(dir_path)
+
+    def save_info(self, dir_path):
+        info = {"labels": self.LABELS_FILENAME, "shape": list(self.labels.shape), "numSpots": int(self.numSpots), "params": self.params,
+                "source_hash": self.source_hash, "basis_spotlists": [list(map(int, spots)) for spots in self.basis_spotlists] if self.basis_spotlists is not None else None}
+        with open(os.path.join(dir_path, self.FILENAME), "w") as f:
+            json.dump(info, f, indent=1)
+
+    def save_basis(self, dir_path, basis_spotlists):
+        self.basis_spotlists = tuple(list(spots) for spots in basis_spotlists)
+        self.save_info(dir_path)
+
+    @classmethod
+    def load(cls, dir_path):
+        with open(os.path.join(dir_path, cls.FILENAME)) as f:
+            info = json.load(f)
+        labels = np.load(os.path.join(dir_path, info["labels"]))
+        if list(labels.shape) != info["shape"]:
+            raise ValueError(f"ROI labels of shape {labels.shape} don't match their info {info['shape']}!")
+        basis_spotlists = tuple(info["basis_spotlists"]) if info.get("basis_spotlists") is not None else None
+        return cls(labels, info["numSpots"], info["params"], info["source_hash"], basis_spotlists=basis_spotlists)
+
+    @classmethod
+    def load_matching(cls, dir_path, params, source_hash):
+        ''' ROIs saved in dir_path if they were detected with the same parameters in the same image, otherwise None '''
+        if not cls.exists(dir_path):
+            return None
+        try:
+            rois = cls.load(dir_path)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Couldn't load ROIs from {dir_path} ({e}), detecting them again")
+            return None
+        if not rois.matches(params, source_hash):
+            print(f"ROIs in {dir_path} were detected with other parameters or in another image, detecting them again")
+            return None
+        rois.bReused = True
+        return rois
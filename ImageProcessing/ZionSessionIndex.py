@@ -0,0 +1,203 @@
+import os
+import threading
+from dataclasses import dataclass
+
+'''
+    This module defines the ZionSessionIndex, an index of the captures in a session directory (or of their converted
+    tifs in its raws directory) by cycle and wavelength, so the cycle, wavelength and time of a capture are parsed from
+    its filename once rather than with every lookup, and a cycle's frames don't have to be found by globbing.
+    Capture names (see ZionSession) look like
+        <capture count>_<protocol count>A_<count in protocol>_<group (wavelength)>[_C<cycle>]_<time in ms>
+    for protocol captures, and <capture count>_<protocol count>M_<count in protocol>_<time in ms>[_<suffix>] for manual ones.
+    The index is persisted as session_index_<ext>.csv in the directory, one line per capture (appended as captures are added),
+    so reopening a session lists the directory once, parsing the names of files that aren't in it yet and dropping deleted
+    ones. After that, whoever writes a capture adds it (eg ZionSession, the image processor's converter), lookups don't list
+    the directory again.
+'''
+
+@dataclass(frozen=True)
+class CaptureInfo:
+    name: str
+    cycle: int
+    wavelength: str
+    time: int
+
+def parse_capture_name(name):
+    ''' CaptureInfo of a capture name (no directory or extension), None if it isn't one '''
+    fields = name.split('_')
+    try:
+        if len(fields) >= 5 and fields[1].endswith('A'):
+            wavelength = fields[3]
+            if len(fields) >= 6 and fields[4].startswith('C'):
+                return CaptureInfo(name, int(fields[4][1:]), wavelength, int(fields[5]))
+            return CaptureInfo(name, None, wavelength, int(fields[4]))
+        if len(fields) >= 4 and fields[1].endswith('M'):
+            return CaptureInfo(name, None, None, int(fields[3]))
+    except ValueError:
+        pass
+    return None
+
+class ZionSessionIndex:
+
+    def __init__(self, dir_path, ext=".jpg", bPersist=True):
+        self.dir_path = dir_path
+        self.ext = ext
+        self.bPersist = bPersist
+        self._lock = threading.RLock()
+        self._captures = dict() # name -> CaptureInfo, in capture order
+        self._cycle_wl_names = dict() # cycle -> wavelength -> names in capture order
+        self._cycle_times = dict() # cycle -> [first time, last time]
+        self._index_file = None
+
+        self._index_path = os.path.join(dir_path, f"session_index_{ext.lstrip('.')}.csv")
+        saved_infos = []
+        if os.path.exists(self._index_path):
+            with open(self._index_path) as f:
+                for line in f:
+                    fields = line.rstrip('\n').split(',')
+                    if len(fields) != 4: # eg a line cut short by a crash
+                        continue
+                    name, cycle, wl, t = fields
+                    saved_infos.append(CaptureInfo(name, int(cycle) if cycle else None, wl if wl else None, int(t)))
+        # the directory is listed once here, later files are added as they're written (or with refresh)
+        names = self._list_names()
+        existing_names = set(names)
+        infos = [info for info in saved_infos if info.name in existing_names]
+        for info in infos:
+            self._add(info)
+        if len(infos) < len(saved_infos):
+            print(f"Dropping {len(saved_infos)-len(infos)} deleted files from the session index of {self.dir_path}")
+            self._rewrite()
+        self.refresh(names)
+
+    def __len__(self):
+        return len(self._captures)
+
+    def __contains__(self, name):
+        return name in self._captures
+
+    def __getitem__(self, name):
+        return self._captures[name]
+
+    def _add(self, info):
+        if info.name in self._captures:
+            return False
+        self._captures[info.name] = info
+        self._cycle_wl_names.setdefault(info.cycle, dict()).setdefault(info.wavelength, []).append(info.name)
+        if info.cycle is not None:
+            times = self._cycle_times.setdefault(info.cycle, [info.time, info.time])
+            times[0] = min(times[0], info.time)
+            times[1] = max(times[1], info.time)
+        return True
+
+    def _write(self, infos):
+        if not self.bPersist or not infos:
+            return
+        if self._index_file is None:
+            try:
+                self._index_file = open(self._index_path, "a")
+            except OSError as e: # eg a read-only copy of a session
+                print(f"Not saving the session index of {self.dir_path}: {e}")
+                self.bPersist = False
+                return
+        self._index_file.writelines(self._format(i) for i in infos)
+        self._index_file.flush()
+
+    @staticmethod
+    def _format(info):
+        return f"{info.name},{'' if info.cycle is None else info.cycle},{info.wavelength or ''},{info.time}\n"
+
+    def _rewrite(self):
+        ''' Replaces the saved index with the captures indexed now, eg without deleted files '''
+        if not self.bPersist:
+            return
+        tmp_path = self._index_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                f.writelines(self._format(i) for i in self._captures.values())
+            os.replace(tmp_path, self._index_path)
+        except OSError as e: # eg a read-only copy of a session
+            print(f"Not saving the session index of {self.dir_path}: {e}")
+            self.bPersist = False
+
+    def add(self, filepath):
+        ''' Adds a capture as it's written, returns its CaptureInfo (None if the name isn't a capture's) '''
+        name = os.path.splitext(os.path.basename(filepath))[0]
+        info = parse_capture_name(name)
+        if info is None:
+            return None
+        with self._lock:
+            if self._add(info):
+                self._write([info])
+        return info
+
+    def _list_names(self):
+        ''' Names of the directory's files with the index's extension, in name (ie capture count) order '''
+        if not os.path.isdir(self.dir_path):
+            return []
+        return sorted(name for name, ext in map(os.path.splitext, os.listdir(self.dir_path)) if ext == self.ext)
+
+    def refresh(self, names=None):
+        ''' Adds files of the directory (or names of its files) that aren't indexed yet, in name order '''
+        new_infos = []
+        with self._lock:
+            for name in (self._list_names() if names is None else names):
+                if name in self._captures:
+                    continue
+                info = parse_capture_name(name)
+                if info is not None and self._add(info):
+                    new_infos.append(info)
+            # files missing from the saved index (eg after a crash) can be older than the ones in it
+            for info in new_infos:
+                self._cycle_wl_names[info.cycle][info.wavelength].sort()
+            self._write(new_infos)
+
+    def get_path(self, name):
+        return os.path.join(self.dir_path, name+self.ext)
+
+    def get_names(self, cycle, wavelength):
+        ''' Names of all captures of a wavelength in a cycle, in capture order '''
+        return list(self._cycle_wl_names.get(cycle, dict()).get(wavelength, []))
+
+    def get_first(self, cycle, wavelength):
+        names = self._cycle_wl_names.get(cycle, dict()).get(wavelength)
+        return names[0] if names else None
+
+    def get_last(self, cycle, wavelength):
+        names = self._cycle_wl_names.get(cycle, dict()).get(wavelength)
+        return names[-1] if names else None
+
+    def get_wavelengths(self, cycle):
+        return sorted(wl for wl in self._cycle_wl_names.get(cycle, dict()).keys() if wl is not None)
+
+    @property
+    def cycles(self):
+        return sorted(self._cycle_times.keys())
+
+    def get_time_range(self, cycle):
+        ''' (first, last) capture time of a cycle in ms '''
+        return tuple(self._cycle_times[cycle])
+
+    def close(self):
+        with self._lock:
+            if self._index_file is not None:
+                self._index_file.close()
+                self._index_file = None
+
+# one index per directory in a process, eg shared by get_imageset_from_cycle and the image processor's converter
+_session_indices = dict()
+_session_indices_lock = threading.Lock()
+
+def get_session_index(dir_path, ext=".jpg", bRefresh=False):
+    ''' The process' index of a directory. Writers add their files to it (see ZionSessionIndex.add), with bRefresh
+        the directory is listed again for files another process wrote since.
+    '''
+    key = (os.path.abspath(dir_path), ext)
+    with _session_indices_lock:
+        index = _session_indices.get(key)
+        if index is None:
+            index = _session_indices[key] = ZionSessionIndex(dir_path, ext=ext)
+            return index
+    if bRefresh:
+        index.refresh()
+    return index
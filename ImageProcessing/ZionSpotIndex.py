@@ -0,0 +1,157 @@
+import numpy as np
+import pandas as pd
+
+from ImageProcessing.ZionData import df_cols, spot_rows_to_dataframe, rgb_to_hsv
+from ImageProcessing.ZionImage import get_wavelength_from_filename, get_time_from_filename, subtract_image
+from ImageProcessing.raw_converter import get_raw_geometry, get_raw_payload, apply_calibration
+
+'''
+    This module is a fast path for spot data once the ROIs are known (ie after cycle 1's detect_rois):
+    a ZionSpotIndex holds the byte offsets of every ROI pixel in the packed raw payload, so the pixels of a
+    capture's spots can be unpacked straight from its jpeg+raw buffer without decoding (or reading back) the whole frame.
+    The gathered pixels are bit-identical to the same pixels of the decoded 'rgb' image, and extract_spot_data gives
+    the same dataframe as ZionData.extract_spot_data does with a ZionImage (up to floating point rounding of means/stds).
+    ROI labels detected on cropped images (see raw_converter.Crop) are in crop coordinates, the index is made with the crop
+    so it gathers the same pixels from the whole raw frame.
+'''
+
+class ZionSpotSet:
+    '''
+    Spot pixels of a cycle's frames, arranged like a ZionImage (same dark/difference subtraction),
+    ie data[wavelength] is a (nPixels, 3) array in ZionSpotIndex order, uint16 unless diffDtype is given
+    '''
+    def __init__(self, lstNames, lstWavelengths, frame_pixels, cycle=None, subtrahends=None, bDarkCorrected=False, diffDtype=None, diffClamp=None):
+        self.data = dict()
+        self.times = []
+        wl_subs = [get_wavelength_from_filename(fp) for fp in subtrahends] if subtrahends is not None else []
+        dark = None
+        if subtrahends is None and not bDarkCorrected and '000' in lstWavelengths:
+            dark = frame_pixels[lstNames[lstWavelengths.index('000')]]
+        for wavelength, name in zip(lstWavelengths, lstNames):
+            if wavelength == '000':  #skip dark images
+                continue
+            pixels = frame_pixels[name]
+            dtype = pixels.dtype if diffDtype is None else diffDtype
+            if subtrahends is not None and wavelength in wl_subs:
+                pixels = subtract_image(pixels, frame_pixels[subtrahends[wl_subs.index(wavelength)]], np.empty(pixels.shape, dtype), clamp=diffClamp)
+            elif dark is not None:
+                pixels = subtract_image(pixels, dark, np.empty(pixels.shape, dtype), clamp=diffClamp)
+            else:
+                pixels = pixels.astype(dtype, copy=False)
+            self.data[wavelength] = pixels
+            self.times.append( get_time_from_filename(name) )
+        self.cycle = cycle
+        self.time_avg = round(sum(self.times)/len(self.times))
+
+    def __getitem__(self, wavelength):
+        return self.data[wavelength]
+
+    @property
+    def wavelengths(self):
+        return list(self.data.keys())
+
+class ZionSpotIndex:
+
+    def __init__(self, roi_labels, crop=None):
+        self.shape = roi_labels.shape
+        self.crop = crop
+        if crop is not None and self.shape != (crop.h, crop.w):
+            raise ValueError(f"ROI labels of shape {self.shape} don't match {crop}!")
+        ys, xs = np.nonzero(roi_labels)
+        labels = roi_labels[ys, xs]
+        # pixels sorted by spot label, so each spot is a contiguous segment
+        order = np.argsort(labels, kind='stable')
+        ys, xs, labels = ys[order], xs[order], labels[order]
+        self.spot_ids, self.starts, self.counts = np.unique(labels, return_index=True, return_counts=True)
+        self.nPixels = labels.size
+        self._segment_idx = np.repeat(np.arange(self.spot_ids.size), self.counts)
+        self._ys = ys.astype(np.int64)
+        self._xs = xs.astype(np.int64)
+        self._flat_indices = self._ys*self.shape[1] + self._xs
+        # payload byte offsets depend on the raw line length, so they're made for the geometry of the first buffer
+        self._geometry = None
+        self._byte_offsets = None
+        self._calibration = None
+        self._calibration_pixels = None
+
+    @property
+    def numSpots(self):
+        return self.spot_ids.size
+
+    def gather(self, buffer, out=None, calibration=None):
+        ''' Unpacks just the ROI pixels of a jpeg+raw buffer into a (nPixels, 3) uint16 array, same values as decode_raw_buffer
+            (with the same dark and flat field correction if a ZionCalibration is given)
+        '''
+        geometry = get_raw_geometry(buffer)
+        if geometry != self._geometry:
+            if self.crop is not None:
+                self.crop.check(geometry)
+            elif (geometry.img_h, geometry.img_w) != self.shape:
+                raise ValueError(f"ROI labels of shape {self.shape} don't match the raw image {(geometry.img_h, geometry.img_w)}!")
+            # every rgb pixel (y,x) comes from the 3-byte groups at x in raw lines 2y (G1 R) and 2y+1 (B G2)
+            bpl = geometry.bytes_per_line
+            y0, x0 = (self.crop.y, self.crop.x) if self.crop is not None else (0, 0)
+            group_offsets = 2*(self._ys+y0)*bpl + 3*(self._xs+x0)
+            self._byte_offsets = (group_offsets[:,None] + np.array([0, 1, 2, bpl, bpl+1, bpl+2])).ravel()
+            self._geometry = geometry
+        payload = get_raw_payload(buffer, geometry)
+        b = payload.take(self._byte_offsets).reshape(self.nPixels, 6).astype(np.uint16)
+        if out is None:
+            out = np.empty((self.nPixels, 3), dtype=np.uint16)
+        out[:,0] = ((b[:,1] << 4) | (b[:,2] >> 4)) << 4 # red
+        out[:,1] = (((b[:,0] << 4) | (b[:,2] & 0x0F)) << 3) + (((b[:,4] << 4) | (b[:,5] >> 4)) << 3) # green1 + green2
+        out[:,2] = ((b[:,3] << 4) | (b[:,5] & 0x0F)) << 4 # blue
+        if calibration is not None:
+            if calibration is not self._calibration:
+                self._calibration_pixels = calibration.take(self._flat_indices)
+                self._calibration = calibration
+            dark, gain = self._calibration_pixels
+            apply_calibration(out, dark, gain, out=out)
+        return out
+
+    def gather_image(self, img):
+        ''' ROI pixels of an already decoded 'rgb' image, in the same order as gather '''
+        return img.reshape(-1, img.shape[-1])[self._flat_indices]
+
+    def spot_stats(self, pixels):
+        ''' Per spot (nSpots, 3) arrays of the rgb and hsv statistics of extract_spot_data, from the gathered pixels.
+            Means and stds come from per-spot sums and sums of squares, min/max/median from the spot segments.
+        '''
+        stats = dict()
+        for space, values in (('rgb', pixels), ('hsv', rgb_to_hsv(pixels))):
+            values64 = values.astype(np.float64)
+            sums = np.add.reduceat(values64, self.starts, axis=0)
+            sumsqs = np.add.reduceat(values64**2, self.starts, axis=0)
+            mean = sums / self.counts[:,None]
+            stats[f"mean_{space}"] = mean
+            stats[f"std_{space}"] = np.sqrt(np.maximum(sumsqs / self.counts[:,None] - mean**2, 0))
+            # sort within each spot segment (spot index is the primary key) to pick medians
+            median = np.empty_like(mean)
+            lo = self.starts + (self.counts-1)//2
+            hi = self.starts + self.counts//2
+            for ch in range(3):
+                sorted_vals = values64[np.lexsort((values64[:,ch], self._segment_idx)), ch]
+                median[:,ch] = (sorted_vals[lo] + sorted_vals[hi]) / 2
+            stats[f"median_{space}"] = median
+        stats["min_rgb"] = np.minimum.reduceat(pixels, self.starts, axis=0)
+        stats["max_rgb"] = np.maximum.reduceat(pixels, self.starts, axis=0)
+        return stats
+
+    def extract_spot_data(self, spot_set, csvFileName=None, kinetic=False):
+        ''' Same as ZionData.extract_spot_data, for a ZionSpotSet '''
+        wl_stats = {w : self.spot_stats(spot_set[w]) for w in spot_set.wavelengths}
+        rows = []
+        for s_ind, s_idx in enumerate(self.spot_ids):
+            for w_ind, w in enumerate(spot_set.wavelengths):
+                st = wl_stats[w]
+                row = [f"spot_{s_idx:03d}", w]
+                for key in ("mean_rgb", "median_rgb", "mean_hsv", "median_hsv", "std_rgb", "std_hsv", "min_rgb", "max_rgb"):
+                    row.extend(st[key][s_ind].tolist())
+                row.append(int(spot_set.cycle))
+                row.append(int(spot_set.times[w_ind]) if kinetic else int(spot_set.time_avg))
+                rows.append(row)
+
+        if csvFileName is not None:
+            with open(csvFileName, "a") as f:
+                f.writelines(','.join(str(v) for v in row) + '\n' for row in rows)
+        return spot_rows_to_dataframe(pd.DataFrame(rows, columns=df_cols), spot_set.wavelengths)
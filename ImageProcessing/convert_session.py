@@ -0,0 +1,191 @@
+import os
+import time
+import argparse
+import multiprocessing
+from glob import glob
+
+from ImageProcessing.ZionImage import jpg_to_raw, get_cycle_from_filename, get_wavelength_from_filename, get_time_from_filename
+from ImageProcessing.ZionImageProcessor import ZionImageProcessor
+from ImageProcessing.ZionRawStore import ZionRawStore
+from ImageProcessing.ZionCalibration import ZionCalibration
+from ImageProcessing.raw_converter import Crop, has_raw_data, decode_raw_buffer, get_decoded_shape, get_raw_geometry, TIFF_COMPRESSIONS, DECODE_MODES
+
+'''
+    Command line tool to (re-)convert all jpeg+raw captures of a session directory into its raws directory,
+    spread over a process pool, eg (from the repository root):
+        python -m ImageProcessing.convert_session sessions/20230131_0955_TS_0192 [more session dirs...]
+    Frames go where the image processor (and get_imageset_from_cycle) reads them from: the session's ZionRawStore if it has
+    one (or with --store), which is rebuilt in capture order unless it already has every capture, otherwise one tif per capture,
+    skipping captures whose tif is newer than the jpeg. --force converts everything again.
+    The session's Crop (raws/crop.json, or the store's) and its ZionCalibration (in the processed images directory, for the
+    cycles it applies to) are applied like the processor did while capturing.
+'''
+
+def find_raw_captures(session_path):
+    ''' All jpegs in the session directory that have raw data appended (ie not manual captures) '''
+    return [fp for fp in sorted(glob(os.path.join(session_path, "*.jpg"))) if has_raw_data(fp)]
+
+def get_raw_target_path(filepath, raws_path):
+    return os.path.join(raws_path, os.path.splitext(os.path.basename(filepath))[0]+".tif")
+
+def is_up_to_date(source_path, target_path):
+    return os.path.exists(target_path) and os.path.getmtime(target_path) >= os.path.getmtime(source_path)
+
+def get_session_calibration(session_path):
+    ''' The ZionCalibration the image processor saved for a session, None if there isn't one '''
+    processed_path = os.path.join(session_path, f"processed_images_v{ZionImageProcessor.IMAGE_PROCESS_VERSION}")
+    return ZionCalibration.load(processed_path) if ZionCalibration.exists(processed_path) else None
+
+# calibration of a pool worker, set once by _init_worker rather than pickled with every capture
+_calibration = None
+
+def _init_worker(calibration):
+    global _calibration
+    _calibration = calibration
+
+def _get_frame_calibration(filepath, buffer, mode, crop):
+    ''' The worker's calibration if it applies to the capture's cycle (cropped like the image processor does), otherwise None '''
+    global _calibration
+    if _calibration is None or mode != 'rgb' or not _calibration.is_applied(get_cycle_from_filename(os.path.basename(filepath))):
+        return None
+    geometry = get_raw_geometry(buffer)
+    if crop is not None and _calibration.shape == get_decoded_shape('rgb', geometry): # a whole image calibration, eg from calibrationPath
+        _calibration = _calibration.crop(crop)
+    if _calibration.shape != get_decoded_shape('rgb', geometry, crop):
+        print(f"Not calibrating {filepath}, its size doesn't match the calibration's {_calibration.shape}")
+        return None
+    return _calibration
+
+def _convert_capture(args):
+    filepath, target_path, compression, level, mode, crop = args
+    try:
+        with open(filepath, "rb") as f:
+            buffer = f.read()
+        jpg_to_raw(filepath, target_path, buffer=buffer, compression=compression, level=level, mode=mode,
+                   calibration=_get_frame_calibration(filepath, buffer, mode, crop), crop=crop)
+    except (OSError, ValueError) as e:
+        return filepath, str(e)
+    return filepath, None
+
+def _decode_capture(args):
+    ''' Decoded frame of a capture for the raw store (the parent appends them in capture order), or the error '''
+    filepath, mode, crop = args
+    try:
+        with open(filepath, "rb") as f:
+            buffer = f.read()
+        calibration = _get_frame_calibration(filepath, buffer, mode, crop)
+        dark, gain = (calibration.master_dark, calibration.gain) if calibration is not None else (None, None)
+        return filepath, decode_raw_buffer(buffer, mode=mode, dark=dark, gain=gain, crop=crop), None
+    except (OSError, ValueError) as e:
+        return filepath, None, str(e)
+
+def rebuild_raw_store(raws_path, captures, jobs, mode, crop, calibration):
+    ''' Writes a new ZionRawStore of the captures next to the raws directory's, then replaces it. Returns the number failed. '''
+    build_path = os.path.join(raws_path, "raw_store_rebuild")
+    for filename in (ZionRawStore.DATA_FILENAME, ZionRawStore.HEADER_FILENAME, ZionRawStore.INDEX_FILENAME):
+        if os.path.exists(os.path.join(build_path, filename)):
+            os.remove(os.path.join(build_path, filename))
+    store = ZionRawStore(build_path, mode=mode)
+    captures = sorted(captures, key=lambda fp: get_time_from_filename(os.path.basename(fp))) # capture order, like the image processor appended them
+    failed = 0
+    t0 = time.perf_counter()
+    with multiprocessing.Pool(processes=jobs, initializer=_init_worker, initargs=(calibration,)) as pool:
+        # unlike imap_unordered, imap keeps that order, which the store's per cycle and wavelength frame lists rely on
+        for done, (filepath, frame, error) in enumerate(pool.imap(_decode_capture, [(fp, mode, crop) for fp in captures]), start=1):
+            if error is None:
+                name = os.path.splitext(os.path.basename(filepath))[0]
+                try:
+                    store.append(name, get_cycle_from_filename(name), get_wavelength_from_filename(name), get_time_from_filename(name), frame=frame, crop=crop)
+                except ValueError as e: # eg a capture with another raw geometry
+                    error = str(e)
+            if error is not None:
+                failed += 1
+                print(f"Failed to convert {filepath}: {error}")
+            if done % 50 == 0:
+                print(f"{done}/{len(captures)} frames, {done/(time.perf_counter()-t0):.2f} frames/s")
+    store.close()
+    for filename in (ZionRawStore.DATA_FILENAME, ZionRawStore.INDEX_FILENAME, ZionRawStore.HEADER_FILENAME):
+        if os.path.exists(os.path.join(build_path, filename)):
+            os.replace(os.path.join(build_path, filename), os.path.join(raws_path, filename))
+    os.rmdir(build_path)
+    return failed
+
+def convert_session(session_path, jobs=None, force=False, raws_path=None, compression=None, level=None, mode=None, bStore=False, bCalibrate=True):
+    ''' Converts a session's captures, into its raw store if it has one (or bStore), returns (number converted, number failed) '''
+    raws_path = os.path.join(session_path, "raws") if raws_path is None else raws_path
+    os.makedirs(raws_path, exist_ok=True)
+    jobs = os.cpu_count() if jobs is None else jobs
+
+    captures = find_raw_captures(session_path)
+    store = ZionRawStore(raws_path, readonly=True) if ZionRawStore.exists(raws_path) else None
+    crop = store.crop if store is not None else Crop.load(raws_path)
+    if crop is not None:
+        print(f"{session_path}: frames are cropped to {crop}")
+    calibration = get_session_calibration(session_path) if bCalibrate else None
+    if calibration is not None:
+        print(f"{session_path}: calibrating frames from cycle {calibration.first_cycle} on")
+
+    if store is not None or bStore:
+        if store is not None and mode is not None and mode != store.mode:
+            print(f"{session_path}: rebuilding the raw store in {mode} mode instead of {store.mode}")
+        mode = mode or (store.mode if store is not None else 'rgb')
+        if compression is not None:
+            print(f"{session_path}: the raw store is uncompressed, ignoring --compression")
+        if store is not None and not force and all(os.path.splitext(os.path.basename(fp))[0] in store for fp in captures) and store.mode == mode:
+            print(f"{session_path}: {len(captures)} raw captures, all already in the raw store")
+            return 0, 0
+        if store is not None:
+            store.close()
+        print(f"{session_path}: {len(captures)} raw captures, rebuilding the raw store")
+        if not captures:
+            return 0, 0
+        t0 = time.perf_counter()
+        failed = rebuild_raw_store(raws_path, captures, jobs, mode, crop, calibration)
+        todo = captures
+    else:
+        mode = mode or 'rgb'
+        todo = [(fp, get_raw_target_path(fp, raws_path)) for fp in captures]
+        if not force:
+            todo = [(fp, tp) for (fp, tp) in todo if not is_up_to_date(fp, tp)]
+        print(f"{session_path}: {len(captures)} raw captures, {len(captures)-len(todo)} already up to date, converting {len(todo)}")
+        if not todo:
+            return 0, 0
+
+        failed = 0
+        t0 = time.perf_counter()
+        with multiprocessing.Pool(processes=jobs, initializer=_init_worker, initargs=(calibration,)) as pool:
+            for done, (filepath, error) in enumerate(pool.imap_unordered(_convert_capture, [(fp, tp, compression, level, mode, crop) for (fp, tp) in todo]), start=1):
+                if error is not None:
+                    failed += 1
+                    print(f"Failed to convert {filepath}: {error}")
+                if done % 50 == 0:
+                    print(f"{done}/{len(todo)} frames, {done/(time.perf_counter()-t0):.2f} frames/s")
+    elapsed = time.perf_counter() - t0
+    print(f"{session_path}: converted {len(todo)-failed} frames ({failed} failed) in {elapsed:.1f} s -- {len(todo)/elapsed:.2f} frames/s with {jobs} processes")
+    return len(todo)-failed, failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert all jpeg+raw captures of session directories to raw tifs")
+    parser.add_argument("session_paths", nargs="+", help="session directories")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of processes (default: number of cores)")
+    parser.add_argument("-f", "--force", action="store_true", help="convert even if the tif (or raw store) is up to date")
+    parser.add_argument("-c", "--compression", choices=list(TIFF_COMPRESSIONS.keys()), default=None, help="lossless tif codec (default: none)")
+    parser.add_argument("-l", "--level", type=int, default=None, help="codec compression level")
+    parser.add_argument("-m", "--mode", choices=DECODE_MODES, default=None, help="decoded image layout (default: the raw store's, or rgb)")
+    parser.add_argument("-s", "--store", action="store_true", help="convert into a raw store even if the session doesn't have one")
+    parser.add_argument("--no-calibration", action="store_true", help="don't apply the session's saved dark/flat field calibration")
+    args = parser.parse_args()
+
+    total_frames = 0
+    total_failed = 0
+    t0 = time.perf_counter()
+    for session_path in args.session_paths:
+        converted, failed = convert_session(session_path, jobs=args.jobs, force=args.force, compression=args.compression, level=args.level, mode=args.mode,
+                                            bStore=args.store, bCalibrate=not args.no_calibration)
+        total_frames += converted
+        total_failed += failed
+    if len(args.session_paths) > 1:
+        elapsed = time.perf_counter() - t0
+        print(f"Total: {total_frames} frames ({total_failed} failed) in {elapsed:.1f} s -- {total_frames/elapsed:.2f} frames/s")
+    if total_failed:
+        raise SystemExit(1)
@@ -1,88 +1,434 @@
+import os
+import json
+import ctypes
+import struct
+from dataclasses import dataclass
+import numpy as np
+import cv2
+from tifffile import imwrite
+try:
+    import numba
+except ImportError:
+    numba = None
 
-# # All the following was ported to C so no longer necessary:
-
-# import os
-# import numpy as np
-# from tifffile import imread, imwrite
-
-# offset_from_end = 0x11D81FF #hexidecimal
-# hdr_size = 32768 #decimal
-# bytes_per_line = 6112
-# used_bytes_per_line = 6084
-# img_W = 4056//2
-# img_H = 3040//2
-
-# # ~ def get_wavelength_and_cycle_from_filename(filepath):
-    # # ~ splits = filepath.split('_')
-    # # ~ # TODO handle when cycle is missing because this'd be broken
-    # # ~ return splits[-3], splits[-2]
-
-# def get_wavelength_from_filename(filepath):
-    # return filepath.split('_')[-3]
-
-# def get_cycle_from_filename(filepath):
-    # cycle_str = filepath.split('_')[-2]
-    # if cycle_str[0]=='C':
-        # return int(cycle_str[1:])
-    # else:
-        # return None
-
-# def get_time_from_filename(filepath):
-    # return int( os.path.splitext(filepath)[0].split('_')[-1] )
-
-# def unpack_12_8_raw(line):
-# #  byte 0   byte 1   byte 2 
-# # AAAAAAAA BBBBBBBB BBBBAAAA
-    # color1 = []
-    # color2 = []
-    # for i in range(0,len(line),3):
-        # byte1 = line[i]<<4 | (line[i+2]&0X0F)
-        # byte2 = line[i+1]<<4 | ((line[i+2]>>4)&0X0F)
-        # color1.append(byte1)
-        # color2.append(byte2)
-    # return np.array(color1), np.array(color2)
-
-# def jpg_to_raw(filepath, target_path, compression=None):
-    
-    # # grab raw data from end of file:
-    # with open(filepath, "rb") as f:
-        # raw_data = f.read()
-    # raw_data = raw_data[-offset_from_end-1:]
-    # if not raw_data[:4] == b'BRCM':
-        # raise("Invalid JPG+RAW file! RAW data header not found.")
-    # raw_data = raw_data[hdr_size:]
-
-    # #initialize 16-bit rgb images, will reshape later
-    # red_image = np.zeros(dtype=np.uint16, shape=(img_W*img_H,))
-    # green_image = np.zeros(dtype=np.uint16, shape=(img_W*img_H,))
-    # blue_image = np.zeros(dtype=np.uint16, shape=(img_W*img_H,))
-
-    # for line in range(0,img_H):
-        # # Create references to data in both raw and img domains:
-        # raw_idx_bg = slice(bytes_per_line*(2*line), bytes_per_line*(2*line)+used_bytes_per_line)
-        # #print('bg row = ' + str(raw_idx_bg))
-        # raw_idx_gr = slice(bytes_per_line*(2*line+1), bytes_per_line*(2*line+1)+used_bytes_per_line)
-        # #print('gr row = ' + str(raw_idx_gr))
-        # img_idx = slice(line*img_W, (line+1)*img_W)
-
-        # # Process colors and unpack:
-        # green1, red = unpack_12_8_raw(raw_data[raw_idx_bg])
-        # blue, green2 = unpack_12_8_raw(raw_data[raw_idx_gr])
-
-        # red_image[img_idx] = red<<4 #12 bit to 16 bit
-        # blue_image[img_idx] = blue<<4 #12 bit to 16 bit
-        # green_image[img_idx] = (green1<<3) + (green2<<3) #combined averaging and 12 bit to 16 bit
-
-    # # Now reshape images and write to 16-bit color tiff:
-    # target_dir = os.path.dirname(target_path)
-    # if not os.path.exists(target_dir):
-        # os.mkdir(target_dir)
-        # print(f"Creating folder {target_dir}")
-    # filename =  os.path.splitext(target_path)[0]
-    # color_image = np.stack([red_image, green_image, blue_image], axis=-1).reshape((img_H, img_W, 3))
-    # imwrite(filename+".tif", color_image, photometric='rgb', compression=compression)
-    # # ~ print("Wrote file "+filename+".tif")
-
-    # #images available to return if desired:
-    # return red_image, green_image, blue_image
+'''
+    This module is the python-side interface to the raw converter in raw_convert_c.
+    The unpack kernel is loaded in-process (via ctypes) from libconvert_raw_c.so, which is built by the Makefile there,
+    so captured jpeg+raw buffers can be decoded directly from memory instead of forking the convert_raw_c binary per image.
+    The raw data geometry (sensor mode 2 or 3) is read from the BRCM header block of each capture, see get_raw_geometry.
+    Where the library isn't built (eg analysis workstations) the same unpacking is done with numba if it's installed,
+    otherwise with vectorized numpy, all giving bit-identical output (see tests/test_raw_converter.py and ZionBenchmarks check).
+    A Crop decodes just part of the image: only its lines (and the bytes of its columns in them) are unpacked.
+'''
+
+# These must match raw_convert_c/convert_raw_c.h
+# The fixed sizes are those of a full resolution (sensor mode 3) capture, which is the default geometry
+OFFSET_FROM_END = 0x11D81FF #hexidecimal
+HDR_SIZE = 32768 #decimal
+BYTES_PER_LINE = 6112
+USED_BYTES_PER_LINE = 6084
+IMG_W = 4056//2
+IMG_H = 3040//2
+ROWS_PER_STRIP = 16
+# BroadcomRawHeader (see picamera) width and height, relative to "BRCM"
+HDR_WIDTH_OFFSET = 208
+MAX_SENSOR_DIM = 8192
+MAX_PADDING_LINES = 64
+
+@dataclass(frozen=True)
+class RawGeometry:
+    ''' Layout of the 12-bit packed bayer data after a BRCM header block '''
+    width: int           # sensor pixels, ie twice the 'rgb' decoded image
+    height: int
+    bytes_per_line: int  # padded to 32 bytes
+    block_size: int      # bytes from "BRCM" to the end of the buffer
+
+    @property
+    def img_w(self):
+        return self.width//2
+
+    @property
+    def img_h(self):
+        return self.height//2
+
+    @property
+    def payload_size(self):
+        return self.block_size - HDR_SIZE
+
+DEFAULT_GEOMETRY = RawGeometry(2*IMG_W, 2*IMG_H, BYTES_PER_LINE, OFFSET_FROM_END+1)
+
+@dataclass(frozen=True)
+class Crop:
+    ''' Region of the 'rgb' decoded image (half sensor resolution) to decode, in pixels.
+        Images decoded with it are in crop coordinates, ie pixel (y, x) of the frame is (y - crop.y, x - crop.x) of the crop.
+    '''
+    y: int
+    x: int
+    h: int
+    w: int
+
+    FILENAME = "crop.json"
+
+    @classmethod
+    def from_normalized(cls, cropping, geometry=DEFAULT_GEOMETRY):
+        ''' Crop of a picamera zoom style (x, y, w, h) box in fractions of the sensor (see ZionCamera.capture),
+            grown to even pixels so 'binned' mode bins the same pixels it would in the whole image. None for the whole image.
+        '''
+        x, y, w, h = cropping
+        x0, y0 = int(x*geometry.img_w)//2*2, int(y*geometry.img_h)//2*2
+        x1 = min(-(-int(np.ceil((x+w)*geometry.img_w))//2)*2, geometry.img_w//2*2)
+        y1 = min(-(-int(np.ceil((y+h)*geometry.img_h))//2)*2, geometry.img_h//2*2)
+        if x1 <= x0 or y1 <= y0:
+            raise ValueError(f"Invalid cropping {cropping}!")
+        crop = cls(y0, x0, y1-y0, x1-x0)
+        return None if crop.is_whole(geometry) else crop
+
+    @property
+    def slices(self):
+        return (slice(self.y, self.y+self.h), slice(self.x, self.x+self.w))
+
+    def is_whole(self, geometry):
+        return (self.y, self.x) == (0, 0) and (self.h, self.w) == (geometry.img_h, geometry.img_w)
+
+    def check(self, geometry):
+        if self.y < 0 or self.x < 0 or self.h <= 0 or self.w <= 0 or self.y+self.h > geometry.img_h or self.x+self.w > geometry.img_w:
+            raise ValueError(f"{self} doesn't fit in the {geometry.img_h}x{geometry.img_w} image!")
+
+    @staticmethod
+    def exists(dir_path):
+        return os.path.exists(os.path.join(dir_path, Crop.FILENAME))
+
+    def save(self, dir_path):
+        with open(os.path.join(dir_path, self.FILENAME), "w") as f:
+            json.dump({"y": self.y, "x": self.x, "h": self.h, "w": self.w}, f)
+
+    @classmethod
+    def load(cls, dir_path):
+        ''' Crop saved in a directory (eg of frames decoded with it, or ROIs detected on them), None if there isn't one '''
+        if not cls.exists(dir_path):
+            return None
+        with open(os.path.join(dir_path, cls.FILENAME)) as f:
+            return cls(**json.load(f))
+
+# Decoder output modes:
+#   'rgb'    half resolution RGB, greens averaged (what convert_raw_c writes)
+#   'bayer'  half resolution raw planes R, G1, G2, B without averaging
+#   'binned' further 2x2 binned RGB, for fast previews/coarse intensities
+#   'full'   full sensor resolution (sensor mode 3) RGB, demosaiced
+DECODE_MODES = ('rgb', 'bayer', 'binned', 'full')
+
+# codec names accepted by convert_raw_c (and the raw_tiff_compression config key) -> tifffile compression
+TIFF_COMPRESSIONS = {'none': None, 'deflate': 'zlib', 'lzw': 'lzw', 'zstd': 'zstd'}
+
+RAW_CONVERT_C_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "raw_convert_c")
+RAW_CONVERT_LIB_PATH = os.path.join(RAW_CONVERT_C_DIR, "libconvert_raw_c.so")
+RAW_CONVERT_BINARY_PATH = os.path.join(RAW_CONVERT_C_DIR, "convert_raw_c")
+
+# unpack implementations, in order of preference
+UNPACK_BACKENDS = ('c', 'numba', 'numpy')
+
+_raw_convert_lib = None
+_raw_convert_lib_loaded = False
+
+def get_raw_convert_lib():
+    ''' Loads the shared library once per process, returns None if it hasn't been built '''
+    global _raw_convert_lib, _raw_convert_lib_loaded
+    if not _raw_convert_lib_loaded:
+        _raw_convert_lib_loaded = True
+        try:
+            lib = ctypes.CDLL(RAW_CONVERT_LIB_PATH)
+        except OSError as e:
+            print(f"Could not load {RAW_CONVERT_LIB_PATH} ({e}), run 'make' in {RAW_CONVERT_C_DIR}")
+        else:
+            lib.unpack_raw_rgb.argtypes = [ctypes.POINTER(ctypes.c_uint8), ctypes.POINTER(ctypes.c_uint16), ctypes.c_int, ctypes.c_int, ctypes.c_int]
+            lib.unpack_raw_rgb.restype = ctypes.c_int
+            lib.unpack_raw_bayer.argtypes = [ctypes.POINTER(ctypes.c_uint8), ctypes.POINTER(ctypes.c_uint16), ctypes.c_int, ctypes.c_int, ctypes.c_int]
+            lib.unpack_raw_bayer.restype = ctypes.c_int
+            lib.unpack_raw_rgb_calibrated.argtypes = [ctypes.POINTER(ctypes.c_uint8), ctypes.POINTER(ctypes.c_uint16), ctypes.POINTER(ctypes.c_uint16), ctypes.POINTER(ctypes.c_float), ctypes.c_int, ctypes.c_int, ctypes.c_int]
+            lib.unpack_raw_rgb_calibrated.restype = ctypes.c_int
+            _raw_convert_lib = lib
+    return _raw_convert_lib
+
+def parse_raw_header(buf, pos):
+    ''' RawGeometry of a plausible BRCM header block at pos of buf (a byte memoryview), otherwise None.
+        Same checks as parse_raw_header in convert_raw_c: the payload after the header has to hold whole padded lines,
+        and not many more than the image height (the HQ camera only gives 12-bit data).
+    '''
+    buf_len = buf.nbytes
+    if pos < 0 or pos + HDR_SIZE > buf_len or buf[pos:pos+4] != b'BRCM':
+        return None
+    width, height = struct.unpack_from('<HH', buf, pos+HDR_WIDTH_OFFSET)
+    if not (0 < width <= MAX_SENSOR_DIM and 0 < height <= MAX_SENSOR_DIM) or width % 2 or height % 2:
+        return None
+    bytes_per_line = (width*3//2 + 31) // 32 * 32
+    lines, remainder = divmod(buf_len - pos - HDR_SIZE, bytes_per_line)
+    if remainder or not height <= lines <= height + MAX_PADDING_LINES:
+        return None
+    return RawGeometry(width, height, bytes_per_line, buf_len - pos)
+
+# geometries found so far, checked before searching a buffer (there's usually only one per session)
+_known_geometries = [DEFAULT_GEOMETRY]
+
+def get_raw_geometry(buffer):
+    ''' Finds and validates the raw header of a jpeg+raw buffer, returns its RawGeometry.
+        Known geometries are checked first, so searching the buffer only happens once per camera configuration.
+    '''
+    buf = memoryview(buffer).cast('B')
+    buf_len = buf.nbytes
+    for geometry in _known_geometries:
+        if parse_raw_header(buf, buf_len - geometry.block_size) == geometry:
+            return geometry
+    # search back from the end, skipping any "BRCM" that doesn't have a valid header
+    data = buffer if isinstance(buffer, (bytes, bytearray)) else buf.tobytes()
+    pos = buf_len
+    while True:
+        pos = data.rfind(b'BRCM', 0, pos)
+        if pos < 0:
+            raise ValueError("Invalid JPG+RAW buffer! RAW data header not found.")
+        geometry = parse_raw_header(buf, pos)
+        if geometry is not None:
+            print(f"Found raw data geometry {geometry}")
+            _known_geometries.append(geometry)
+            return geometry
+
+def get_raw_payload(buffer, geometry=None):
+    ''' Returns a uint8 array viewing (not copying) the packed bayer data at the end of a jpeg+raw buffer.
+        buffer can be anything supporting the buffer protocol (bytes, bytearray, memoryview, mmap...)
+    '''
+    if geometry is None:
+        geometry = get_raw_geometry(buffer)
+    buf = memoryview(buffer).cast('B')
+    return np.frombuffer(buf, dtype=np.uint8, count=geometry.payload_size, offset=buf.nbytes-geometry.payload_size)
+
+def get_crop_geometry(geometry, crop):
+    ''' Geometry to unpack a crop with, from the start of its payload (see get_crop_payload): lines keep their length '''
+    if crop is None:
+        return geometry
+    crop.check(geometry)
+    return RawGeometry(2*crop.w, 2*crop.h, geometry.bytes_per_line, geometry.block_size)
+
+def get_crop_payload(payload, geometry, crop):
+    ''' View of the packed data from the crop's first byte, and the geometry to unpack it with '''
+    if crop is None:
+        return payload, geometry
+    crop_geometry = get_crop_geometry(geometry, crop)
+    # rgb pixel (y,x) comes from the 3-byte groups at x in raw lines 2y and 2y+1
+    return payload[2*crop.y*geometry.bytes_per_line + 3*crop.x:], crop_geometry
+
+def get_decoded_shape(mode='rgb', geometry=DEFAULT_GEOMETRY, crop=None):
+    geometry = get_crop_geometry(geometry, crop)
+    img_h, img_w = geometry.img_h, geometry.img_w
+    if mode == 'rgb':
+        return (img_h, img_w, 3)
+    elif mode == 'bayer':
+        return (img_h, img_w, 4)
+    elif mode == 'binned':
+        return (img_h//2, img_w//2, 3)
+    elif mode == 'full':
+        return (2*img_h, 2*img_w, 3)
+    else:
+        raise ValueError(f"Invalid decode mode {mode}!")
+
+def _get_out_array(out, shape):
+    if out is None:
+        return np.empty(shape, dtype=np.uint16)
+    elif out.shape != shape or out.dtype != np.uint16 or not out.flags.c_contiguous:
+        raise ValueError(f"Output array must be C-contiguous uint16 with shape {shape}")
+    return out
+
+def _call_kernel(kernel, payload, out, geometry):
+    ret = kernel(payload.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8)), out.ctypes.data_as(ctypes.POINTER(ctypes.c_uint16)), geometry.img_w, geometry.img_h, geometry.bytes_per_line)
+    if ret != 0:
+        raise OSError(f"Raw unpacking failed with error {ret}")
+    return out
+
+def get_unpack_backend():
+    ''' First available of UNPACK_BACKENDS '''
+    if get_raw_convert_lib() is not None:
+        return 'c'
+    elif numba is not None:
+        return 'numba'
+    return 'numpy'
+
+def _get_packed_lines(payload, geometry):
+    ''' (height, 3*img_w) view of the used bytes of each raw line, ie without the padding (or the columns outside a crop) '''
+    if payload.size < (geometry.height-1)*geometry.bytes_per_line + 3*geometry.img_w:
+        raise ValueError("Raw payload too short for its geometry!")
+    return np.lib.stride_tricks.as_strided(payload, shape=(geometry.height, 3*geometry.img_w), strides=(geometry.bytes_per_line, 1), writeable=False)
+
+def unpack_12_8_raw(lines):
+    ''' Unpacks 12-bit packed lines (..., 3*n) into their even and odd pixels, each (..., n) uint16
+        byte 0   byte 1   byte 2
+        AAAAAAAA BBBBBBBB BBBBAAAA
+    '''
+    byte0 = lines[..., 0::3].astype(np.uint16)
+    byte1 = lines[..., 1::3].astype(np.uint16)
+    byte2 = lines[..., 2::3]
+    color1 = (byte0 << 4) | (byte2 & 0x0F)
+    color2 = (byte1 << 4) | (byte2 >> 4)
+    return color1, color2
+
+def unpack_raw_rgb_numpy(payload, out, geometry):
+    ''' Same as unpack_raw_rgb in convert_raw_c, on whole arrays '''
+    lines = _get_packed_lines(payload, geometry)
+    green1, red = unpack_12_8_raw(lines[0::2])
+    blue, green2 = unpack_12_8_raw(lines[1::2])
+    np.left_shift(red, 4, out=out[:,:,0])
+    np.add(green1 << 3, green2 << 3, out=out[:,:,1]) #combined averaging and 12 bit to 16 bit
+    np.left_shift(blue, 4, out=out[:,:,2])
+    return out
+
+def unpack_raw_bayer_numpy(payload, out, geometry):
+    ''' Same as unpack_raw_bayer in convert_raw_c, on whole arrays '''
+    out[:, 0::2], out[:, 1::2] = unpack_12_8_raw(_get_packed_lines(payload, geometry))
+    return out
+
+def _unpack_raw_rgb_loops(payload, out, img_w, img_h, bytes_per_line):
+    # line by line port of unpack_raw_rgb, only meant to be compiled by numba
+    for l in range(img_h):
+        even = 2*l*bytes_per_line
+        odd = even + bytes_per_line
+        for p in range(img_w):
+            i = 3*p
+            green1 = (np.uint16(payload[even+i]) << 4) | (payload[even+i+2] & 0x0F)
+            red = (np.uint16(payload[even+i+1]) << 4) | (payload[even+i+2] >> 4)
+            blue = (np.uint16(payload[odd+i]) << 4) | (payload[odd+i+2] & 0x0F)
+            green2 = (np.uint16(payload[odd+i+1]) << 4) | (payload[odd+i+2] >> 4)
+            out[l, p, 0] = red << 4
+            out[l, p, 1] = (green1 << 3) + (green2 << 3)
+            out[l, p, 2] = blue << 4
+
+def _unpack_raw_bayer_loops(payload, out, img_w, img_h, bytes_per_line):
+    for l in range(2*img_h):
+        start = l*bytes_per_line
+        for p in range(img_w):
+            i = start + 3*p
+            out[l, 2*p] = (np.uint16(payload[i]) << 4) | (payload[i+2] & 0x0F)
+            out[l, 2*p+1] = (np.uint16(payload[i+1]) << 4) | (payload[i+2] >> 4)
+
+if numba is not None:
+    _unpack_raw_rgb_numba = numba.njit(cache=True)(_unpack_raw_rgb_loops)
+    _unpack_raw_bayer_numba = numba.njit(cache=True)(_unpack_raw_bayer_loops)
+
+def _unpack(kernel, payload, out, geometry, backend):
+    ''' Runs the 'rgb' or 'bayer' unpack kernel with the given backend '''
+    if backend == 'c':
+        lib = get_raw_convert_lib()
+        if lib is None:
+            raise OSError(f"Raw converter library {RAW_CONVERT_LIB_PATH} not available!")
+        return _call_kernel(lib.unpack_raw_rgb if kernel == 'rgb' else lib.unpack_raw_bayer, payload, out, geometry)
+    elif backend == 'numba':
+        if numba is None:
+            raise OSError("numba is not installed!")
+        (_unpack_raw_rgb_numba if kernel == 'rgb' else _unpack_raw_bayer_numba)(payload, out, geometry.img_w, geometry.img_h, geometry.bytes_per_line)
+        return out
+    elif backend == 'numpy':
+        return unpack_raw_rgb_numpy(payload, out, geometry) if kernel == 'rgb' else unpack_raw_bayer_numpy(payload, out, geometry)
+    else:
+        raise ValueError(f"Invalid unpack backend {backend}!")
+
+def bin_2x2(img, out=None):
+    ''' Averages 2x2 pixel blocks of a (H, W, C) uint16 image (exact integer mean, rounded down) '''
+    h, w, c = img.shape
+    binned = img.reshape(h//2, 2, w//2, 2, c).sum(axis=(1,3), dtype=np.uint32) >> 2
+    if out is None:
+        return binned.astype(np.uint16)
+    np.copyto(out, binned, casting='unsafe')
+    return out
+
+def apply_calibration(img, dark, gain=None, out=None):
+    ''' Subtracts a dark image with saturation at 0 and optionally multiplies by a float32 gain (ie inverse flat field),
+        rounding and clamping to 16 bits. Same arithmetic as unpack_raw_rgb_calibrated, for any matching uint16 arrays.
+    '''
+    if gain is None:
+        return cv2.subtract(img, dark, dst=out) # saturates for unsigned types
+    values = np.subtract(img, dark, dtype=np.float32)
+    np.maximum(values, 0, out=values)
+    values *= gain
+    values += np.float32(0.5)
+    np.minimum(values, 65535, out=values)
+    if out is None:
+        return values.astype(np.uint16)
+    np.copyto(out, values, casting='unsafe')
+    return out
+
+def decode_raw_buffer(buffer, out=None, mode='rgb', backend=None, dark=None, gain=None, crop=None):
+    ''' Decodes the raw data of a jpeg+raw buffer into a 16-bit image of get_decoded_shape(mode, crop=crop) (see DECODE_MODES).
+        The default 'rgb' mode is identical to what convert_raw_c writes to its tiff.
+        Optionally decodes into a preallocated out array. backend is one of UNPACK_BACKENDS, by default the first available.
+        In 'rgb' mode a dark image (and gain) can be applied while decoding, see apply_calibration.
+        With a Crop, only its region is unpacked (dark and gain have the crop's shape then).
+    '''
+    backend = get_unpack_backend() if backend is None else backend
+    geometry = get_raw_geometry(buffer)
+    payload, geometry = get_crop_payload(get_raw_payload(buffer, geometry), geometry, crop)
+    out = _get_out_array(out, get_decoded_shape(mode, geometry))
+
+    if dark is not None:
+        if mode != 'rgb':
+            raise ValueError(f"Calibration can't be applied in {mode} mode!")
+        if dark.shape != out.shape or dark.dtype != np.uint16 or not dark.flags.c_contiguous:
+            raise ValueError(f"Dark image must be C-contiguous uint16 with shape {out.shape}")
+        if gain is not None and (gain.shape != out.shape or gain.dtype != np.float32 or not gain.flags.c_contiguous):
+            raise ValueError(f"Gain image must be C-contiguous float32 with shape {out.shape}")
+        if backend == 'c':
+            lib = get_raw_convert_lib()
+            ret = lib.unpack_raw_rgb_calibrated(payload.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8)), out.ctypes.data_as(ctypes.POINTER(ctypes.c_uint16)),
+                                                dark.ctypes.data_as(ctypes.POINTER(ctypes.c_uint16)), gain.ctypes.data_as(ctypes.POINTER(ctypes.c_float)) if gain is not None else None,
+                                                geometry.img_w, geometry.img_h, geometry.bytes_per_line)
+            if ret != 0:
+                raise OSError(f"Raw unpacking failed with error {ret}")
+            return out
+        return apply_calibration(_unpack('rgb', payload, out, geometry, backend), dark, gain, out=out)
+
+    if mode == 'rgb':
+        return _unpack('rgb', payload, out, geometry, backend)
+    elif mode == 'binned':
+        # Same as binning 4x4 blocks of the bayer mosaic
+        return bin_2x2(_unpack('rgb', payload, np.empty(get_decoded_shape('rgb', geometry), dtype=np.uint16), geometry, backend), out=out)
+
+    mosaic = _unpack('bayer', payload, np.empty((geometry.height, geometry.width), dtype=np.uint16), geometry, backend)
+    if mode == 'bayer':
+        for ch, (row, col) in enumerate( ((0,1), (0,0), (1,1), (1,0)) ): # R, G1, G2, B
+            np.left_shift(mosaic[row::2, col::2], 4, out=out[:,:,ch])
+    else: # full
+        # opencv names bayer patterns by the second row, so our G R / B G layout is its "GB"
+        np.left_shift(mosaic, 4, out=mosaic)
+        cv2.cvtColor(mosaic, cv2.COLOR_BayerGB2RGB, dst=out)
+    return out
+
+def write_raw_tiff(target_path, img, compression=None, level=None):
+    ''' Writes a decoded image the same way convert_raw_c does: 16-bit RGB in ROWS_PER_STRIP strips,
+        optionally with a lossless codec (see TIFF_COMPRESSIONS) plus horizontal predictor.
+        Images that aren't RGB (eg 'bayer' mode planes) are written as contiguous multi-sample grayscale.
+    '''
+    photometric = 'rgb' if img.shape[-1] == 3 else 'minisblack'
+    codec = TIFF_COMPRESSIONS[compression or 'none']
+    if codec is None:
+        imwrite(target_path, img, photometric=photometric, planarconfig='contig', rowsperstrip=ROWS_PER_STRIP)
+    else:
+        compressionargs = {'level': level} if level is not None and level > 0 else None
+        imwrite(target_path, img, photometric=photometric, planarconfig='contig', rowsperstrip=ROWS_PER_STRIP, compression=codec, compressionargs=compressionargs, predictor=True)
+
+def has_raw_data(filepath):
+    ''' Checks for a BRCM raw header of any known geometry, without reading the whole file (unless none match) '''
+    try:
+        with open(filepath, "rb") as f:
+            file_len = f.seek(0, os.SEEK_END)
+            for geometry in _known_geometries:
+                if file_len >= geometry.block_size:
+                    f.seek(file_len - geometry.block_size)
+                    header = f.read(HDR_WIDTH_OFFSET+4)
+                    if header[:4] == b'BRCM' and struct.unpack_from('<HH', header, HDR_WIDTH_OFFSET) == (geometry.width, geometry.height):
+                        return True
+            f.seek(0)
+            get_raw_geometry(f.read())
+            return True
+    except (OSError, ValueError, struct.error):
+        return False
+
+def decode_raw_file(filepath, out=None, mode='rgb', backend=None, dark=None, gain=None, crop=None):
+    with open(filepath, "rb") as f:
+        buffer = f.read()
+    return decode_raw_buffer(buffer, out=out, mode=mode, backend=backend, dark=dark, gain=gain, crop=crop)
 
@@ -86,3 +86,45 @@ def read_config_file():
                 else:
                     print(f"Skipping parameter, too many colons in line {line}")
     return cfg
+
+# Config values are read as stripped strings (see read_config_file), defaults given in the code can be python values.
+
+TRUE_STRINGS = ("1", "true", "yes", "on")
+FALSE_STRINGS = ("0", "false", "no", "off")
+
+def parse_bool(value):
+    value = str(value).strip().lower()
+    if value in TRUE_STRINGS:
+        return True
+    if value in FALSE_STRINGS:
+        return False
+    raise ValueError(f"Invalid boolean config value '{value}', expected one of {TRUE_STRINGS + FALSE_STRINGS}")
+
+def parse_numbers(value, cast=float, n=None):
+    ''' Tuple of a comma separated value like "0.1, 0.1, 0.8, 0.8" (optionally in brackets), or of a tuple or list.
+        n is the number of values expected.
+    '''
+    if isinstance(value, str):
+        value = [v for v in value.strip().strip("()[]").split(',')]
+    try:
+        numbers = tuple(cast(v) for v in value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid config value '{value}', expected comma separated numbers")
+    if n is not None and len(numbers) != n:
+        raise ValueError(f"Invalid config value '{value}', expected {n} numbers")
+    return numbers
+
+def parse_optional(value, cast=str):
+    ''' None for a missing, empty or "None" value, otherwise cast(value) '''
+    if value is None or str(value).strip().lower() in ("", "none"):
+        return None
+    return cast(value)
+
+def parse_number(value):
+    ''' int if the value is a whole number, otherwise float, eg for bounds of integer images '''
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+def parse_bounds(value):
+    ''' (low, high) of a value like "0, 4095", either can be None (eg "0, None"), None for no bounds at all '''
+    return parse_optional(value, lambda v: parse_numbers(v, lambda b: parse_optional(b, parse_number), 2))
@@ -22,7 +22,7 @@ import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, GLib
 
-from ZionConfig import ZionConfig
+from ZionConfig import ZionConfig, parse_bool, parse_numbers, parse_bounds, parse_optional
 from Camera.ZionCamera import ZionCamera, ZionCameraParameters
 from GPIO.ZionGPIO import ZionGPIO
 from Protocol.ZionProtocols import ZionProtocol
@@ -30,6 +30,8 @@ from Protocol.ZionEvents import ZionEvent
 from GUI.ZionGtk import ZionGUI
 from ImageProcessing.ZionImage import ZionImage, jpg_to_raw, get_cycle_from_filename
 from ImageProcessing.ZionImageProcessor import ZionImageProcessor
+from ImageProcessing.ZionFrameRing import ZionFrameSlot
+from ImageProcessing.ZionSessionIndex import ZionSessionIndex
 
 # ~ mod_path = os.path.dirname(os.path.abspath(__file__))
 
@@ -67,7 +69,9 @@ class ZionSession():
         self.Dir = os.path.join(self.SessionsDir, f"{filename}_{lastSuffix+1:04d}")
         print('Creating directory '+str(self.Dir))
         os.makedirs(self.Dir)
-        
+        # captures by cycle and wavelength, added to as they're written
+        self.session_index = ZionSessionIndex(self.Dir)
+
         self.Temperature = None
         self.Camera = ZionCamera(Binning, Initial_Values, parent=self)
         self.GPIO = ZionGPIO(parent=self, PID_Params=PID_Params)
@@ -87,13 +91,42 @@ class ZionSession():
         self.update_last_capture_lock = threading.Lock()
 
         self.all_image_paths = []
-        self.ImageProcessor = ZionImageProcessor(self.gui, self.Dir)
+        raw_compression_level = self.Config.get("raw_tiff_compression_level")
+        # picamera zoom style (x, y, w, h) box the camera captures and the image processor decodes (see raw_converter.Crop)
+        self.Cropping = parse_numbers(self.Config.get("cropping", (0,0,1,1)), float, 4)
+        if not all(0 <= v <= 1 for v in self.Cropping):
+            raise ValueError(f"Invalid cropping {self.Cropping}, its (x, y, w, h) must be fractions of the sensor in [0, 1]")
+        self.ImageProcessor = ZionImageProcessor(self.gui, self.Dir, nFrameSlots=int(self.Config.get("frame_ring_slots", 6)),
+                                                 rawCompression=self.Config.get("raw_tiff_compression"),
+                                                 rawCompressionLevel=int(raw_compression_level) if raw_compression_level is not None else None,
+                                                 rawMode=self.Config.get("raw_decode_mode", "rgb"),
+                                                 calibrationPath=self.Config.get("calibration_path"),
+                                                 nDarkFrames=int(self.Config.get("calibration_dark_frames", 5)),
+                                                 flatWavelength=self.Config.get("calibration_flat_wavelength"),
+                                                 nFlatFrames=int(self.Config.get("calibration_flat_frames", 5)),
+                                                 imageCacheMB=parse_optional(self.Config.get("image_cache_mb"), float),
+                                                 nLoadThreads=parse_optional(self.Config.get("image_load_threads"), int),
+                                                 diffDtype=self.Config.get("difference_dtype"),
+                                                 diffClamp=parse_bounds(self.Config.get("difference_clamp")),
+                                                 bgRadius=int(self.Config.get("background_radius", 64)),
+                                                 bKinetics=parse_bool(self.Config.get("kinetics", True)),
+                                                 registrationMode=parse_optional(self.Config.get("registration_mode", "translation")),
+                                                 registrationScale=int(self.Config.get("registration_scale", 4)),
+                                                 cropping=self.Cropping if self.Cropping != (0,0,1,1) else None,
+                                                 nPrefetchCycles=int(self.Config.get("prefetch_cycles", 2)),
+                                                 prefetchMB=parse_optional(self.Config.get("prefetch_mb", 256), float), # None is unbounded
+                                                 bCompactLabels=parse_bool(self.Config.get("compact_roi_labels", False)),
+                                                 medianBackend=self.Config.get("median_backend", "disk"),
+                                                 detectScale=int(self.Config.get("roi_detect_scale", 1)),
+                                                 morphologyMode=self.Config.get("roi_morphology", "edt"),
+                                                 bReuseRois=parse_bool(self.Config.get("reuse_rois", True)))
         # ~ self.ImageProcessor.start() moved to when running program
         self.ip_enable_lock = threading.Lock()
 
-    def CaptureImageThread(self, cropping=(0,0,1,1), group=None, verbose=False, comment='', suffix='', protocol=True):
+    def CaptureImageThread(self, cropping=None, group=None, verbose=False, comment='', suffix='', protocol=True):
         """ This is running in a thread. It should not call any GTK functions """
         group = '' if group is None else group
+        cropping = self.Cropping if cropping is None else cropping
         
         self.CaptureCount += 1
         self.captureCountThisProtocol += 1
@@ -179,12 +212,16 @@ class ZionSession():
         print("_save_event_image starting...")
         protocol_count = str(self.ProtocolCount).zfill(ZionSession.protocolCountDigits) + 'A'
         while True:
-            buffer, event = image_buffer_event_queue.get()
+            frame, event = image_buffer_event_queue.get()
             # buffer, event = image_buffer_event_queue.get_nowait()
-            if buffer is None:
+            if frame is None:
                 print("_save_event_image -- received stop signal!")
                 break
 
+            # frame is either a shared memory slot or (if no slot was free) a copy of the buffer
+            frame_slot = frame if isinstance(frame, ZionFrameSlot) else None
+            buffer = self.ImageProcessor.frame_ring.view(frame_slot) if frame_slot is not None else frame
+
             print(f"_save_event_image -- Received buffer -- len(buffer): {len(buffer)}  event.name: {event.name}")
 
             self.CaptureCount += 1
@@ -214,12 +251,15 @@ class ZionSession():
                 f"Writing event image to file {filepath}"
             )
 
-            #Keep record of file saved for loading later in different thread
-            self.ImageProcessor.add_to_convert_queue(filepath)
-            self.all_image_paths.append(filepath)
-
             with open(filepath, "wb") as out:
                 out.write(buffer)
+            if frame_slot is not None:
+                buffer.release()
+            self.session_index.add(filepath)
+
+            #Keep record of file saved for loading later in different thread (which then releases the frame slot)
+            self.ImageProcessor.add_to_convert_queue(filepath, frame_slot)
+            self.all_image_paths.append(filepath)
 
             try:
                 # Attempt to update the last capture (even dark ones):
@@ -384,7 +424,10 @@ class ZionSession():
                         seq_stream.seek(0)
 
                         if event.captureBool:
-                            buffer_queue.put_nowait((seq_stream.getvalue(), event))
+                            # Hand off via a shared memory frame slot, only copying the whole buffer if none is free
+                            with seq_stream.getbuffer() as stream_view:
+                                frame = self.ImageProcessor.frame_ring.put(stream_view[:stream_size])
+                            buffer_queue.put_nowait((frame if frame is not None else seq_stream.getvalue(), event))
                             print(f"Received frame {frame_ind} for event '{event.name}'  capture: {event.captureBool}  buf size: {stream_size}")
                             self.GPIO.debug_trigger()
                         elif frame_ind % 10 == 0:
@@ -479,6 +522,7 @@ class ZionSession():
         self.Camera.quit()
         self.GPIO.quit()
         self.ImageProcessor.stop_event.set()
+        self.ImageProcessor.frame_ring.close()
 
         # Delete the session folder if it's empty
         if os.path.isdir(self.Dir) and not any(os.scandir(self.Dir)):
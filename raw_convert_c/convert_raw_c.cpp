@@ -10,76 +10,209 @@
 using namespace std;
 
 
+// Checks for a plausible BRCM header block at pos and fills geom from it. Returns 0 if valid.
+// The payload after the header has to hold whole padded lines, and not many more than the image height.
+extern "C" int parse_raw_header(const uint8_t * buffer, long length, long pos, raw_geometry * geom)
+{
+	if (pos < 0 || pos + HDR_SIZE > length || memcmp(buffer+pos, "BRCM", 4) != 0)
+		return 1;
+	int width = buffer[pos+HDR_WIDTH_OFFSET] | (buffer[pos+HDR_WIDTH_OFFSET+1] << 8);
+	int height = buffer[pos+HDR_HEIGHT_OFFSET] | (buffer[pos+HDR_HEIGHT_OFFSET+1] << 8);
+	if (width <= 0 || height <= 0 || width > MAX_SENSOR_DIM || height > MAX_SENSOR_DIM || width % 2 || height % 2)
+		return 2;
+	int bytes_per_line = ((width*3/2 + 31) / 32) * 32;
+	long payload_length = length - pos - HDR_SIZE;
+	long lines = payload_length / bytes_per_line;
+	if (payload_length % bytes_per_line || lines < height || lines > height + MAX_PADDING_LINES)
+		return 3;
+	geom->offset = pos;
+	geom->width = width;
+	geom->height = height;
+	geom->bytes_per_line = bytes_per_line;
+	return 0;
+}
+
+// Finds the raw header of a jpeg+raw buffer, first where a full resolution capture has it, then searching back from the end.
+// Returns its offset, or -1 if there is none.
+extern "C" long find_raw_header(const uint8_t * buffer, long length, raw_geometry * geom)
+{
+	if (parse_raw_header(buffer, length, length - OFFSET_FROM_END - 1, geom) == 0)
+		return geom->offset;
+	for (long pos = length - HDR_SIZE; pos >= 0; pos--) {
+		if (buffer[pos] == 'B' && parse_raw_header(buffer, length, pos, geom) == 0)
+			return pos;
+	}
+	return -1;
+}
+
+// Unpacks the 12-bit packed bayer data (everything after the BRCM header) into
+// a half-resolution 16-bit RGB image (img_h x img_w x 3), averaging the two greens.
+// img_w and img_h are half the sensor width and height, bytes_per_line the padded raw line length.
+// Exported with C linkage so it can also be called in-process (eg via ctypes).
+extern "C" int unpack_raw_rgb(const uint8_t * input_buffer, uint16_t * output_buffer, int img_w, int img_h, int bytes_per_line)
+{
+	const uint8_t  * dual_line_start;
+	uint16_t * output_line_buffer;
+	uint16_t currentPixel[3];
+	uint16_t GreenPixel1;
+	uint16_t GreenPixel2;
+
+	for (int l=0; l<img_h; l++) { //l is line index
+		// we want to look at lines 2*l and 2*l+1, which is the following:
+		dual_line_start = input_buffer + 2*l*bytes_per_line; //&input_buffer[2*l*bytes_per_line]; //
+		output_line_buffer = output_buffer + 3*l*img_w;
+		for (int i=0; i < 3*img_w; i=i+3) { // 3 bytes per pair of 12-bit pixels
+
+			GreenPixel1     = (uint16_t)( (*(i+dual_line_start) << 4) | (*(i+dual_line_start+2) & 0x0F) ); //green1
+			GreenPixel2     = (uint16_t)( (*(i+dual_line_start+1+bytes_per_line) << 4) | ((*(i+dual_line_start+2+bytes_per_line) >> 4) & 0x0F) ); //green2
+			currentPixel[0] = (uint16_t)( (*(i+dual_line_start+1) << 4) | ((*(i+dual_line_start+2) >> 4) & 0x0F) ) << 4; //red
+			currentPixel[2] = (uint16_t)( (*(i+dual_line_start+bytes_per_line) << 4) | (*(i+dual_line_start+2+bytes_per_line) & 0x0F) ) << 4; //blue
+			currentPixel[1] = (GreenPixel1 << 3) + (GreenPixel2 << 3);
+
+			memcpy(output_line_buffer+i, currentPixel, 6);
+		}
+	}
+	return 0;
+}
+
+// Unpacks the 12-bit packed bayer data into the full resolution 12-bit mosaic (2*img_h x 2*img_w), no demosaicing.
+// Even lines are G1 R G1 R..., odd lines are B G2 B G2...
+extern "C" int unpack_raw_bayer(const uint8_t * input_buffer, uint16_t * output_buffer, int img_w, int img_h, int bytes_per_line)
+{
+	const uint8_t * line_start;
+	uint16_t * output_line_buffer;
+
+	for (int l=0; l<2*img_h; l++) { //l is raw line index
+		line_start = input_buffer + l*bytes_per_line;
+		output_line_buffer = output_buffer + 2*l*img_w;
+		for (int i=0, p=0; i < 3*img_w; i=i+3, p=p+2) {
+			output_line_buffer[p]   = (uint16_t)( (*(i+line_start) << 4) | (*(i+line_start+2) & 0x0F) );
+			output_line_buffer[p+1] = (uint16_t)( (*(i+line_start+1) << 4) | ((*(i+line_start+2) >> 4) & 0x0F) );
+		}
+	}
+	return 0;
+}
+
+// Same as unpack_raw_rgb, with dark subtraction (and flat field gain) in the same pass.
+// dark is an img_h x img_w x 3 image subtracted with saturation at 0. If gain isn't NULL it's an
+// img_h x img_w x 3 float image the dark subtracted values are multiplied by, rounded and clamped to 16 bits.
+extern "C" int unpack_raw_rgb_calibrated(const uint8_t * input_buffer, uint16_t * output_buffer, const uint16_t * dark, const float * gain, int img_w, int img_h, int bytes_per_line)
+{
+	const uint8_t  * dual_line_start;
+	int pixel[3];
+	int GreenPixel1;
+	int GreenPixel2;
+	long idx;
+	float value;
+
+	for (int l=0; l<img_h; l++) { //l is line index
+		dual_line_start = input_buffer + 2*l*bytes_per_line;
+		for (int i=0; i < 3*img_w; i=i+3) {
+			GreenPixel1 = (*(i+dual_line_start) << 4) | (*(i+dual_line_start+2) & 0x0F); //green1
+			GreenPixel2 = (*(i+dual_line_start+1+bytes_per_line) << 4) | ((*(i+dual_line_start+2+bytes_per_line) >> 4) & 0x0F); //green2
+			pixel[0] = ((*(i+dual_line_start+1) << 4) | ((*(i+dual_line_start+2) >> 4) & 0x0F)) << 4; //red
+			pixel[1] = (GreenPixel1 << 3) + (GreenPixel2 << 3);
+			pixel[2] = ((*(i+dual_line_start+bytes_per_line) << 4) | (*(i+dual_line_start+2+bytes_per_line) & 0x0F)) << 4; //blue
+
+			idx = 3*((long)l*img_w) + i;
+			for (int c=0; c<3; c++) {
+				pixel[c] -= dark[idx+c];
+				if (pixel[c] < 0)
+					pixel[c] = 0;
+				if (gain) {
+					value = (float)pixel[c] * gain[idx+c] + 0.5f;
+					pixel[c] = (value >= 65535.0f) ? 65535 : (int)value;
+				}
+				output_buffer[idx+c] = (uint16_t)pixel[c];
+			}
+		}
+	}
+	return 0;
+}
+
+
+
+// Maps a codec name to its libtiff compression scheme, -1 if unknown
+int get_compression(string codec)
+{
+	if (codec == "none")
+		return COMPRESSION_NONE;
+	if (codec == "deflate")
+		return COMPRESSION_ADOBE_DEFLATE;
+	if (codec == "lzw")
+		return COMPRESSION_LZW;
+#ifdef COMPRESSION_ZSTD
+	if (codec == "zstd")
+		return COMPRESSION_ZSTD;
+#endif
+	return -1;
+}
 
-int jpg_to_raw(string in_filepath, string out_filepath)
+int jpg_to_raw(string in_filepath, string out_filepath, int compression, int level)
 {
 	cout << in_filepath << endl;
 	int ret = 0;
-	const char key_literal[5] = {'B', 'R', 'C', 'M', '\0'};
-	unsigned char key_buffer[5];
-	const int buffer_length = OFFSET_FROM_END - HDR_SIZE + 1;
 
 	FILE* f = fopen(in_filepath.c_str(), "rb");
 	if (!f) {
 		cout << "Unable to open image" << endl;
+		return 1;
+	}
+
+	fseek(f, 0, SEEK_END);
+	long file_length = ftell(f);
+	fseek(f, 0, SEEK_SET);
+	uint8_t * file_buffer = (uint8_t*)malloc(file_length);
+	if (fread(file_buffer, 1, file_length, f) != (size_t)file_length) {
+		cout << "Unable to read image" << endl;
 		ret++;
 	}
 
 	else {
-		fseek(f, -1 * (OFFSET_FROM_END +1), SEEK_END);
-		fread(key_buffer, 1, 4, f);
-		key_buffer[4] = '\0';
-
-		if (strcmp((char*)key_buffer, key_literal) == 0) {
-			uint8_t * input_buffer = (uint8_t*)malloc(buffer_length);
-			fseek(f, -1 * buffer_length, SEEK_END);
-			fread(input_buffer, 1, buffer_length, f);
+		raw_geometry geom;
+		if (find_raw_header(file_buffer, file_length, &geom) >= 0) {
+			const uint8_t * input_buffer = file_buffer + geom.offset + HDR_SIZE;
+			const int img_w = geom.width/2;
+			const int img_h = geom.height/2;
 
 			TIFF* tif = TIFFOpen(out_filepath.c_str(), "w"); //opening file here
 
-			TIFFSetField(tif, TIFFTAG_IMAGEWIDTH, (uint32_t)IMG_W);
-			TIFFSetField(tif, TIFFTAG_IMAGELENGTH, (uint32_t)IMG_H);
+			TIFFSetField(tif, TIFFTAG_IMAGEWIDTH, (uint32_t)img_w);
+			TIFFSetField(tif, TIFFTAG_IMAGELENGTH, (uint32_t)img_h);
 			TIFFSetField(tif, TIFFTAG_BITSPERSAMPLE, (uint16_t)16);
 			TIFFSetField(tif, TIFFTAG_SAMPLESPERPIXEL, (uint16_t)3);
 			TIFFSetField(tif, TIFFTAG_PHOTOMETRIC, PHOTOMETRIC_RGB);
 			TIFFSetField(tif, TIFFTAG_ORIENTATION, ORIENTATION_TOPLEFT);
 			TIFFSetField(tif, TIFFTAG_PLANARCONFIG, PLANARCONFIG_CONTIG);
-			TIFFSetField(tif, TIFFTAG_ROWSPERSTRIP, (uint32_t)1);
-
-			uint8_t  * dual_line_start;
-			uint16_t * output_line_buffer = (uint16_t*)malloc(6*IMG_W);
-			uint16_t currentPixel[3];
-			uint16_t GreenPixel1;
-			uint16_t GreenPixel2;
-			int res;
-
-			for (int l=0; l<IMG_H; l++) { //l is line index
-				// we want to look at lines 2*l and 2*l+1, which is the following:
-				//memcpy(dual_line_buffer, &input_buffer[2*l*BYTES_PER_LINE], BYTES_PER_LINE*2)
-				//now dual_line_buffer is set up as follows:
-				dual_line_start = input_buffer + 2*l*BYTES_PER_LINE; //&input_buffer[2*l*BYTES_PER_LINE]; //
-				for (int i=0; i < USED_BYTES_PER_LINE; i=i+3) {
-
-					GreenPixel1     = (uint16_t)( (*(i+dual_line_start) << 4) | (*(i+dual_line_start+2) & 0x0F) ); //green1
-					GreenPixel2     = (uint16_t)( (*(i+dual_line_start+1+BYTES_PER_LINE) << 4) | ((*(i+dual_line_start+2+BYTES_PER_LINE) >> 4) & 0x0F) ); //green2
-					currentPixel[0] = (uint16_t)( (*(i+dual_line_start+1) << 4) | ((*(i+dual_line_start+2) >> 4) & 0x0F) ) << 4; //red
-					currentPixel[2] = (uint16_t)( (*(i+dual_line_start+BYTES_PER_LINE) << 4) | (*(i+dual_line_start+2+BYTES_PER_LINE) & 0x0F) ) << 4; //blue
-					currentPixel[1] = (GreenPixel1 << 3) + (GreenPixel2 << 3);
-
-					memcpy(output_line_buffer+i, currentPixel, 6);
-				}
+			TIFFSetField(tif, TIFFTAG_ROWSPERSTRIP, (uint32_t)ROWS_PER_STRIP);
+			TIFFSetField(tif, TIFFTAG_COMPRESSION, (uint16_t)compression);
+			if (compression != COMPRESSION_NONE) {
+				// lossless codecs do much better on differences between neighboring pixels
+				TIFFSetField(tif, TIFFTAG_PREDICTOR, PREDICTOR_HORIZONTAL);
+				if (level > 0 && compression == COMPRESSION_ADOBE_DEFLATE)
+					TIFFSetField(tif, TIFFTAG_ZIPQUALITY, level);
+#ifdef COMPRESSION_ZSTD
+				if (level > 0 && compression == COMPRESSION_ZSTD)
+					TIFFSetField(tif, TIFFTAG_ZSTD_LEVEL, level);
+#endif
+			}
+
+			uint16_t * output_buffer = (uint16_t*)malloc(6*img_w*img_h);
+			unpack_raw_rgb(input_buffer, output_buffer, img_w, img_h, geom.bytes_per_line);
 
-				res = TIFFWriteScanline(tif, output_line_buffer, l, 0);
-				if (res < 1){
-					cout << "Error writing scanline" << endl;
+			tmsize_t res;
+			int rows;
+			for (int s=0; s*ROWS_PER_STRIP < img_h; s++) { //s is strip index
+				rows = (img_h - s*ROWS_PER_STRIP < ROWS_PER_STRIP) ? img_h - s*ROWS_PER_STRIP : ROWS_PER_STRIP;
+				res = TIFFWriteEncodedStrip(tif, s, output_buffer + 3*s*ROWS_PER_STRIP*img_w, 6*rows*img_w);
+				if (res < 0){
+					cout << "Error writing strip" << endl;
 					ret ++;
 				}
 			}
 
 			TIFFClose(tif); //closing file here
-			if (output_line_buffer)
-				_TIFFfree(output_line_buffer);
-			free(input_buffer);
+			free(output_buffer);
 		}
 
 		else {
@@ -87,6 +220,7 @@ int jpg_to_raw(string in_filepath, string out_filepath)
 			ret++;
 		}
 	}
+	free(file_buffer);
 	fclose(f);
 	return ret;
 }
@@ -99,8 +233,20 @@ int main(int argc, char* argv[])
 	}
 	string filepath = argv[1];
 	string target_path = argv[2];
+	// optional: codec (none, deflate, lzw, zstd) and level
+	int compression = COMPRESSION_NONE;
+	int level = -1;
+	if (argc > 3) {
+		compression = get_compression(argv[3]);
+		if (compression < 0) {
+			cout << "Unknown compression " << argv[3] << endl;
+			return 1;
+		}
+	}
+	if (argc > 4)
+		level = atoi(argv[4]);
 	//~ clock_t start = clock();
-	int out = jpg_to_raw(filepath, target_path);
+	int out = jpg_to_raw(filepath, target_path, compression, level);
 	//~ clock_t end = clock();
 	//~ double time_used = ((double)(end-start))/ CLOCKS_PER_SEC;
 	//~ cout << time_used << endl;
@@ -7,3 +7,17 @@
 #define USED_BYTES_PER_LINE 6084
 #define IMG_W 2028
 #define IMG_H 1520
+#define ROWS_PER_STRIP 16
+// BroadcomRawHeader (see picamera) fields, relative to "BRCM"
+#define HDR_WIDTH_OFFSET 208
+#define HDR_HEIGHT_OFFSET 210
+#define MAX_SENSOR_DIM 8192
+#define MAX_PADDING_LINES 64
+
+// Geometry of the raw data appended to a capture, read from its BRCM header block
+struct raw_geometry {
+	long offset;        // of "BRCM" from the start of the buffer
+	int width;          // sensor pixels, ie twice the rgb output
+	int height;
+	int bytes_per_line; // 12-bit packed, padded to 32 bytes
+};
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from ImageProcessing.raw_converter import HDR_SIZE, HDR_WIDTH_OFFSET, IMG_W, IMG_H, UNPACK_BACKENDS, get_raw_convert_lib, get_raw_geometry, decode_raw_buffer, numba
+
+'''
+    Regression tests of the raw unpack backends (the C kernel when libconvert_raw_c.so is built, numba when it's installed,
+    and numpy) against a plain per-pixel unpacking, on synthetic jpeg+raw buffers laid out like captures.
+'''
+
+def make_jpeg_raw(width, height, seed=0, jpeg_size=4096, padding_lines=16):
+    ''' Random "jpeg", a BRCM header block with the sensor size, and random 12-bit packed lines padded to 32 bytes '''
+    rng = np.random.default_rng(seed)
+    header = bytearray(HDR_SIZE)
+    header[:4] = b'BRCM'
+    header[HDR_WIDTH_OFFSET:HDR_WIDTH_OFFSET+4] = np.array([width, height], dtype='<u2').tobytes()
+    bytes_per_line = (width*3//2 + 31) // 32 * 32
+    payload = rng.integers(0, 256, bytes_per_line*(height+padding_lines), dtype=np.uint8)
+    return rng.integers(0, 256, jpeg_size, dtype=np.uint8).tobytes() + bytes(header) + payload.tobytes(), payload, bytes_per_line
+
+def unpack_sensor_pixels(payload, bytes_per_line, width, nLines):
+    ''' 12-bit values of the first nLines sensor lines, two pixels per 3 bytes: AAAAAAAA BBBBBBBB BBBBAAAA '''
+    pixels = np.empty((nLines, width), dtype=np.uint16)
+    for l in range(nLines):
+        line = payload[l*bytes_per_line:]
+        for p in range(width//2):
+            b0, b1, b2 = int(line[3*p]), int(line[3*p+1]), int(line[3*p+2])
+            pixels[l, 2*p] = (b0 << 4) | (b2 & 0x0F)
+            pixels[l, 2*p+1] = (b1 << 4) | (b2 >> 4)
+    return pixels
+
+def reference_rgb(pixels):
+    ''' G1 R / B G2 bayer quads to 16-bit rgb, greens averaged '''
+    red, green1 = pixels[0::2, 1::2], pixels[0::2, 0::2]
+    blue, green2 = pixels[1::2, 0::2], pixels[1::2, 1::2]
+    return np.stack([red << 4, (green1 << 3) + (green2 << 3), blue << 4], axis=-1).astype(np.uint16)
+
+def reference_bayer(pixels):
+    return np.stack([pixels[0::2, 1::2], pixels[0::2, 0::2], pixels[1::2, 1::2], pixels[1::2, 0::2]], axis=-1).astype(np.uint16) << 4
+
+def get_backend(backend):
+    if backend == 'c' and get_raw_convert_lib() is None:
+        pytest.skip("libconvert_raw_c.so isn't built")
+    if backend == 'numba' and numba is None:
+        pytest.skip("numba isn't installed")
+    return backend
+
+# full resolution (sensor mode 3, the default geometry, only its first lines are compared), sensor mode 2,
+# and a small one whose lines need padding
+GEOMETRIES = [(2*IMG_W, 2*IMG_H, 8), (IMG_W, IMG_H, 8), (70, 24, 24)]
+
+@pytest.fixture(scope="module", params=GEOMETRIES, ids=lambda g: f"{g[0]}x{g[1]}")
+def capture(request):
+    width, height, nLines = request.param
+    buffer, payload, bytes_per_line = make_jpeg_raw(width, height)
+    return buffer, unpack_sensor_pixels(payload, bytes_per_line, width, nLines)
+
+def test_geometry_from_header():
+    buffer, _, bytes_per_line = make_jpeg_raw(70, 24)
+    geometry = get_raw_geometry(buffer)
+    assert (geometry.width, geometry.height, geometry.bytes_per_line) == (70, 24, bytes_per_line) == (70, 24, 128)
+
+@pytest.mark.parametrize("backend", UNPACK_BACKENDS)
+def test_rgb(capture, backend):
+    buffer, pixels = capture
+    img = decode_raw_buffer(buffer, mode='rgb', backend=get_backend(backend))
+    np.testing.assert_array_equal(img[:pixels.shape[0]//2], reference_rgb(pixels))
+
+@pytest.mark.parametrize("backend", UNPACK_BACKENDS)
+def test_bayer(capture, backend):
+    buffer, pixels = capture
+    img = decode_raw_buffer(buffer, mode='bayer', backend=get_backend(backend))
+    np.testing.assert_array_equal(img[:pixels.shape[0]//2], reference_bayer(pixels))
+
+@pytest.mark.parametrize("backend", UNPACK_BACKENDS)
+@pytest.mark.parametrize("bGain", [False, True], ids=["dark", "dark+gain"])
+def test_calibrated(capture, backend, bGain):
+    buffer, pixels = capture
+    shape = decode_raw_buffer(buffer, backend='numpy').shape
+    rng = np.random.default_rng(1)
+    dark = rng.integers(0, 4096, shape, dtype=np.uint16)
+    gain = rng.uniform(0.5, 20, shape).astype(np.float32) if bGain else None
+    img = decode_raw_buffer(buffer, backend=get_backend(backend), dark=dark, gain=gain)
+
+    nRows = pixels.shape[0]//2
+    rgb = reference_rgb(pixels)
+    values = np.maximum(rgb.astype(np.int64) - dark[:nRows], 0)
+    if bGain:
+        # float32 arithmetic, rounded half up and clamped to 16 bits
+        values = np.minimum(np.floor(values.astype(np.float32) * gain[:nRows] + np.float32(0.5)), 65535)
+    np.testing.assert_array_equal(img[:nRows], values.astype(np.uint16))
@@ -0,0 +1,47 @@
+import os
+
+from ImageProcessing.ZionSessionIndex import ZionSessionIndex, get_session_index
+
+'''
+    Tests of the persisted session index: captures added as they're written, and deleted ones dropped when it's reopened.
+'''
+
+def make_capture(dir_path, count, wavelength, cycle, ext=".tif"):
+    filepath = os.path.join(dir_path, f"{count:08d}_001A_{count:05d}_{wavelength}_C{cycle:03d}_{1000+count:09d}{ext}")
+    open(filepath, "wb").close()
+    return filepath
+
+def test_added_and_reopened(tmp_path):
+    index = ZionSessionIndex(str(tmp_path), ext=".tif")
+    paths = [make_capture(tmp_path, i, wl, 1) for i, wl in enumerate(("000", "365", "365"))]
+    for filepath in paths:
+        index.add(filepath)
+    assert index.cycles == [1] and index.get_wavelengths(1) == ["000", "365"]
+    assert index.get_names(1, "365") == [os.path.splitext(os.path.basename(fp))[0] for fp in paths[1:]]
+    index.close()
+
+    reopened = ZionSessionIndex(str(tmp_path), ext=".tif")
+    assert len(reopened) == 3 and reopened.get_last(1, "365") == index.get_last(1, "365")
+    reopened.close()
+
+def test_deleted_files_dropped(tmp_path):
+    index = ZionSessionIndex(str(tmp_path), ext=".tif")
+    paths = [make_capture(tmp_path, i, "365", cycle) for i, cycle in enumerate((1, 1, 2))]
+    for filepath in paths:
+        index.add(filepath)
+    index.close()
+    os.remove(paths[1])
+    os.remove(paths[2])
+
+    reopened = ZionSessionIndex(str(tmp_path), ext=".tif")
+    assert len(reopened) == 1 and reopened.cycles == [1]
+    reopened.close()
+    with open(os.path.join(tmp_path, "session_index_tif.csv")) as f:
+        assert len(f.readlines()) == 1
+
+def test_process_index_not_relisted(tmp_path):
+    index = get_session_index(str(tmp_path), ext=".tif")
+    make_capture(tmp_path, 0, "365", 1)
+    assert get_session_index(str(tmp_path), ext=".tif") is index and len(index) == 0
+    assert len(get_session_index(str(tmp_path), ext=".tif", bRefresh=True)) == 1
+    index.close()
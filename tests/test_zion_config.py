@@ -0,0 +1,40 @@
+import pytest
+
+from ZionConfig import parse_bool, parse_numbers, parse_bounds, parse_optional
+
+'''
+    Tests of parsing the string values of zion.cfg (see ZionConfig.read_config_file) into the image processor's parameters.
+'''
+
+@pytest.mark.parametrize("value, expected", [("True", True), ("yes", True), (" 1 ", True), ("on", True), (True, True),
+                                             ("False", False), ("no", False), ("0", False), ("OFF", False), (False, False)])
+def test_parse_bool(value, expected):
+    assert parse_bool(value) is expected
+
+@pytest.mark.parametrize("value", ["", "None", "maybe"])
+def test_parse_bool_invalid(value):
+    with pytest.raises(ValueError):
+        parse_bool(value)
+
+@pytest.mark.parametrize("value", ["0.1,0.1,0.8,0.8", " (0.1, 0.1, 0.8, 0.8) ", "[0.1,0.1,0.8,0.8]", (0.1, 0.1, 0.8, 0.8)])
+def test_parse_numbers(value):
+    assert parse_numbers(value, float, 4) == (0.1, 0.1, 0.8, 0.8)
+
+@pytest.mark.parametrize("value", ["0.1,0.1,0.8", "0.1,0.1,0.8,0.8,1", "0.1,a,0.8,0.8", ""])
+def test_parse_numbers_invalid(value):
+    with pytest.raises(ValueError):
+        parse_numbers(value, float, 4)
+
+@pytest.mark.parametrize("value, expected", [("0,4095", (0, 4095)), ("0, None", (0, None)), ("-0.5,1.5", (-0.5, 1.5)), ("None", None), (None, None)])
+def test_parse_bounds(value, expected):
+    bounds = parse_bounds(value)
+    assert bounds == expected and (bounds is None or all(type(b) is type(e) for b, e in zip(bounds, expected)))
+
+@pytest.mark.parametrize("value", ["4095", "0,1,2", "0,a"])
+def test_parse_bounds_invalid(value):
+    with pytest.raises(ValueError):
+        parse_bounds(value)
+
+@pytest.mark.parametrize("value, expected", [("translation", "translation"), ("None", None), ("none", None), ("", None), (None, None)])
+def test_parse_optional(value, expected):
+    assert parse_optional(value) == expected